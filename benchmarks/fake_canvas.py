@@ -0,0 +1,438 @@
+"""A local stand-in for the parts of the Canvas API used by the grading tool.
+
+The server generates a course with students, groups, assignments and
+submissions. Submissions are zip files or git bundles. Grades and comments
+can be posted, for single students or in bulk. Latency and Canvas's rate
+limiting can be simulated.
+"""
+
+import io
+import itertools
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+from zipfile import ZipFile
+
+COURSE_ID = 1
+ASSIGNMENT_GROUP_ID = 5
+GROUPSET_ID = 7
+ASSIGNMENT_GROUP = "ECPC"
+GROUPSET = "Groups"
+# Canvas's rate limit: a bucket of 700 which refills 10 per second
+RATE_LIMIT_BUCKET = 700
+RATE_LIMIT_REFILL = 10
+
+
+@dataclass
+class CourseSize:
+    students: int = 100
+    assignments: int = 5
+    groups: int = 4
+    # number of files in each submitted zip or repository
+    files: int = 20
+    # size of each submitted file in bytes
+    file_size: int = 4096
+    # every nth student submits a git bundle instead of a zip file
+    bundle_every: int = 2
+
+
+class RateLimiter:
+    """Leaky bucket like Canvas's, which is emptied by the cost of requests."""
+
+    def __init__(self, cost: float) -> None:
+        self.cost = cost
+        self.remaining = float(RATE_LIMIT_BUCKET)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float | None:
+        """Take the cost of a request from the bucket.
+
+        Returns:
+            float | None: the remaining quota, or None if the request is
+            throttled.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.remaining = min(
+                RATE_LIMIT_BUCKET,
+                self.remaining + (now - self.updated_at) * RATE_LIMIT_REFILL,
+            )
+            self.updated_at = now
+            if self.remaining < self.cost:
+                return None
+            self.remaining -= self.cost
+            return self.remaining
+
+
+class FakeCanvas:
+    """Fake Canvas server running in a background thread.
+
+    Args:
+        size (CourseSize): the size of the generated course.
+        latency (float): the time in seconds to wait before each API response.
+        rate_limit_cost (float | None): the cost of each API request, taken
+            from a bucket of 700 which refills 10 per second, or None to
+            disable rate limiting.
+        page_size (int): the maximum number of items per page.
+    """
+
+    def __init__(
+        self,
+        size: CourseSize = CourseSize(),
+        latency: float = 0.05,
+        rate_limit_cost: float | None = None,
+        page_size: int = 100,
+    ) -> None:
+        self.size = size
+        self.latency = latency
+        self.page_size = page_size
+        self.limiter = RateLimiter(rate_limit_cost) if rate_limit_cost else None
+        self.request_count = 0
+        self.throttled_count = 0
+        # grades and comments posted per (assignment id, student id)
+        self.grades: dict[tuple[int, int], str] = {}
+        self.comments: dict[tuple[int, int], list[str]] = {}
+        # bulk updates, which are applied when their progress is requested
+        self.progress: dict[int, tuple[int, dict]] = {}
+        self._progress_ids = itertools.count(1)
+        self._grades_lock = threading.Lock()
+        self._fixtures_dir = Path(tempfile.mkdtemp(prefix="fake-canvas-"))
+        self.files = {
+            "zip": create_zip_fixture(size),
+            "bundle": create_bundle_fixture(size, self._fixtures_dir),
+        }
+        self._server = ThreadingHTTPServer(("localhost", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeCanvas":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._fixtures_dir, ignore_errors=True)
+
+    def __enter__(self) -> "FakeCanvas":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def get_canvas_config(self, course_alias: str = "bench") -> dict:
+        """Get a canvas-course-tools configuration for this server."""
+        return {
+            "servers": {"fake": {"url": self.url, "token": "fake-token"}},
+            "courses": {course_alias: {"server": "fake", "course_id": COURSE_ID}},
+        }
+
+    def get_students(self, group: int | None = None) -> list[dict]:
+        return [
+            {
+                "id": i,
+                "short_name": f"Student {i:04d}",
+                "sortable_name": f"{i:04d}, Student",
+            }
+            for i in range(self.size.students)
+            if group is None or i % self.size.groups == group
+        ]
+
+    def get_assignments(self) -> list[dict]:
+        return [
+            {
+                "id": 100 + i,
+                "name": f"Assignment {i}",
+                "submission_types": ["online_upload"],
+            }
+            for i in range(self.size.assignments)
+        ]
+
+    def get_submission(self, assignment_id: int, student_id: int) -> dict:
+        kind = "bundle" if student_id % self.size.bundle_every == 0 else "zip"
+        submitted = student_id % 10 != 9
+        attempt = {
+            "id": assignment_id * 100_000 + student_id,
+            "attempt": 1 if submitted else None,
+            "submitted_at": "2025-01-01T10:00:00Z" if submitted else None,
+            "seconds_late": 0 if student_id % 5 else 3600,
+            "attachments": (
+                [
+                    {
+                        "id": student_id,
+                        "filename": f"code.{kind}",
+                        "url": f"{self.url}/files/{kind}",
+                        "content-type": "application/octet-stream",
+                    }
+                ]
+                if submitted
+                else []
+            ),
+        }
+        key = (assignment_id, student_id)
+        grade = "Goed" if submitted and student_id % 3 == 0 else None
+        return attempt | {
+            "user_id": student_id,
+            "grade": self.grades.get(key, grade),
+            "score": None,
+            "missing": not submitted,
+            "submission_history": [attempt],
+            "submission_comments": [
+                {
+                    "id": i,
+                    "author_name": "Teacher",
+                    "created_at": "2025-01-02T10:00:00Z",
+                    "comment": comment,
+                }
+                for i, comment in enumerate(self.comments.get(key, []))
+            ],
+        }
+
+    def update_grade(
+        self,
+        assignment_id: int,
+        student_id: int,
+        grade: str | None,
+        comment: str | None,
+    ) -> None:
+        with self._grades_lock:
+            if grade is not None:
+                self.grades[(assignment_id, student_id)] = grade
+            if comment:
+                self.comments.setdefault((assignment_id, student_id), []).append(
+                    comment
+                )
+
+    def get_progress(self, progress_id: int) -> dict | None:
+        """Apply a bulk update, which is reported as queued until now."""
+        with self._grades_lock:
+            update = self.progress.pop(progress_id, None)
+        if update is None:
+            return None
+        assignment_id, grade_data = update
+        for student_id, data in grade_data.items():
+            self.update_grade(
+                assignment_id,
+                int(student_id),
+                data.get("posted_grade"),
+                data.get("text_comment"),
+            )
+        return {"id": progress_id, "workflow_state": "completed"}
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                fake.request_count += 1
+                url = urlparse(self.path)
+                if url.path.startswith("/files/"):
+                    # file downloads are not rate limited by Canvas
+                    kind = url.path.removeprefix("/files/")
+                    return self.send(fake.files[kind], content_type="application/zip")
+                is_allowed, remaining = self.take_quota()
+                if not is_allowed:
+                    return
+                data = fake.route(url.path, parse_qs(url.query))
+                if data is None:
+                    return self.send(b"Not found", status=404, remaining=remaining)
+                if isinstance(data, list):
+                    return self.send_page(
+                        url.path, parse_qs(url.query), data, remaining
+                    )
+                return self.send(json.dumps(data).encode(), remaining=remaining)
+
+            def do_PUT(self) -> None:
+                self.handle_update("PUT")
+
+            def do_POST(self) -> None:
+                self.handle_update("POST")
+
+            def handle_update(self, method: str) -> None:
+                fake.request_count += 1
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                is_allowed, remaining = self.take_quota()
+                if not is_allowed:
+                    return
+                data = fake.route_update(method, url.path, body)
+                if data is None:
+                    return self.send(b"Not found", status=404, remaining=remaining)
+                self.send(json.dumps(data).encode(), remaining=remaining)
+
+            def take_quota(self) -> tuple[bool, float | None]:
+                """Simulate the latency and rate limit of an API request.
+
+                Returns:
+                    tuple[bool, float | None]: whether the request is allowed,
+                    which is answered here if not, and the remaining quota.
+                """
+                remaining = fake.limiter.take() if fake.limiter else None
+                time.sleep(fake.latency)
+                if fake.limiter and remaining is None:
+                    fake.throttled_count += 1
+                    self.send(
+                        b"403 Forbidden (Rate Limit Exceeded)",
+                        status=403,
+                        remaining=0,
+                    )
+                    return False, None
+                return True, remaining
+
+            def send_page(
+                self, path: str, query: dict, items: list, remaining: float | None
+            ) -> None:
+                page = int(query.get("page", ["1"])[0])
+                per_page = min(int(query.get("per_page", ["10"])[0]), fake.page_size)
+                body = json.dumps(items[(page - 1) * per_page : page * per_page])
+                links = None
+                if page * per_page < len(items):
+                    next_query = {k: v for k, v in query.items() if k != "page"}
+                    next_query["page"] = [str(page + 1)]
+                    links = f'<{fake.url}{path}?{urlencode(next_query, doseq=True)}>; rel="next"'
+                self.send(body.encode(), remaining=remaining, links=links)
+
+            def send(
+                self,
+                body: bytes,
+                status: int = 200,
+                content_type: str = "application/json",
+                remaining: float | None = None,
+                links: str | None = None,
+            ) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if remaining is not None:
+                    self.send_header("X-Rate-Limit-Remaining", f"{remaining:.1f}")
+                if links is not None:
+                    self.send_header("Link", links)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def route(self, path: str, query: dict) -> dict | list | None:
+        parts = path.strip("/").split("/")[2:]
+        match parts:
+            case ["courses", "1"]:
+                return {
+                    "id": COURSE_ID,
+                    "name": "Benchmark course",
+                    "course_code": "bench",
+                    "term": {"name": "2025"},
+                }
+            case ["courses", "1", "assignment_groups"]:
+                return [{"id": ASSIGNMENT_GROUP_ID, "name": ASSIGNMENT_GROUP}]
+            case ["courses", "1", "assignment_groups", _, "assignments"]:
+                return self.get_assignments()
+            case ["courses", "1", "users"]:
+                return self.get_students()
+            case ["courses", "1", "group_categories"]:
+                return [{"id": GROUPSET_ID, "name": GROUPSET}]
+            case ["group_categories", _, "groups"]:
+                return [
+                    {"id": 1000 + i, "name": f"Group {i}"}
+                    for i in range(self.size.groups)
+                ]
+            case ["groups", group_id, "users"]:
+                return self.get_students(int(group_id) - 1000)
+            case ["courses", "1", "assignments", assignment_id, "submissions"]:
+                return [
+                    self.get_submission(int(assignment_id), i)
+                    for i in range(self.size.students)
+                ]
+            case ["courses", "1", "assignments", assignment_id, "submissions", id]:
+                return self.get_submission(int(assignment_id), int(id))
+            case ["courses", "1", "students", "submissions"]:
+                # nothing changes on this server
+                return []
+            case ["progress", progress_id]:
+                return self.get_progress(int(progress_id))
+        return None
+
+    def route_update(self, method: str, path: str, body: dict) -> dict | None:
+        parts = path.strip("/").split("/")[2:]
+        match method, parts:
+            case (
+                "PUT",
+                ["courses", "1", "assignments", assignment_id, "submissions", id],
+            ) if id.isdigit():
+                self.update_grade(
+                    int(assignment_id),
+                    int(id),
+                    body.get("submission", {}).get("posted_grade"),
+                    body.get("comment", {}).get("text_comment"),
+                )
+                return self.get_submission(int(assignment_id), int(id))
+            case (
+                "POST",
+                [
+                    "courses",
+                    "1",
+                    "assignments",
+                    assignment_id,
+                    "submissions",
+                    "update_grades",
+                ],
+            ):
+                with self._grades_lock:
+                    progress_id = next(self._progress_ids)
+                    self.progress[progress_id] = (
+                        int(assignment_id),
+                        body.get("grade_data", {}),
+                    )
+                return {"id": progress_id, "workflow_state": "queued"}
+        return None
+
+
+def create_zip_fixture(size: CourseSize) -> bytes:
+    """Create a zip file like a submitted project."""
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w") as f:
+        f.writestr("project/pyproject.toml", "[project]\nname = 'project'\n")
+        for i in range(size.files):
+            f.writestr(f"project/src/project/module_{i}.py", get_file_contents(i, size))
+    return buffer.getvalue()
+
+
+def create_bundle_fixture(size: CourseSize, tmp_dir: Path) -> bytes:
+    """Create a git bundle of a repository like a submitted project."""
+    repo = tmp_dir / "repo"
+    (repo / "src" / "project").mkdir(parents=True)
+    (repo / "pyproject.toml").write_text("[project]\nname = 'project'\n")
+    for i in range(size.files):
+        (repo / "src" / "project" / f"module_{i}.py").write_text(
+            get_file_contents(i, size)
+        )
+    for args in [
+        ["init", "-b", "main"],
+        ["add", "."],
+        ["-c", "user.name=Student", "-c", "user.email=s@example.com"]
+        + ["commit", "-m", "Submission"],
+        ["bundle", "create", str(tmp_dir / "code.bundle"), "main"],
+    ]:
+        subprocess.run(["git", *args], cwd=repo, check=True, capture_output=True)
+    return (tmp_dir / "code.bundle").read_bytes()
+
+
+def get_file_contents(index: int, size: CourseSize) -> str:
+    line = f"value_{index} = {'0' * 60}\n"
+    return line * (size.file_size // len(line) + 1)
@@ -0,0 +1,474 @@
+"""Benchmarks of the grading tool against a local fake Canvas server.
+
+Every benchmark runs in a fresh grading folder, so that caches from earlier
+runs do not influence the results. Append the results to a JSON lines file
+using --output to track performance over time, e.g.:
+
+    python benchmarks/run.py --students 200 --latency 0.05 --output bench.jsonl
+"""
+
+import asyncio
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+import click
+from canvas_course_tools import configfile
+from canvas_course_tools.datatypes import Assignment, CanvasSubmission, Student
+
+from ecpcgrading.cache import fetch_canvas_data, save_cache
+from ecpcgrading.canvas import get_canvas_tasks
+from ecpcgrading.config import Config, read_config
+from ecpcgrading.downloads import (
+    BlobStore,
+    Manifest,
+    create_session,
+    download_all,
+    download_submission,
+)
+from ecpcgrading.environments import create_env, ensure_env
+from ecpcgrading.extract import extract_all
+from ecpcgrading.grades import GRADES, GradeQueue
+from ecpcgrading.index import get_submission_index
+from ecpcgrading.paths import (
+    get_blob_store_dir,
+    get_code_dir,
+    get_env_templates_dir,
+    get_grade_queue_path,
+    get_manifest_path,
+    get_object_store,
+    get_submissions_dir,
+)
+from ecpcgrading.profiling import STARTUP_BUDGET, StartupProfile
+from fake_canvas import ASSIGNMENT_GROUP, GROUPSET, CourseSize, FakeCanvas
+
+COURSE_ALIAS = "bench"
+
+
+@dataclass
+class Bench:
+    """The fake Canvas server and the settings shared by all benchmarks."""
+
+    canvas: FakeCanvas
+    tmp_dir: Path
+    groupset: bool
+    pool_size: int
+    package_spec: str
+
+    def create_grading_dir(self, **settings) -> Config:
+        """Create an empty grading folder and return its configuration."""
+        root = Path(tempfile.mkdtemp(dir=self.tmp_dir))
+        python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+        lines = [
+            f'course_alias = "{COURSE_ALIAS}"',
+            f'assignment_group = "{ASSIGNMENT_GROUP}"',
+            f"pool_size = {self.pool_size}",
+            *(f"{key} = {json.dumps(value)}" for key, value in settings.items()),
+        ]
+        if self.groupset:
+            lines.append(f'groupset = "{GROUPSET}"')
+        lines += ["[env.default]", 'name = "default"']
+        lines.append(f'python_version = "{python_version}"')
+        lines.append(f"package_spec = {json.dumps(self.package_spec)}")
+        (root / "grading.toml").write_text("\n".join(lines) + "\n")
+        return read_config(root)
+
+    def get_submissions(
+        self, config: Config
+    ) -> tuple[Assignment, list[tuple[Student, CanvasSubmission]]]:
+        """Get the first assignment and the submitted submissions from Canvas."""
+        canvas_tasks, cache = fetch_canvas_data(config)
+        save_cache(config, cache)
+        assignment = cache.assignments[0]
+        submissions = {
+            s.student_id: s for s in canvas_tasks.get_submissions(assignment)
+        }
+        return assignment, [
+            (student, submissions[student.id])
+            for student in cache.students
+            if submissions[student.id].attempt is not None
+        ]
+
+    def download(
+        self, config: Config
+    ) -> tuple[Assignment, list[tuple[Student, CanvasSubmission]]]:
+        """Download all submissions of the first assignment."""
+        assignment, submissions = self.get_submissions(config)
+        with create_session(self.pool_size) as session:
+            download_all(
+                session,
+                get_submissions_dir(config, assignment),
+                BlobStore(get_blob_store_dir(config)),
+                submissions,
+                self.pool_size,
+            )
+        return assignment, submissions
+
+
+BENCHMARKS: dict[str, Callable[[Bench], float]] = {}
+
+
+def benchmark(name: str):
+    """Register a benchmark, which returns the time of the measured part."""
+
+    def register(func: Callable[[Bench], float]) -> Callable[[Bench], float]:
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+@benchmark("startup (no cache)")
+def bench_startup(bench: Bench) -> float:
+    return run_startup(bench.create_grading_dir())
+
+
+@benchmark("startup (cached)")
+def bench_startup_cached(bench: Bench) -> float:
+    config = bench.create_grading_dir()
+    _, cache = fetch_canvas_data(config)
+    save_cache(config, cache)
+    return run_startup(config)
+
+
+def run_startup(config: Config) -> float:
+    """Start the app headless and return the time until assignments are shown."""
+    from ecpcgrading.tui import GradingTool
+
+    cwd = Path.cwd()
+    os.chdir(config.root_path)
+    try:
+        profile = StartupProfile()
+        GradingTool(profile=profile).run(headless=True)
+    finally:
+        os.chdir(cwd)
+    return profile.marks["assignments"][0]
+
+
+@benchmark("startup (budget)")
+def bench_startup_budget(bench: Bench) -> float:
+    """Check the startup budget in a fresh interpreter, like a user would start.
+
+    Returns the time until the first frame, or fails when over budget.
+    """
+    config = bench.create_grading_dir()
+    _, cache = fetch_canvas_data(config)
+    save_cache(config, cache)
+    # the new interpreter does not share the patched Canvas configuration
+    script = (
+        "import sys\n"
+        "from canvas_course_tools import configfile\n"
+        f"configfile.read_config = lambda: {bench.canvas.get_canvas_config(COURSE_ALIAS)!r}\n"
+        "from ecpcgrading.profiling import profile_startup\n"
+        f"sys.exit(0 if profile_startup({STARTUP_BUDGET!r}) else 1)\n"
+    )
+    process = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=config.root_path,
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode:
+        raise click.ClickException(
+            f"Startup is over budget or failed:\n{process.stdout}{process.stderr}"
+        )
+    match = re.search(r"first frame:\s*([\d.]+) ms", process.stdout)
+    return float(match.group(1)) / 1000
+
+
+@benchmark("load submissions")
+def bench_load_submissions(bench: Bench) -> float:
+    config = bench.create_grading_dir(prefetch_submissions=False, refresh_interval=0)
+    _, cache = fetch_canvas_data(config)
+    save_cache(config, cache)
+    return asyncio.run(load_submissions(config))
+
+
+async def load_submissions(config: Config) -> float:
+    """Open the first assignment and wait until all submissions are shown."""
+    from ecpcgrading.students import StudentsScreen
+    from ecpcgrading.tui import GradingTool
+
+    cwd = Path.cwd()
+    os.chdir(config.root_path)
+    try:
+        app = GradingTool()
+        async with app.run_test() as pilot:
+            while type(app.screen).__name__ != "AssignmentsScreen":
+                await pilot.pause(0.01)
+            t0 = time.perf_counter()
+            await pilot.press("enter")
+            while not (
+                isinstance(app.screen, StudentsScreen)
+                and app.screen.last_sync is not None
+            ):
+                await pilot.pause(0.001)
+            return time.perf_counter() - t0
+    finally:
+        os.chdir(cwd)
+
+
+@benchmark("download (single)")
+def bench_download_single(bench: Bench) -> float:
+    config = bench.create_grading_dir()
+    assignment, submissions = bench.get_submissions(config)
+    submissions_dir = get_submissions_dir(config, assignment)
+    submissions_dir.mkdir(parents=True)
+    manifest = Manifest.load(get_manifest_path(config, assignment))
+    with create_session(pool_size=1) as session:
+        t0 = time.perf_counter()
+        download_submission(
+            session,
+            submissions_dir,
+            BlobStore(get_blob_store_dir(config)),
+            *submissions[0],
+            manifest,
+        )
+        return time.perf_counter() - t0
+
+
+@benchmark("download (all)")
+def bench_download_all(bench: Bench) -> float:
+    config = bench.create_grading_dir()
+    assignment, submissions = bench.get_submissions(config)
+    with create_session(bench.pool_size) as session:
+        t0 = time.perf_counter()
+        download_all(
+            session,
+            get_submissions_dir(config, assignment),
+            BlobStore(get_blob_store_dir(config)),
+            submissions,
+            bench.pool_size,
+        )
+        return time.perf_counter() - t0
+
+
+@benchmark("extract (zip)")
+def bench_extract_zip(bench: Bench) -> float:
+    return run_extract(bench, ".zip")
+
+
+@benchmark("extract (bundle)")
+def bench_extract_bundle(bench: Bench) -> float:
+    return run_extract(bench, ".bundle")
+
+
+def run_extract(bench: Bench, suffix: str) -> float:
+    """Extract all submitted files with a suffix and return the time."""
+    config = bench.create_grading_dir()
+    assignment, submissions = bench.download(config)
+    students = [
+        student
+        for student, submission in submissions
+        if submission.attachments[0].filename.endswith(suffix)
+    ]
+    t0 = time.perf_counter()
+    extract_all(
+        get_submission_index(config, assignment),
+        students,
+        get_object_store(config, assignment),
+    )
+    return time.perf_counter() - t0
+
+
+@benchmark("env (first)")
+def bench_env(bench: Bench) -> float:
+    return run_create_envs(bench, count=1)
+
+
+@benchmark("env (second)")
+def bench_env_second(bench: Bench) -> float:
+    return run_create_envs(bench, count=2)
+
+
+def run_create_envs(bench: Bench, count: int) -> float:
+    """Create environments for students and return the time of the last one."""
+    config = bench.create_grading_dir()
+    assignment, submissions = bench.download(config)
+    students = [student for student, _ in submissions[:count]]
+    extract_all(
+        get_submission_index(config, assignment),
+        students,
+        get_object_store(config, assignment),
+    )
+    env = config.env["default"]
+    for student in students:
+        t0 = time.perf_counter()
+        create_env(
+            get_code_dir(config, assignment, student, check_subdir=True),
+            env.python_version,
+            env.package_spec,
+            get_env_templates_dir(config, assignment),
+            None,
+        )
+    return time.perf_counter() - t0
+
+
+@benchmark("env (unchanged)")
+def bench_env_unchanged(bench: Bench) -> float:
+    config = bench.create_grading_dir()
+    assignment, submissions = bench.download(config)
+    student = submissions[0][0]
+    extract_all(
+        get_submission_index(config, assignment),
+        [student],
+        get_object_store(config, assignment),
+    )
+    env = config.env["default"]
+    args = (
+        get_code_dir(config, assignment, student, check_subdir=True),
+        env.python_version,
+        env.package_spec,
+        get_env_templates_dir(config, assignment),
+    )
+    ensure_env(*args)
+    t0 = time.perf_counter()
+    ensure_env(*args)
+    return time.perf_counter() - t0
+
+
+@benchmark("grades (flush)")
+def bench_flush_grades(bench: Bench) -> float:
+    config = bench.create_grading_dir()
+    assignment, submissions = bench.get_submissions(config)
+    canvas_tasks, _ = get_canvas_tasks(config.course_alias, config.pool_size)
+    queue = GradeQueue(get_grade_queue_path(config))
+    expected = {}
+    for i, (student, _) in enumerate(submissions):
+        grade = GRADES[i % len(GRADES)]
+        queue.add(assignment, student, grade, f"Comment for {student.name}")
+        expected[(assignment.id, student.id)] = grade
+    t0 = time.perf_counter()
+    sent, failed = queue.flush(canvas_tasks)
+    duration = time.perf_counter() - t0
+    if (
+        failed
+        or len(queue)
+        or any(bench.canvas.grades.get(key) != grade for key, grade in expected.items())
+    ):
+        raise click.ClickException("Not all grades were sent to the fake server.")
+    return duration
+
+
+def get_commit() -> str | None:
+    process = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+    )
+    return process.stdout.strip() or None
+
+
+@click.command()
+@click.option("--students", default=100, show_default=True)
+@click.option("--assignments", default=5, show_default=True)
+@click.option("--files", default=20, show_default=True, help="Files per submission.")
+@click.option("--file-size", default=4096, show_default=True, help="In bytes.")
+@click.option(
+    "--latency", default=0.05, show_default=True, help="API latency in seconds."
+)
+@click.option(
+    "--rate-limit-cost",
+    type=float,
+    help="Rate limit cost of each API request (Canvas's bucket is 700).",
+)
+@click.option("--groupset", is_flag=True, help="Request students per group.")
+@click.option("--pool-size", default=8, show_default=True)
+@click.option(
+    "--package-spec",
+    default="",
+    help="Packages installed in environments, e.g. 'numpy -e .' (needs network).",
+)
+@click.option("-r", "--repeat", default=3, show_default=True)
+@click.option(
+    "-k", "--select", "selected", multiple=True, help="Only run these benchmarks."
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Append the results to this JSON lines file.",
+)
+def main(
+    students: int,
+    assignments: int,
+    files: int,
+    file_size: int,
+    latency: float,
+    rate_limit_cost: float | None,
+    groupset: bool,
+    pool_size: int,
+    package_spec: str,
+    repeat: int,
+    selected: tuple[str, ...],
+    output: Path | None,
+) -> None:
+    """Run the benchmarks against a local fake Canvas server."""
+    size = CourseSize(
+        students=students, assignments=assignments, files=files, file_size=file_size
+    )
+    tmp_dir = Path(tempfile.mkdtemp(prefix="ecpcgrading-bench-"))
+    results = {}
+    with FakeCanvas(size, latency, rate_limit_cost) as canvas:
+        # point canvas-course-tools to the fake server instead of the user's
+        # configured servers
+        configfile.read_config = lambda: canvas.get_canvas_config(COURSE_ALIAS)
+        bench = Bench(canvas, tmp_dir, groupset, pool_size, package_spec)
+        try:
+            for name, func in BENCHMARKS.items():
+                if selected and not any(s in name for s in selected):
+                    continue
+                times = [func(bench) for _ in range(repeat)]
+                results[name] = {
+                    "min": min(times),
+                    "median": statistics.median(times),
+                    "max": max(times),
+                }
+                click.echo(
+                    f"{name:>20}: {min(times) * 1000:8.1f} ms (min)"
+                    f" {statistics.median(times) * 1000:8.1f} ms (median)"
+                )
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        click.echo(
+            f"{canvas.request_count} requests, {canvas.throttled_count} throttled"
+        )
+    if output is not None:
+        record = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {
+                "students": students,
+                "assignments": assignments,
+                "files": files,
+                "file_size": file_size,
+                "latency": latency,
+                "rate_limit_cost": rate_limit_cost,
+                "groupset": groupset,
+                "pool_size": pool_size,
+                "package_spec": package_spec,
+                "repeat": repeat,
+            },
+            "results": results,
+            "requests": canvas.request_count,
+            "throttled": canvas.throttled_count,
+        }
+        with open(output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
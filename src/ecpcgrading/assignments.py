@@ -2,15 +2,15 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
-from canvas_course_tools.datatypes import Assignment as CanvasAssignment
 from textual.app import ComposeResult
 from textual.containers import Horizontal
 from textual.screen import Screen
 from textual.widgets import Button, Footer, Header, Label, ListItem, ListView, Static
 
-from ecpcgrading.students import StudentsScreen
-
 if TYPE_CHECKING:
+    from canvas_course_tools.datatypes import Assignment as CanvasAssignment
+    from canvas_course_tools.datatypes import CanvasSubmission
+
     from ecpcgrading.tui import GradingTool
 
 
@@ -23,6 +23,15 @@ class Assignment(ListItem):
     def compose(self) -> ComposeResult:
         yield Label(self.title)
 
+    def show_counts(self, submissions: list[CanvasSubmission]) -> None:
+        submitted = [s for s in submissions if s.attempt is not None]
+        late = [s for s in submitted if s.seconds_late > 0]
+        graded = [s for s in submissions if s.grade is not None]
+        self.query_one(Label).update(
+            f"{self.title}  [dim]({len(submitted)} submitted, {len(late)} late,"
+            f" {len(graded)} graded)"
+        )
+
 
 class Assignments(ListView):
     def compose(self) -> ComposeResult:
@@ -30,6 +39,8 @@ class Assignments(ListView):
             yield Assignment(assignment)
 
     def on_list_view_selected(self, event: "Assignments.Selected") -> None:
+        from ecpcgrading.students import StudentsScreen
+
         assignment: Assignment = event.item
         self.app.push_screen(StudentsScreen(assignment))
 
@@ -53,3 +64,34 @@ class AssignmentsScreen(Screen):
 
     def on_mount(self) -> None:
         self.query_one("Assignments").focus()
+        self.show_counts()
+
+    def on_screen_resume(self) -> None:
+        self.show_counts()
+
+    def show_counts(self, assignment_id: int | None = None) -> None:
+        """Show submission counts, using the freshest submissions available.
+
+        Args:
+            assignment_id (int | None): only update this assignment.
+        """
+        for assignment in self.query(Assignment):
+            id = assignment._assignment.id
+            if assignment_id is not None and id != assignment_id:
+                continue
+            if (stored := self.app.submissions.get(id)) is not None:
+                assignment.show_counts(stored[1])
+            elif (cached := self.app.cache.submissions.get(id)) is not None:
+                assignment.show_counts(cached)
+
+    async def update_assignments(self) -> None:
+        """Show the current course and assignments, e.g. after a refresh."""
+        self.query_one("#course_info", Label).update(
+            f"{self.app.course.name} - {self.app.course.term}"
+        )
+        assignments = self.query_one(Assignments)
+        index = assignments.index
+        await assignments.clear()
+        await assignments.extend(Assignment(a) for a in self.app.assignments)
+        assignments.index = index
+        self.show_counts()
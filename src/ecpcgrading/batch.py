@@ -0,0 +1,252 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+import click
+from canvas_course_tools.canvas_tasks import CanvasTasks
+from canvas_course_tools.datatypes import Assignment as CanvasAssignment
+from canvas_course_tools.datatypes import CanvasSubmission
+from canvas_course_tools.datatypes import Student as CanvasStudent
+
+from ecpcgrading import canvas
+from ecpcgrading.cache import (
+    CanvasCache,
+    fetch_canvas_data,
+    load_cache,
+    save_cache,
+    store_submissions,
+)
+from ecpcgrading.config import Config, read_config
+from ecpcgrading.downloads import Manifest
+from ecpcgrading.grades import GradeQueue
+from ecpcgrading.index import get_slug, get_submission_index
+from ecpcgrading.paths import (
+    get_code_dir,
+    get_grade_queue_path,
+    get_manifest_path,
+    get_submissions_dir,
+)
+from ecpcgrading.pipeline import prepare_all
+
+_output_lock = threading.Lock()
+
+
+class ConfigError(click.ClickException):
+    exit_code = 2
+
+
+class StudentsFailed(click.ClickException):
+    exit_code = 1
+
+
+def run_stages(
+    command: str,
+    stage_names: tuple[str, ...],
+    assignment_names: tuple[str, ...],
+    refresh: bool,
+    env_name: str | None = None,
+) -> None:
+    config, canvas_tasks, cache = get_canvas_data(refresh)
+    env = None
+    if env_name is not None:
+        try:
+            env = config.env[env_name]
+        except KeyError:
+            raise ConfigError(f"Unknown environment {env_name}.")
+    elif stage_names == ("env",) and not config.env:
+        raise ConfigError("No environments configured.")
+
+    n_failed = 0
+    for assignment in select_assignments(cache, assignment_names):
+        t0 = time.time()
+        # only download submissions which are known to be new
+        submissions = get_submissions(
+            config, canvas_tasks, cache, assignment, refresh="download" in stage_names
+        )
+        submitted = [
+            (student, submissions[student.id])
+            for student in cache.students
+            if student.id in submissions and submissions[student.id].attempt
+        ]
+        if "download" not in stage_names:
+            # only process submissions which are on disk
+            submitted = [
+                (student, submission)
+                for student, submission in submitted
+                if is_downloaded(config, assignment, student)
+            ]
+
+        def show_progress(student: CanvasStudent, stage: str, state: str) -> None:
+            output(
+                event="progress",
+                command=command,
+                assignment=assignment.name,
+                student=student.name,
+                student_id=student.id,
+                stage=stage,
+                state=state,
+            )
+
+        results = prepare_all(
+            config,
+            assignment,
+            submitted,
+            canvas_tasks.session,
+            show_progress,
+            stage_names,
+            env,
+        )
+        students = {student.id: student for student, _ in submitted}
+        for student_id, result in results.items():
+            if isinstance(result, Exception):
+                output(
+                    event="error",
+                    command=command,
+                    assignment=assignment.name,
+                    student=students[student_id].name,
+                    student_id=student_id,
+                    error=str(result) or type(result).__name__,
+                )
+        failed = sum(isinstance(r, Exception) for r in results.values())
+        n_failed += failed
+        output(
+            event="summary",
+            command=command,
+            assignment=assignment.name,
+            succeeded=len(results) - failed,
+            failed=failed,
+            seconds=round(time.time() - t0, 3),
+        )
+    if n_failed:
+        raise StudentsFailed(f"{command} failed for {n_failed} student(s).")
+
+
+def show_status(assignment_names: tuple[str, ...], refresh: bool) -> None:
+    config, canvas_tasks, cache = get_canvas_data(refresh)
+    for assignment in select_assignments(cache, assignment_names):
+        submissions = get_submissions(config, canvas_tasks, cache, assignment, refresh)
+        submissions_dir = get_submissions_dir(config, assignment)
+        manifest = Manifest.load(get_manifest_path(config, assignment))
+        for student in cache.students:
+            submission = submissions.get(student.id)
+            code_dir = get_code_dir(config, assignment, student, check_subdir=True)
+            output(
+                event="status",
+                assignment=assignment.name,
+                student=student.name,
+                student_id=student.id,
+                attempt=submission.attempt if submission else None,
+                grade=submission.grade if submission else None,
+                downloaded=submission is not None
+                and manifest.is_current(submissions_dir, student, submission),
+                extracted=code_dir.exists(),
+                env=(code_dir / ".venv").exists(),
+            )
+
+
+def push_grades() -> None:
+    config, canvas_tasks, _ = get_canvas_data(refresh=False)
+    queue = GradeQueue(get_grade_queue_path(config))
+    if queue.moved_aside is not None:
+        output(
+            event="warning", command="push-grades", moved_aside=str(queue.moved_aside)
+        )
+    t0 = time.time()
+    sent, failed = queue.flush(canvas_tasks, force=True)
+    for record in sent:
+        output(
+            event="sent",
+            command="push-grades",
+            assignment_id=record.assignment_id,
+            student=record.student_name,
+            student_id=record.student_id,
+            grade=record.grade,
+        )
+    for record in failed:
+        output(
+            event="error",
+            command="push-grades",
+            assignment_id=record.assignment_id,
+            student=record.student_name,
+            student_id=record.student_id,
+            error=record.error,
+        )
+    output(
+        event="summary",
+        command="push-grades",
+        succeeded=len(sent),
+        failed=len(failed),
+        seconds=round(time.time() - t0, 3),
+    )
+    if failed:
+        raise StudentsFailed(f"push-grades failed for {len(failed)} student(s).")
+
+
+def get_canvas_data(refresh: bool) -> tuple[Config, CanvasTasks, CanvasCache]:
+    try:
+        config = read_config(Path.cwd())
+    except FileNotFoundError:
+        raise ConfigError("No grading.toml file found. Are you in the correct folder?")
+    cache = None if refresh else load_cache(config)
+    if cache is None or cache.is_stale(config.cache_ttl):
+        canvas_tasks, new_cache = fetch_canvas_data(config)
+        if cache is not None:
+            new_cache.submissions = cache.submissions
+        cache = new_cache
+        save_cache(config, cache)
+    else:
+        canvas_tasks, _ = canvas.get_canvas_tasks(
+            config.course_alias, config.pool_size, config.max_retries
+        )
+    return config, canvas_tasks, cache
+
+
+def select_assignments(
+    cache: CanvasCache, assignment_names: tuple[str, ...]
+) -> list[CanvasAssignment]:
+    if not assignment_names:
+        return cache.assignments
+    assignments = []
+    for name in assignment_names:
+        try:
+            assignments.append(
+                next(
+                    a
+                    for a in cache.assignments
+                    if name in (a.name, get_slug(a.name), str(a.id))
+                )
+            )
+        except StopIteration:
+            raise ConfigError(f"Unknown assignment {name}.")
+    return assignments
+
+
+def get_submissions(
+    config: Config,
+    canvas_tasks: CanvasTasks,
+    cache: CanvasCache,
+    assignment: CanvasAssignment,
+    refresh: bool,
+) -> dict[int, CanvasSubmission]:
+    submissions = cache.submissions.get(assignment.id)
+    if refresh or submissions is None:
+        submissions = canvas_tasks.get_submissions(assignment)
+        store_submissions(config, cache, assignment, submissions)
+    return {submission.student_id: submission for submission in submissions}
+
+
+def is_downloaded(
+    config: Config, assignment: CanvasAssignment, student: CanvasStudent
+) -> bool:
+    try:
+        get_submission_index(config, assignment).get_submission_file(student)
+    except RuntimeError:
+        return False
+    return True
+
+
+def output(**fields) -> None:
+    """Print a JSON line, safe to call from multiple threads."""
+    with _output_lock:
+        click.echo(json.dumps(fields))
@@ -0,0 +1,191 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+
+from canvas_course_tools.datatypes import Assignment, CanvasSubmission, Course, Student
+from pydantic import AwareDatetime, BaseModel, ValidationError
+from slugify import slugify
+
+from ecpcgrading import canvas
+from ecpcgrading.client import CanvasClient
+from ecpcgrading.config import Config
+from ecpcgrading.downloads import atomic_write
+
+CACHE_VERSION = 1
+
+_cache_lock = threading.RLock()
+
+
+class CanvasCache(BaseModel):
+    """Local copy of the Canvas data needed by the grading tool.
+
+    The cache is stored in the grading root, so that the tool can start
+    without waiting for the Canvas server.
+    """
+
+    version: int = CACHE_VERSION
+    key: str
+    updated_at: AwareDatetime
+    course: Course
+    assignments: list[Assignment]
+    students: list[Student]
+    submissions: dict[int, list[CanvasSubmission]] = {}
+
+    def is_stale(self, ttl: float) -> bool:
+        """Check whether the cache is older than ttl seconds."""
+        age = datetime.now(timezone.utc) - self.updated_at
+        return age.total_seconds() > ttl
+
+
+class SubmissionStore:
+    """In-memory store of the submissions fetched from Canvas in this session.
+
+    The store holds the submissions of at most maxsize assignments, evicting the
+    least recently used assignment. It is safe to use from multiple threads.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._submissions: OrderedDict[int, tuple[datetime, list[CanvasSubmission]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __contains__(self, assignment_id: int) -> bool:
+        with self._lock:
+            return assignment_id in self._submissions
+
+    def get(self, assignment_id: int) -> tuple[datetime, list[CanvasSubmission]] | None:
+        """Get the submissions for an assignment.
+
+        Args:
+            assignment_id (int): the assignment id.
+
+        Returns:
+            tuple[datetime, list[CanvasSubmission]] | None: the time at which
+            the submissions were fetched and the submissions, or None if the
+            assignment is not in the store.
+        """
+        with self._lock:
+            if assignment_id not in self._submissions:
+                return None
+            self._submissions.move_to_end(assignment_id)
+            return self._submissions[assignment_id]
+
+    def put(
+        self,
+        assignment_id: int,
+        submissions: list[CanvasSubmission],
+        fetched_at: datetime,
+    ) -> None:
+        with self._lock:
+            self._submissions[assignment_id] = fetched_at, submissions
+            self._submissions.move_to_end(assignment_id)
+            while len(self._submissions) > self.maxsize:
+                self._submissions.popitem(last=False)
+
+
+def get_cache_key(config: Config) -> str:
+    return "|".join(
+        [
+            config.course_alias,
+            config.assignment_group,
+            config.groupset or "",
+            config.group or "",
+        ]
+    )
+
+
+def get_cache_path(config: Config) -> Path:
+    return (
+        config.root_path
+        / ".ecpcgrading"
+        / f"canvas-{slugify(get_cache_key(config))}.json"
+    )
+
+
+def create_cache(
+    config: Config,
+    course: Course,
+    assignments: list[Assignment],
+    students: list[Student],
+) -> CanvasCache:
+    return CanvasCache(
+        key=get_cache_key(config),
+        updated_at=datetime.now(timezone.utc),
+        course=course,
+        assignments=assignments,
+        students=students,
+    )
+
+
+def fetch_canvas_data(config: Config) -> tuple[CanvasClient, CanvasCache]:
+    """Get the course, assignments and students from Canvas.
+
+    Args:
+        config (Config): the grading tool configuration.
+
+    Returns:
+        tuple[CanvasClient, CanvasCache]: a Canvas client and a new
+        cache containing the Canvas data.
+    """
+    canvas_tasks, course = canvas.find_course(
+        config.course_alias, config.pool_size, config.max_retries
+    )
+    assignments = canvas.get_assignments(canvas_tasks, course, config.assignment_group)
+    students = canvas.get_students(
+        canvas_tasks, course, config.groupset, config.group, config.pool_size
+    )
+    return canvas_tasks, create_cache(config, course, assignments, students)
+
+
+def load_cache(config: Config) -> CanvasCache | None:
+    """Load the Canvas cache for this configuration.
+
+    Args:
+        config (Config): the grading tool configuration.
+
+    Returns:
+        CanvasCache | None: the cache, or None if there is no usable cache
+        because it is missing, unreadable, or of a different version.
+    """
+    try:
+        cache = CanvasCache.model_validate_json(
+            get_cache_path(config).read_bytes(), by_name=True
+        )
+    except (FileNotFoundError, ValidationError):
+        return None
+    if cache.version != CACHE_VERSION or cache.key != get_cache_key(config):
+        return None
+    return cache
+
+
+def save_cache(config: Config, cache: CanvasCache) -> None:
+    path = get_cache_path(config)
+    Path.mkdir(path.parent, parents=True, exist_ok=True)
+    with _cache_lock, atomic_write(path) as f:
+        f.write(cache.model_dump_json().encode())
+
+
+def store_submissions(
+    config: Config,
+    cache: CanvasCache,
+    assignment: Assignment,
+    submissions: list[CanvasSubmission],
+    save: bool = True,
+) -> None:
+    """Store the submissions for an assignment in the cache.
+
+    Args:
+        config (Config): the grading tool configuration.
+        cache (CanvasCache): the cache.
+        assignment (Assignment): the assignment.
+        submissions (list[CanvasSubmission]): the submissions.
+        save (bool): save the cache to disk. When storing the submissions of
+            many assignments, pass False and call save_cache() once afterwards.
+    """
+    with _cache_lock:
+        cache.submissions[assignment.id] = submissions
+        if save:
+            save_cache(config, cache)
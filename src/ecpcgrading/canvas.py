@@ -1,7 +1,94 @@
-from canvas_course_tools.canvas_tasks import CanvasTasks
-from canvas_course_tools.datatypes import Assignment, Course, Student
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from canvas_course_tools import configfile
+from canvas_course_tools.canvas_tasks import (
+    CanvasForbidden,
+    CanvasResourceDoesNotExist,
+    CanvasTasks,
+)
+from canvas_course_tools.datatypes import (
+    Assignment,
+    CanvasSubmission,
+    Course,
+    Group,
+    GroupSet,
+    Student,
+)
+from pydantic import BaseModel
 from unidecode import unidecode
 
+from ecpcgrading.client import CanvasClient
+from ecpcgrading.config import CANVAS_POOL_SIZE, MAX_RETRIES
+
+# how often, and how long, to check whether Canvas finished updating grades
+PROGRESS_INTERVAL = 1
+PROGRESS_TIMEOUT = 120
+
+# groupsets and groups rarely change, so look them up only once per session
+_groupsets: dict[tuple[str, int, str], GroupSet] = {}
+_groups: dict[tuple[str, int], list[Group]] = {}
+
+
+def get_canvas_tasks(
+    course_alias: str,
+    pool_size: int = CANVAS_POOL_SIZE,
+    max_retries: int = MAX_RETRIES,
+) -> tuple[CanvasClient, int]:
+    """Get a Canvas client for a course without contacting the server
+
+    Args:
+        course_alias (str): the alias of the course in the canvas-course-tools
+            configuration.
+        pool_size (int): the maximum number of concurrent requests.
+        max_retries (int): the maximum number of retries per request.
+
+    Returns:
+        tuple[CanvasClient, int]: a Canvas client and the course id.
+    """
+    config = configfile.read_config()
+    try:
+        server, course_id = (
+            config["courses"][course_alias][k] for k in ("server", "course_id")
+        )
+    except KeyError:
+        raise click.BadArgumentUsage(f"Unknown course {course_alias}.")
+    try:
+        url, token = (config["servers"][server][k] for k in ("url", "token"))
+    except KeyError:
+        raise click.UsageError(f"Unknown server '{server}'.")
+    return CanvasClient(url, token, pool_size, max_retries), course_id
+
+
+def find_course(
+    course_alias: str,
+    pool_size: int = CANVAS_POOL_SIZE,
+    max_retries: int = MAX_RETRIES,
+) -> tuple[CanvasClient, Course]:
+    """Get a Canvas client and the course from the server
+
+    Args:
+        course_alias (str): the alias of the course in the canvas-course-tools
+            configuration.
+        pool_size (int): the maximum number of concurrent requests.
+        max_retries (int): the maximum number of retries per request.
+
+    Returns:
+        tuple[CanvasClient, Course]: a Canvas client and the course.
+    """
+    canvas_tasks, course_id = get_canvas_tasks(course_alias, pool_size, max_retries)
+    try:
+        course = canvas_tasks.get_course(course_id)
+    except CanvasResourceDoesNotExist:
+        raise click.UsageError(f"Course {course_alias} does not exist on the server.")
+    except CanvasForbidden:
+        raise click.UsageError(
+            f"You don't have authorization to access course {course_alias}."
+        )
+    return canvas_tasks, course
+
 
 def get_assignments(
     canvas_tasks: CanvasTasks, course: Course, group_name: str
@@ -34,19 +121,45 @@ def get_students(
     course: Course,
     groupset_name: str | None,
     group_name: str | None,
+    max_workers: int = CANVAS_POOL_SIZE,
 ) -> list[Student]:
+    """Get students from Canvas
+
+    Get all students in a group, in all groups of a groupset or in the course,
+    depending on the groupset and group names. Students in a groupset are
+    requested for all groups in parallel.
+
+    Args:
+        canvas_tasks (CanvasTasks): a CanvasTasks instance
+        course (Course): the course object containing the students
+        groupset_name (str | None): the name of the groupset
+        group_name (str | None): the name of the group in the groupset
+        max_workers (int): the maximum number of parallel requests
+
+    Returns:
+        list[Student]: a list of students
+    """
     match groupset_name, group_name:
         case (str(), str()):
             groupset = get_groupset_by_name(groupset_name, canvas_tasks, course)
             group = get_group_from_groupset_by_name(group_name, canvas_tasks, groupset)
             return canvas_tasks.get_students_in_group(group)
         case (str(), None):
-            students = []
             groupset = get_groupset_by_name(groupset_name, canvas_tasks, course)
-            for group in canvas_tasks.list_groups(groupset):
-                students.extend(canvas_tasks.get_students_in_group(group))
+            groups = list_groups(canvas_tasks, groupset)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                students_per_group = executor.map(
+                    canvas_tasks.get_students_in_group, groups
+                )
+                # a student can be a member of multiple groups
+                students = {
+                    student.id: student
+                    for group_students in students_per_group
+                    for student in group_students
+                }
             return sorted(
-                students, key=lambda x: unidecode(getattr(x, "sortable_name"))
+                students.values(),
+                key=lambda x: unidecode(getattr(x, "sortable_name")),
             )
         case (None, str()):
             raise RuntimeError(f"Group {group_name} specified without 'groupset'")
@@ -56,17 +169,152 @@ def get_students(
             )
 
 
+def get_changed_submissions(
+    canvas_tasks: CanvasTasks, assignment: Assignment, since: datetime
+) -> list[CanvasSubmission]:
+    """Get submissions which were submitted or graded since a point in time
+
+    Canvas only filters on one of these at a time, so both are requested.
+    Only new comments, without a new attempt or grade, are not detected.
+
+    Args:
+        canvas_tasks (CanvasTasks): a CanvasTasks instance
+        assignment (Assignment): the assignment
+        since (datetime): the point in time (timezone aware)
+
+    Returns:
+        list[CanvasSubmission]: the changed submissions
+    """
+    path = f"/api/v1/courses/{assignment.course.id}/students/submissions"
+    params = {
+        "student_ids[]": "all",
+        "assignment_ids[]": assignment.id,
+        "include[]": ["submission_history", "submission_comments"],
+    }
+    changed = {}
+    for filter in ("submitted_since", "graded_since"):
+        # canvas-course-tools has no public method for this endpoint
+        for submission in canvas_tasks._get_paginated_list(
+            path, CanvasSubmission, params=params | {filter: since.isoformat()}
+        ):
+            changed[submission.student_id] = submission
+    return list(changed.values())
+
+
+class CanvasProgress(BaseModel):
+    """Progress of an asynchronous operation in Canvas."""
+
+    id: int
+    workflow_state: str
+    message: str | None = None
+
+
+def update_grade(
+    canvas_tasks: CanvasClient,
+    course_id: int,
+    assignment_id: int,
+    student_id: int,
+    grade: str | None,
+    comment: str,
+) -> None:
+    """Grade the submission of a single student and/or add a comment
+
+    Args:
+        canvas_tasks (CanvasClient): a CanvasClient instance
+        course_id (int): the id of the course
+        assignment_id (int): the id of the assignment
+        student_id (int): the id of the student
+        grade (str | None): the new grade, or None to keep the grade
+        comment (str): a comment to add, if not empty
+    """
+    path = (
+        f"/api/v1/courses/{course_id}/assignments/{assignment_id}"
+        f"/submissions/{student_id}"
+    )
+    data = {}
+    if grade is not None:
+        data["submission"] = {"posted_grade": grade}
+    if comment:
+        data["comment"] = {"text_comment": comment}
+    response = canvas_tasks.request("PUT", path, json=data)
+    canvas_tasks._handle_response_errors(response)
+
+
+def update_grades(
+    canvas_tasks: CanvasClient,
+    course_id: int,
+    assignment_id: int,
+    grade_data: dict[int, tuple[str | None, str]],
+) -> None:
+    """Grade submissions and add comments for many students at once
+
+    Canvas updates the grades in the background, so this waits until Canvas
+    reports that it is finished.
+
+    Args:
+        canvas_tasks (CanvasClient): a CanvasClient instance
+        course_id (int): the id of the course
+        assignment_id (int): the id of the assignment
+        grade_data (dict[int, tuple[str | None, str]]): the grade (or None to
+            keep the grade) and comment (or an empty string) per student id
+
+    Raises:
+        RuntimeError: when Canvas failed to update the grades.
+        TimeoutError: when Canvas did not finish in time.
+    """
+    path = (
+        f"/api/v1/courses/{course_id}/assignments/{assignment_id}"
+        "/submissions/update_grades"
+    )
+    data = {}
+    for student_id, (grade, comment) in grade_data.items():
+        data[str(student_id)] = {}
+        if grade is not None:
+            data[str(student_id)]["posted_grade"] = grade
+        if comment:
+            data[str(student_id)]["text_comment"] = comment
+    # canvas-course-tools has no public method for this endpoint
+    progress = canvas_tasks._post_object(
+        path, CanvasProgress, json={"grade_data": data}
+    )
+    deadline = time.monotonic() + PROGRESS_TIMEOUT
+    while progress.workflow_state in ("queued", "running"):
+        if time.monotonic() > deadline:
+            raise TimeoutError("Canvas did not finish updating the grades in time")
+        time.sleep(PROGRESS_INTERVAL)
+        progress = canvas_tasks._fetch_single_object(
+            f"/api/v1/progress/{progress.id}", CanvasProgress, None, None
+        )
+    if progress.workflow_state != "completed":
+        raise RuntimeError(progress.message or "Canvas failed to update the grades")
+
+
 def get_groupset_by_name(groupset_name, canvas, course):
-    groupsets = canvas.list_groupsets(course)
-    try:
-        groupset = next(g for g in groupsets if g.name == groupset_name)
-    except StopIteration:
-        raise RuntimeError(f"Group set {groupset_name} not found")
-    return groupset
+    key = (str(canvas), course.id, groupset_name)
+    if key not in _groupsets:
+        groupsets = canvas.list_groupsets(course)
+        try:
+            _groupsets[key] = next(g for g in groupsets if g.name == groupset_name)
+        except StopIteration:
+            raise RuntimeError(f"Group set {groupset_name} not found")
+    return _groupsets[key]
+
+
+def list_groups(canvas, groupset):
+    key = (str(canvas), groupset.id)
+    if key not in _groups:
+        _groups[key] = canvas.list_groups(groupset)
+    return _groups[key]
+
+
+def clear_group_lookups() -> None:
+    """Forget groupsets and groups, so that they are requested again."""
+    _groupsets.clear()
+    _groups.clear()
 
 
 def get_group_from_groupset_by_name(group_name, canvas, groupset):
-    groups = canvas.list_groups(groupset)
+    groups = list_groups(canvas, groupset)
     try:
         group = next(g for g in groups if g.name == group_name)
     except StopIteration:
@@ -0,0 +1,126 @@
+from pathlib import Path
+
+import click
+
+from ecpcgrading.profiling import STARTUP_BUDGET
+
+
+@click.group(invoke_without_command=True)
+@click.option(
+    "--profile-startup",
+    is_flag=True,
+    help="Report startup timings and exit, with exit code 1 if over budget.",
+)
+@click.option(
+    "--startup-budget",
+    type=float,
+    default=STARTUP_BUDGET,
+    show_default=True,
+    help="Maximum time in seconds until the first frame is shown.",
+)
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Export a Chrome trace of all operations to this file when finished.",
+)
+@click.pass_context
+def cli(
+    ctx: click.Context,
+    profile_startup: bool,
+    startup_budget: float,
+    trace: Path | None,
+) -> None:
+    """Grading tool for ECPC.
+
+    Without a command, the interactive grading tool is started. The commands
+    perform batch operations for all students without user interface,
+    printing progress as JSON lines. The exit code is 0 on success, 1 if the
+    operation failed for at least one student and 2 for configuration errors.
+    """
+    if trace is not None:
+        from ecpcgrading.instrumentation import recorder
+
+        ctx.call_on_close(lambda: recorder.export_trace(trace))
+    if ctx.invoked_subcommand is None:
+        # only import Textual when it is needed
+        if profile_startup:
+            from ecpcgrading.profiling import profile_startup
+
+            ctx.exit(0 if profile_startup(startup_budget) else 1)
+        else:
+            from ecpcgrading.tui import app
+
+            app()
+
+
+def assignment_options(f):
+    f = click.option(
+        "-a",
+        "--assignment",
+        "assignment_names",
+        multiple=True,
+        help="Name of the assignment (default: all assignments).",
+    )(f)
+    f = click.option(
+        "--refresh",
+        is_flag=True,
+        help="Refresh the cached course, assignments and students.",
+    )(f)
+    return f
+
+
+@cli.command()
+@assignment_options
+def sync(assignment_names: tuple[str, ...], refresh: bool) -> None:
+    """Download new and changed submissions."""
+    from ecpcgrading import batch
+
+    batch.run_stages("sync", ("download",), assignment_names, refresh)
+
+
+@cli.command()
+@assignment_options
+def extract(assignment_names: tuple[str, ...], refresh: bool) -> None:
+    """Extract downloaded submissions."""
+    from ecpcgrading import batch
+
+    batch.run_stages("extract", ("extract",), assignment_names, refresh)
+
+
+@cli.command()
+@assignment_options
+@click.option("-e", "--env", "env_name", help="Environment (default: the first).")
+def envs(assignment_names: tuple[str, ...], refresh: bool, env_name: str | None):
+    """Create virtual environments for extracted submissions."""
+    from ecpcgrading import batch
+
+    batch.run_stages("envs", ("env",), assignment_names, refresh, env_name)
+
+
+@cli.command()
+@assignment_options
+@click.option("-e", "--env", "env_name", help="Environment (default: the first).")
+def prepare(assignment_names: tuple[str, ...], refresh: bool, env_name: str | None):
+    """Download, extract and create environments in one go."""
+    from ecpcgrading import batch
+
+    batch.run_stages(
+        "prepare", ("download", "extract", "env"), assignment_names, refresh, env_name
+    )
+
+
+@cli.command()
+def push_grades() -> None:
+    """Send queued grades and comments to Canvas."""
+    from ecpcgrading import batch
+
+    batch.push_grades()
+
+
+@cli.command()
+@assignment_options
+def status(assignment_names: tuple[str, ...], refresh: bool) -> None:
+    """Show the status of all students."""
+    from ecpcgrading import batch
+
+    batch.show_status(assignment_names, refresh)
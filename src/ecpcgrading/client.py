@@ -0,0 +1,294 @@
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Iterator, Type, TypeVar
+
+import httpx
+import requests
+from canvas_course_tools.canvas_tasks import CanvasTasks, IncorrectURL
+from pydantic import BaseModel
+
+from ecpcgrading.config import CANVAS_POOL_SIZE, MAX_RETRIES
+from ecpcgrading.downloads import create_session
+from ecpcgrading.instrumentation import measure
+
+T = TypeVar("T")
+T_BaseModel = TypeVar("T_BaseModel", bound=BaseModel)
+
+TIMEOUT = httpx.Timeout(120, connect=10)
+# Canvas refills its request bucket to 700; below this, slow down
+RATE_LIMIT_LOW_WATER = 200
+BACKOFF_BASE = 0.5
+MAX_BACKOFF = 30
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# requests which may be sent again after a server error; PUT is left out since
+# grading a submission with a PUT also adds a comment, which would be doubled
+IDEMPOTENT_METHODS = {"GET", "HEAD", "DELETE"}
+
+
+class ConcurrencyLimiter:
+    """Limit the number of concurrent requests, adapting to the rate limit.
+
+    Canvas reports the remaining quota of its request bucket in the
+    X-Rate-Limit-Remaining header. When it runs low, or requests are
+    throttled, the number of concurrent requests is halved. While there is
+    enough quota left, it grows back to the maximum one request at a time.
+    """
+
+    def __init__(self, max_concurrency: int) -> None:
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self._active = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Wait until a request may be sent."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify()
+
+    def update(self, remaining: str | None) -> None:
+        """Adapt the concurrency to the X-Rate-Limit-Remaining header."""
+        if remaining is None:
+            return
+        if float(remaining) < RATE_LIMIT_LOW_WATER:
+            self.throttle()
+        else:
+            with self._condition:
+                if self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._condition.notify()
+
+    def throttle(self) -> None:
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+
+
+class CanvasClient(CanvasTasks):
+    """CanvasTasks sharing one connection pool for all requests.
+
+    Requests are throttled using the Canvas rate limit headers, retried with
+    jittered exponential backoff and identical GET requests which are in
+    flight at the same time are sent only once.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: str,
+        pool_size: int = CANVAS_POOL_SIZE,
+        max_retries: int = MAX_RETRIES,
+    ) -> None:
+        super().__init__(url, token)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self._client = httpx.Client(
+            base_url=url,
+            headers=self._headers,
+            timeout=TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+        )
+        self._limiter = ConcurrencyLimiter(pool_size)
+        self._in_flight: dict[str, Future] = {}
+        self._in_flight_lock = threading.Lock()
+        self._session: requests.Session | None = None
+
+    def __repr__(self) -> str:
+        return f"CanvasClient({self._url})"
+
+    @property
+    def session(self) -> requests.Session:
+        """A shared HTTP session for downloading attachments."""
+        if self._session is None:
+            self._session = create_session(self.pool_size, self.max_retries)
+        return self._session
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request, retrying when throttled or on server errors.
+
+        Requests which are not idempotent are only retried if they were not
+        processed by the server.
+
+        Args:
+            method (str): the HTTP method.
+            url (str): the API path or URL.
+            **kwargs: passed on to httpx.Client.request.
+
+        Returns:
+            httpx.Response: the last response, which may be an error.
+        """
+        for attempt in range(self.max_retries + 1):
+            response = error = None
+            with (
+                self._limiter.slot(),
+                measure(f"{method} {get_endpoint(url)}", "canvas") as span,
+            ):
+                try:
+                    response = self._client.request(method, url, **kwargs)
+                except (httpx.ConnectError, httpx.TimeoutException) as exc:
+                    error = exc
+                    span.error = True
+                else:
+                    span.bytes = len(response.content)
+                    span.error = response.is_error
+                    span.args |= {"status": response.status_code, "attempt": attempt}
+            if response is not None:
+                self._limiter.update(response.headers.get("X-Rate-Limit-Remaining"))
+                if is_throttled(response):
+                    self._limiter.throttle()
+                elif not (
+                    method in IDEMPOTENT_METHODS
+                    and response.status_code in RETRY_STATUS_CODES
+                ):
+                    return response
+            elif method not in IDEMPOTENT_METHODS and not isinstance(
+                error, httpx.ConnectError
+            ):
+                break
+            if attempt < self.max_retries:
+                time.sleep(get_backoff(attempt, response))
+        if response is None:
+            raise IncorrectURL(
+                f"Cannot connect to Canvas server at {self._url}: {error}"
+            ) from error
+        return response
+
+    def _coalesce(self, key: str, func: Callable[..., T], *args) -> T:
+        """Call func, or wait for the result of an identical call in flight."""
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._in_flight[key] = Future()
+        if not is_owner:
+            return future.result()
+        try:
+            result = func(*args)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def _get_single_object(
+        self,
+        path: str,
+        model: Type[T_BaseModel],
+        params: dict | None = None,
+        context: dict | None = None,
+    ) -> T_BaseModel:
+        key = repr(("single", path, model.__name__, params, context))
+        return self._coalesce(
+            key, self._fetch_single_object, path, model, params, context
+        )
+
+    def _fetch_single_object(
+        self,
+        path: str,
+        model: Type[T_BaseModel],
+        params: dict | None,
+        context: dict | None,
+    ) -> T_BaseModel:
+        response = self.request("GET", path, params=params)
+        self._handle_response_errors(response)
+        return model.model_validate(response.json(), context=context)
+
+    def _get_paginated_list(
+        self,
+        path: str,
+        model: Type[T_BaseModel],
+        params: dict | None = None,
+        context: dict | None = None,
+    ) -> list[T_BaseModel]:
+        key = repr(("list", path, model.__name__, params, context))
+        return self._coalesce(
+            key, self._fetch_paginated_list, path, model, params, context
+        )
+
+    def _fetch_paginated_list(
+        self,
+        path: str,
+        model: Type[T_BaseModel],
+        params: dict | None,
+        context: dict | None,
+    ) -> list[T_BaseModel]:
+        items = []
+        url = path
+        request_params = (params or {}) | {"per_page": 100}
+        while url:
+            response = self.request("GET", url, params=request_params)
+            self._handle_response_errors(response)
+            items.extend(
+                model.model_validate(item, context=context) for item in response.json()
+            )
+            url = response.links.get("next", {}).get("url")
+            # the next URL already contains the parameters
+            request_params = None
+        return items
+
+    def _post_object(
+        self,
+        path: str,
+        model: Type[T_BaseModel],
+        json: dict | None = None,
+        context: dict | None = None,
+    ) -> T_BaseModel:
+        response = self.request("POST", path, json=json)
+        self._handle_response_errors(response)
+        return model.model_validate(response.json(), context=context)
+
+    def _post_no_response(self, path: str, json: dict | None = None) -> None:
+        response = self.request("POST", path, json=json)
+        self._handle_response_errors(response)
+
+    def _delete_object(self, path: str) -> None:
+        response = self.request("DELETE", path)
+        self._handle_response_errors(response)
+
+
+def get_endpoint(url: str) -> str:
+    """Get the path of an API URL with ids replaced, for grouping requests."""
+    return re.sub(r"/\d+(?=/|$)", "/:id", httpx.URL(url).path)
+
+
+def is_throttled(response: httpx.Response) -> bool:
+    """Check whether Canvas refused a request because of its rate limit."""
+    return response.status_code == 429 or (
+        response.status_code == 403 and "Rate Limit Exceeded" in response.text
+    )
+
+
+def get_backoff(attempt: int, response: httpx.Response | None) -> float:
+    """Get the time to wait before retrying a request.
+
+    Args:
+        attempt (int): the number of the failed attempt, starting at 0.
+        response (httpx.Response | None): the failed response, if any.
+
+    Returns:
+        float: the Retry-After time if given, or an exponential backoff with
+        jitter, so that parallel requests do not retry at the same time.
+    """
+    if response is not None and (retry_after := response.headers.get("Retry-After")):
+        try:
+            return min(float(retry_after), MAX_BACKOFF)
+        except ValueError:
+            pass
+    backoff = min(BACKOFF_BASE * 2**attempt, MAX_BACKOFF)
+    return backoff / 2 + random.uniform(0, backoff / 2)
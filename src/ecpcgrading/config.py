@@ -7,6 +7,31 @@ from pathlib import Path
 
 from pydantic import BaseModel
 
+CANVAS_POOL_SIZE = 8
+CACHE_TTL = 60 * 60
+ENV_WORKERS = 4
+REFRESH_INTERVAL = 60
+SUBMISSION_STORE_SIZE = 32
+MAX_RETRIES = 5
+# number of students prepared ahead while grading, when look-ahead is enabled
+LOOK_AHEAD = 3
+# how often grades which were not yet sent to Canvas are sent
+GRADE_FLUSH_INTERVAL = 30
+# limits on the contents of submitted zip files
+MAX_EXTRACT_SIZE = 500 * 1024 * 1024
+MAX_EXTRACT_FILES = 10_000
+EXTRACT_EXCLUDE = [
+    ".venv",
+    "venv",
+    "__pycache__",
+    "*.pyc",
+    ".pytest_cache",
+    ".mypy_cache",
+    "node_modules",
+    "__MACOSX",
+    ".DS_Store",
+]
+
 
 class EnvironmentConfig(BaseModel):
     name: str
@@ -25,6 +50,20 @@ class Config(BaseModel):
     group: str | None = None
     env: dict[str, EnvironmentConfig]
     theme: str = "textual-dark"
+    pool_size: int = CANVAS_POOL_SIZE
+    max_retries: int = MAX_RETRIES
+    cache_ttl: float = CACHE_TTL
+    uv_cache_dir: Path | None = None
+    extract_workers: int | None = None
+    env_workers: int = ENV_WORKERS
+    refresh_interval: float = REFRESH_INTERVAL
+    prefetch_submissions: bool = True
+    submission_store_size: int = SUBMISSION_STORE_SIZE
+    max_extract_size: int = MAX_EXTRACT_SIZE
+    max_extract_files: int = MAX_EXTRACT_FILES
+    extract_exclude: list[str] = EXTRACT_EXCLUDE
+    look_ahead: int = LOOK_AHEAD
+    grade_flush_interval: float = GRADE_FLUSH_INTERVAL
 
 
 def read_config(folder: Path):
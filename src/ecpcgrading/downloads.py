@@ -0,0 +1,439 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator
+from zipfile import ZipFile, ZipInfo
+
+import requests
+from canvas_course_tools.datatypes import CanvasAttachment, CanvasSubmission
+from canvas_course_tools.datatypes import Student as CanvasStudent
+from pydantic import AwareDatetime, BaseModel, PrivateAttr
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from ecpcgrading.config import MAX_RETRIES
+from ecpcgrading.index import get_slug
+from ecpcgrading.instrumentation import measure
+
+CHUNK_SIZE = 1024 * 1024
+# connect and read timeouts
+DOWNLOAD_TIMEOUT = (10, 60)
+MANIFEST_VERSION = 1
+
+_manifests: dict[Path, "Manifest"] = {}
+_manifests_lock = threading.Lock()
+
+
+class AttachmentRecord(BaseModel):
+    id: int
+    filename: str
+    size: int
+    sha256: str = ""
+
+
+class ManifestEntry(BaseModel):
+    attempt: int
+    submitted_at: AwareDatetime | None
+    filename: str
+    size: int
+    sha256: str = ""
+    attachments: list[AttachmentRecord]
+
+
+class Manifest(BaseModel):
+    """Record of the submissions which are stored on disk for an assignment.
+
+    The manifest is used to skip downloading submissions when the student did
+    not resubmit since the last download.
+    """
+
+    version: int = MANIFEST_VERSION
+    entries: dict[int, ManifestEntry] = {}
+
+    _path: Path = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def load(cls, path: Path) -> "Manifest":
+        """Load a manifest from disk, or start a new one.
+
+        An unreadable manifest or one with a different version is discarded,
+        which means that all submissions will be downloaded again.
+        """
+        try:
+            manifest = cls.model_validate_json(path.read_bytes())
+        except (FileNotFoundError, ValueError):
+            manifest = cls()
+        if manifest.version != MANIFEST_VERSION:
+            manifest = cls()
+        manifest._path = path
+        return manifest
+
+    def save(self) -> None:
+        Path.mkdir(self._path.parent, parents=True, exist_ok=True)
+        with self._lock, atomic_write(self._path) as f:
+            f.write(self.model_dump_json(indent=2).encode())
+
+    def is_current(
+        self,
+        submissions_dir: Path,
+        student: CanvasStudent,
+        submission: CanvasSubmission,
+    ) -> bool:
+        """Check whether the submission on disk matches the Canvas submission."""
+        with self._lock:
+            entry = self.entries.get(student.id)
+        if entry is None:
+            return False
+        path = submissions_dir / entry.filename
+        return (
+            entry.attempt == submission.attempt
+            and entry.submitted_at == submission.submitted_at
+            and [a.id for a in entry.attachments]
+            == [a.id for a in submission.attachments]
+            and path.is_file()
+            and path.stat().st_size == entry.size
+        )
+
+    def record(
+        self,
+        student: CanvasStudent,
+        submission: CanvasSubmission,
+        path: Path,
+        sha256: str,
+        blobs: list[tuple[str, int]],
+    ) -> None:
+        """Record a downloaded submission, removing an outdated submission file.
+
+        Args:
+            student (CanvasStudent): the student who submitted.
+            submission (CanvasSubmission): the submission of the student.
+            path (Path): the path of the submission file.
+            sha256 (str): the digest of the submission file.
+            blobs (list[tuple[str, int]]): the digest and size of each
+                attachment.
+        """
+        entry = ManifestEntry(
+            attempt=submission.attempt,
+            submitted_at=submission.submitted_at,
+            filename=path.name,
+            size=path.stat().st_size,
+            sha256=sha256,
+            attachments=[
+                AttachmentRecord(id=a.id, filename=a.filename, size=size, sha256=digest)
+                for a, (digest, size) in zip(submission.attachments, blobs)
+            ],
+        )
+        with self._lock:
+            previous = self.entries.get(student.id)
+            self.entries[student.id] = entry
+        if previous is not None and previous.filename != entry.filename:
+            (path.parent / previous.filename).unlink(missing_ok=True)
+
+
+def get_shared_manifest(path: Path) -> Manifest:
+    """Get the manifest at a path, shared by all threads of this process.
+
+    Jobs which download submissions of the same assignment at the same time
+    must record them in the same manifest, or one would overwrite the other.
+    """
+    with _manifests_lock:
+        if (manifest := _manifests.get(path)) is None:
+            manifest = _manifests[path] = Manifest.load(path)
+    return manifest
+
+
+class BlobStore:
+    """Content-addressed store of downloaded attachments.
+
+    Attachments are hashed while they are downloaded and stored only once,
+    under their SHA-256 digest. The digest of every downloaded attachment is
+    recorded, so that an attachment is never downloaded twice. Submission
+    files are hardlinks to the blobs, or copies if the file system does not
+    support hardlinks.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def get_blob_path(self, digest: str) -> Path:
+        return self.path / digest[:2] / digest
+
+    def get_digest(self, attachment: CanvasAttachment) -> str | None:
+        """Get the digest of an attachment which is in the store."""
+        try:
+            digest = (self.path / "attachments" / str(attachment.id)).read_text()
+        except FileNotFoundError:
+            return None
+        return digest if self.get_blob_path(digest).is_file() else None
+
+    def fetch(
+        self, session: requests.Session, attachment: CanvasAttachment
+    ) -> tuple[str, int]:
+        """Get an attachment from the store, downloading it if necessary.
+
+        Returns:
+            tuple[str, int]: the digest and the size of the attachment.
+        """
+        if (digest := self.get_digest(attachment)) is None:
+            Path.mkdir(self.path / "attachments", parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    hasher = HashingWriter(f)
+                    stream_attachment(session, attachment, hasher)
+                digest = hasher.hexdigest()
+                blob_path = self.get_blob_path(digest)
+                Path.mkdir(blob_path.parent, exist_ok=True)
+                if blob_path.is_file():
+                    # identical content was downloaded before
+                    os.unlink(tmp_path)
+                else:
+                    os.replace(tmp_path, blob_path)
+            except BaseException:
+                Path(tmp_path).unlink(missing_ok=True)
+                raise
+            with atomic_write(self.path / "attachments" / str(attachment.id)) as f:
+                f.write(digest.encode())
+        return digest, self.get_blob_path(digest).stat().st_size
+
+    def link(self, digest: str, path: Path) -> None:
+        """Make path a hardlink to a blob, or a copy if linking fails."""
+        blob_path = self.get_blob_path(digest)
+        if path.is_file() and os.path.samefile(path, blob_path):
+            return
+        tmp_path = path.with_name(
+            f".{path.name}.{os.getpid()}-{threading.get_ident()}.part"
+        )
+        tmp_path.unlink(missing_ok=True)
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            shutil.copyfile(blob_path, tmp_path)
+        os.replace(tmp_path, path)
+
+
+class HashingWriter:
+    """Binary file wrapper which computes the SHA-256 digest of the writes."""
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        self._hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def create_session(pool_size: int, max_retries: int = MAX_RETRIES) -> requests.Session:
+    """Create a HTTP session with a connection pool.
+
+    Failed connections and server errors are retried with exponential backoff,
+    honouring the Retry-After header.
+
+    Args:
+        pool_size (int): the maximum number of connections kept open per host.
+        max_retries (int): the maximum number of retries per request.
+
+    Returns:
+        requests.Session: a session which reuses connections.
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=max_retries,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_submission(
+    session: requests.Session,
+    submissions_dir: Path,
+    blob_store: BlobStore,
+    student: CanvasStudent,
+    submission: CanvasSubmission,
+    manifest: Manifest | None = None,
+) -> Path:
+    """Download a student submission into the submissions directory.
+
+    A single attachment is stored as-is, multiple attachments are zipped.
+    Attachments are streamed into the blob store, unless they were downloaded
+    before, and the submission file only appears in the submissions directory
+    once it is complete. If a manifest is given, the download is recorded in
+    it.
+
+    Args:
+        session (requests.Session): the HTTP session used for downloading.
+        submissions_dir (Path): the directory in which to store the submission.
+        blob_store (BlobStore): the store of downloaded attachments.
+        student (CanvasStudent): the student who submitted.
+        submission (CanvasSubmission): the submission of the student.
+        manifest (Manifest | None): the manifest of downloaded submissions.
+
+    Returns:
+        Path: the path of the downloaded submission file.
+    """
+    if submission.attempt is None:
+        raise RuntimeError("Student did not yet submit this assignment")
+
+    student_name = get_slug(student.name)
+    Path.mkdir(submissions_dir, parents=True, exist_ok=True)
+    blobs = [blob_store.fetch(session, a) for a in submission.attachments]
+    match submission.attachments:
+        case [CanvasAttachment() as attachment]:
+            submission_path = submissions_dir / f"{student_name}_{attachment.filename}"
+            sha256 = blobs[0][0]
+            blob_store.link(sha256, submission_path)
+        case [*attachments]:
+            submission_path = submissions_dir / (student_name + "_zipped.zip")
+            with atomic_write(submission_path) as f, ZipFile(f, mode="w") as zipfile:
+                for attachment, (digest, _) in zip(attachments, blobs):
+                    zipinfo = ZipInfo(
+                        attachment.filename, date_time=time.localtime()[:6]
+                    )
+                    with (
+                        open(blob_store.get_blob_path(digest), "rb") as blob,
+                        zipfile.open(zipinfo, mode="w", force_zip64=True) as member,
+                    ):
+                        shutil.copyfileobj(blob, member, CHUNK_SIZE)
+            sha256 = hash_file(submission_path)
+    if manifest is not None:
+        manifest.record(student, submission, submission_path, sha256, blobs)
+    return submission_path
+
+
+def ignore_progress(student: CanvasStudent, state: str) -> None:
+    pass
+
+
+def download_all(
+    session: requests.Session,
+    submissions_dir: Path,
+    blob_store: BlobStore,
+    submissions: list[tuple[CanvasStudent, CanvasSubmission]],
+    pool_size: int,
+    callback: Callable[[CanvasStudent, str], None] | None = None,
+    manifest: Manifest | None = None,
+) -> dict[int, Path | Exception]:
+    """Download many submissions in parallel.
+
+    If a manifest is given, submissions which are already on disk and were
+    not changed since are skipped, and the manifest is saved afterwards.
+
+    Args:
+        session (requests.Session): the HTTP session, e.g. the shared session
+            of the Canvas client.
+        submissions_dir (Path): the directory in which to store the submissions.
+        blob_store (BlobStore): the store of downloaded attachments.
+        submissions (list[tuple[CanvasStudent, CanvasSubmission]]): the students
+            and their submissions.
+        pool_size (int): the number of parallel downloads.
+        callback (Callable[[CanvasStudent, str], None] | None): called with
+            the student and one of "queued", "downloading", "done", "skipped"
+            or "failed" whenever the progress of a download changes.
+        manifest (Manifest | None): the manifest of downloaded submissions.
+
+    Returns:
+        dict[int, Path | Exception]: the downloaded path or the error, keyed by
+        student id.
+    """
+    if callback is None:
+        callback = ignore_progress
+
+    def download(student, submission):
+        if manifest is not None and manifest.is_current(
+            submissions_dir, student, submission
+        ):
+            path = submissions_dir / manifest.entries[student.id].filename
+            return path, "skipped"
+        callback(student, "downloading")
+        path = download_submission(
+            session, submissions_dir, blob_store, student, submission, manifest
+        )
+        return path, "done"
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=pool_size) as executor:
+        futures = {}
+        for student, submission in submissions:
+            callback(student, "queued")
+            futures[executor.submit(download, student, submission)] = student
+        for future in as_completed(futures):
+            student = futures[future]
+            try:
+                results[student.id], state = future.result()
+            except Exception as exc:
+                results[student.id] = exc
+                callback(student, "failed")
+            else:
+                callback(student, state)
+    if manifest is not None:
+        manifest.save()
+    return results
+
+
+def stream_attachment(
+    session: requests.Session, attachment: CanvasAttachment, f: BinaryIO
+) -> int:
+    """Download an attachment in chunks and write it to a file object.
+
+    Returns:
+        int: the number of bytes written.
+    """
+    with (
+        measure(
+            "download attachment", "download", filename=attachment.filename
+        ) as span,
+        session.get(attachment.url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response,
+    ):
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            span.bytes += f.write(chunk)
+    return span.bytes
+
+
+@contextmanager
+def atomic_write(path: Path) -> Iterator[BinaryIO]:
+    """Write to a temporary file which replaces path when finished.
+
+    The temporary file is hidden and lives in the same directory as path, so
+    that the final rename is atomic. If writing fails, the temporary file is
+    removed and path is left untouched.
+
+    Args:
+        path (Path): the path of the file to write.
+
+    Yields:
+        BinaryIO: the temporary file object.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".part"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,342 @@
+import hashlib
+import os
+import shlex
+import subprocess
+import threading
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from ecpcgrading.config import EnvironmentConfig
+from ecpcgrading.downloads import hash_file
+from ecpcgrading.errors import TaskError
+from ecpcgrading.instrumentation import measure
+
+# files which determine the contents of a virtual environment
+DEPENDENCY_FILES = (
+    "pyproject.toml",
+    "uv.lock",
+    "poetry.lock",
+    "requirements.txt",
+    ".python-version",
+)
+# stored inside .venv, so that it is removed together with the environment
+FINGERPRINT_PATH = Path(".venv") / "ecpcgrading-fingerprint.json"
+
+# options of uv pip install which select the package index and take a value
+INDEX_OPTIONS = {
+    "-i",
+    "--index-url",
+    "--extra-index-url",
+    "--index",
+    "--default-index",
+    "-f",
+    "--find-links",
+    "--index-strategy",
+}
+# other options which take a value
+VALUE_OPTIONS = {
+    "-e",
+    "--editable",
+    "-r",
+    "--requirement",
+    "-c",
+    "--constraint",
+    "--override",
+    "-C",
+    "--config-setting",
+    "--keyring-provider",
+    "--resolution",
+    "--prerelease",
+}
+
+_template_locks: dict[Path, threading.Lock] = {}
+_template_locks_lock = threading.Lock()
+
+
+def get_python_version(env: EnvironmentConfig, code_dir: Path) -> str | None:
+    """Get the Python version for an environment.
+
+    Args:
+        env (EnvironmentConfig): the environment configuration.
+        code_dir (Path): the code directory of the student.
+
+    Returns:
+        str | None: the configured Python version or, if that is "*", the
+        version from the student's .python-version file. None if there is no
+        such file.
+    """
+    if env.python_version != "*":
+        return env.python_version
+    if (p := (code_dir / ".python-version")).is_file():
+        return p.open().readline().rstrip("\n")
+    return None
+
+
+def split_package_spec(package_spec: str) -> tuple[list[str], list[str], list[str]]:
+    """Split a package spec into shared and student-specific requirements.
+
+    Requirements which refer to local paths (e.g. "-e ." to install the
+    student's project) and other options depend on the student's code and can
+    not be resolved ahead of time. Options which select the package index are
+    needed both to resolve the shared requirements and to install them. An
+    option which takes a value is kept together with its value.
+
+    Args:
+        package_spec (str): the package spec, as passed to uv pip install.
+
+    Returns:
+        tuple[list[str], list[str], list[str]]: the shared requirements, the
+        index options and the student-specific arguments.
+    """
+    shared, index_options, local = [], [], []
+    tokens = iter(shlex.split(package_spec))
+    for token in tokens:
+        option = token.partition("=")[0]
+        if option in INDEX_OPTIONS or option in VALUE_OPTIONS:
+            args = [token] if "=" in token else [token, next(tokens, "")]
+            (index_options if option in INDEX_OPTIONS else local).extend(args)
+        elif token.startswith(("-", ".", "/", "~")) or (
+            os.sep in token and "://" not in token
+        ):
+            local.append(token)
+        else:
+            shared.append(token)
+    return shared, index_options, local
+
+
+def prepare_template(
+    templates_dir: Path,
+    python_version: str,
+    requirements: list[str],
+    uv_cache_dir: Path | None = None,
+    index_options: list[str] | None = None,
+) -> Path:
+    """Prepare a template environment and return its lockfile.
+
+    The requirements are resolved once for each combination of Python version
+    and requirements, and pinned in a lockfile. Installing them into the
+    template environment fills the uv cache, so that student environments are
+    created from the cache without resolving or downloading anything.
+
+    Args:
+        templates_dir (Path): the directory containing the templates of an
+            assignment.
+        python_version (str): the Python version of the environment.
+        requirements (list[str]): the requirements to install.
+        uv_cache_dir (Path | None): the uv cache directory, or None to use the
+            default cache.
+        index_options (list[str] | None): the options which select the
+            package index.
+
+    Returns:
+        Path: the path of the lockfile.
+    """
+    index_options = index_options or []
+    key = hashlib.sha256(
+        "\n".join([python_version, *index_options, *requirements]).encode()
+    )
+    template_dir = templates_dir / f"{python_version}-{key.hexdigest()[:12]}"
+    lockfile = template_dir / "requirements.lock"
+    with _template_locks_lock:
+        lock = _template_locks.setdefault(template_dir, threading.Lock())
+    with lock:
+        if not lockfile.exists():
+            Path.mkdir(template_dir, parents=True, exist_ok=True)
+            (template_dir / "requirements.in").write_text("\n".join(requirements))
+            run_uv(["venv", "--python", python_version, "--clear"], template_dir)
+            run_uv(
+                [
+                    "pip",
+                    "compile",
+                    *index_options,
+                    "requirements.in",
+                    "-o",
+                    "requirements.lock.tmp",
+                ],
+                template_dir,
+                uv_cache_dir,
+            )
+            run_uv(
+                ["pip", "sync", *index_options, "requirements.lock.tmp"],
+                template_dir,
+                uv_cache_dir,
+            )
+            os.replace(template_dir / "requirements.lock.tmp", lockfile)
+    return lockfile
+
+
+def create_env(
+    code_dir: Path,
+    python_version: str,
+    package_spec: str,
+    templates_dir: Path,
+    uv_cache_dir: Path | None = None,
+) -> str:
+    """Create a clean virtual environment in a student's code directory.
+
+    Shared requirements are installed from the pinned lockfile of a template
+    environment, student-specific requirements are installed afterwards.
+
+    Args:
+        code_dir (Path): the code directory of the student.
+        python_version (str): the Python version of the environment.
+        package_spec (str): the packages to install, as passed to uv pip
+            install.
+        templates_dir (Path): the directory containing the templates of an
+            assignment.
+        uv_cache_dir (Path | None): the uv cache directory, or None to use the
+            default cache.
+
+    Returns:
+        str: the output of uv.
+    """
+    shared, index_options, local = split_package_spec(package_spec)
+    output = run_uv(["venv", "--python", python_version, "--clear"], code_dir)
+    if shared:
+        lockfile = prepare_template(
+            templates_dir, python_version, shared, uv_cache_dir, index_options
+        )
+        output += run_uv(
+            ["pip", "sync", *index_options, lockfile], code_dir, uv_cache_dir
+        )
+    if local:
+        output += run_uv(
+            ["pip", "install", *index_options, *local], code_dir, uv_cache_dir
+        )
+    return output
+
+
+class EnvFingerprint(BaseModel):
+    """The inputs from which a student environment was created.
+
+    Attributes:
+        python_version (str): the Python version.
+        package_spec (str): the configured package spec.
+        lockfile (str): the digest of the lockfile of the shared
+            requirements, or an empty string if there are none.
+        dependencies (dict[str, str]): the digests of the dependency files in
+            the code directory.
+    """
+
+    python_version: str
+    package_spec: str
+    lockfile: str
+    dependencies: dict[str, str]
+
+    @classmethod
+    def load(cls, code_dir: Path) -> "EnvFingerprint | None":
+        try:
+            return cls.model_validate_json((code_dir / FINGERPRINT_PATH).read_bytes())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, code_dir: Path) -> None:
+        (code_dir / FINGERPRINT_PATH).write_text(self.model_dump_json(indent=2))
+
+
+def get_dependency_digests(code_dir: Path) -> dict[str, str]:
+    return {
+        name: hash_file(code_dir / name)
+        for name in DEPENDENCY_FILES
+        if (code_dir / name).is_file()
+    }
+
+
+def ensure_env(
+    code_dir: Path,
+    python_version: str,
+    package_spec: str,
+    templates_dir: Path,
+    uv_cache_dir: Path | None = None,
+) -> tuple[str, str]:
+    """Make sure that a student's code directory has an up-to-date environment.
+
+    A fingerprint of the Python version, the package spec, the pinned shared
+    requirements and the student's dependency files is stored in the
+    environment. Nothing is done when the fingerprint did not change. If only
+    the packages changed, the existing environment is synced incrementally.
+    Otherwise, a clean environment is created.
+
+    Args:
+        code_dir (Path): the code directory of the student.
+        python_version (str): the Python version of the environment.
+        package_spec (str): the packages to install, as passed to uv pip
+            install.
+        templates_dir (Path): the directory containing the templates of an
+            assignment.
+        uv_cache_dir (Path | None): the uv cache directory, or None to use the
+            default cache.
+
+    Returns:
+        tuple[str, str]: a message describing what was done and the output of
+        uv.
+    """
+    shared, index_options, local = split_package_spec(package_spec)
+    lockfile = (
+        prepare_template(
+            templates_dir, python_version, shared, uv_cache_dir, index_options
+        )
+        if shared
+        else None
+    )
+    fingerprint = EnvFingerprint(
+        python_version=python_version,
+        package_spec=package_spec,
+        lockfile=hash_file(lockfile) if lockfile is not None else "",
+        dependencies=get_dependency_digests(code_dir),
+    )
+    previous = EnvFingerprint.load(code_dir)
+    if previous == fingerprint:
+        return f"Environment is up to date ({python_version})", ""
+    # the fingerprint is only valid once the environment is up to date
+    (code_dir / FINGERPRINT_PATH).unlink(missing_ok=True)
+    if (
+        previous is not None
+        and previous.python_version == python_version
+        and lockfile is not None
+    ):
+        # uninstalls packages which are no longer required, including
+        # student-specific ones, which are installed again afterwards
+        output = run_uv(
+            ["pip", "sync", *index_options, lockfile], code_dir, uv_cache_dir
+        )
+        if local:
+            output += run_uv(
+                ["pip", "install", *index_options, *local], code_dir, uv_cache_dir
+            )
+        msg = f"Updated environment ({python_version})"
+    else:
+        output = create_env(
+            code_dir, python_version, package_spec, templates_dir, uv_cache_dir
+        )
+        msg = f"Created clean environment ({python_version})"
+    fingerprint.save(code_dir)
+    return msg, output
+
+
+def run_uv(args: list, cwd: Path, uv_cache_dir: Path | None = None) -> str:
+    """Run uv in a directory and return its output, raising a TaskError if it fails."""
+    env = os.environ | {
+        # make sure the .venv environment is used for installing packages
+        # even when another virtual environment is activated
+        "VIRTUAL_ENV": "./.venv"
+    }
+    if uv_cache_dir is not None:
+        env["UV_CACHE_DIR"] = str(uv_cache_dir)
+    # e.g. "uv pip sync", leaving out options and paths
+    command = " ".join(["uv", *[a for a in args[:2] if not str(a).startswith("-")]])
+    with measure(command, "uv", cwd=str(cwd)):
+        process = subprocess.run(
+            ["uv", *args],
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+        output = process.stdout.decode()
+        if process.returncode:
+            raise TaskError(
+                f"Process exited with exit code: {process.returncode}", details=output
+            )
+    return output
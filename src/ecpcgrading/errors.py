@@ -0,0 +1,7 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class TaskError(Exception):
+    msg: str
+    details: str
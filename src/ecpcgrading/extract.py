@@ -0,0 +1,644 @@
+import fnmatch
+import multiprocessing
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import redirect_stderr
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+from zipfile import ZipFile, ZipInfo
+
+import humanize
+from canvas_course_tools.datatypes import Student as CanvasStudent
+from pydantic import BaseModel
+
+from ecpcgrading.config import (
+    EXTRACT_EXCLUDE,
+    MAX_EXTRACT_FILES,
+    MAX_EXTRACT_SIZE,
+    Config,
+)
+from ecpcgrading.downloads import atomic_write, hash_file
+from ecpcgrading.environments import get_dependency_digests
+from ecpcgrading.errors import TaskError
+from ecpcgrading.index import SubmissionIndex, get_project_dir, get_slug
+from ecpcgrading.instrumentation import call_recorded, measure, recorder
+
+# number of files or folders listed when a zip file exceeds the limits
+MAX_DETAILS = 20
+
+_object_store_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ZipLimits:
+    """Limits on the contents of a submitted zip file.
+
+    Attributes:
+        max_size (int): the maximum total uncompressed size in bytes.
+        max_files (int): the maximum number of files.
+        exclude (tuple[str, ...]): glob patterns of files and directories
+            which are not extracted, matched against every path component.
+    """
+
+    max_size: int = MAX_EXTRACT_SIZE
+    max_files: int = MAX_EXTRACT_FILES
+    exclude: tuple[str, ...] = tuple(EXTRACT_EXCLUDE)
+
+    @classmethod
+    def from_config(cls, config: Config) -> "ZipLimits":
+        return cls(
+            config.max_extract_size,
+            config.max_extract_files,
+            tuple(config.extract_exclude),
+        )
+
+    def is_excluded(self, filename: str) -> bool:
+        return any(
+            fnmatch.fnmatchcase(part, pattern)
+            for part in filename.split("/")
+            for pattern in self.exclude
+        )
+
+
+def extract_submission(
+    path: Path,
+    code_dir: Path,
+    student_name: str,
+    object_store: Path,
+    limits: ZipLimits | None = None,
+) -> str:
+    """Extract a submission file into a code directory.
+
+    Zip files are extracted, git bundles are checked out and all other files
+    are copied as-is. What was extracted is recorded next to the code
+    directory, together with the digest of the submission file. Extracting
+    the same submission again is skipped. When the submission changed, only
+    the changed files are updated, leaving other files like a virtual
+    environment in place. The virtual environment is removed if the
+    dependency files (e.g. pyproject.toml) changed. A code directory which
+    was not extracted by this function is removed first.
+
+    Zip files are scanned before anything is extracted and are rejected if
+    they exceed the limits or contain unsafe paths. Excluded files (e.g. a
+    submitted virtual environment) are skipped.
+
+    Args:
+        path (Path): the path of the submission file.
+        code_dir (Path): the code directory of the student.
+        student_name (str): the slugified name of the student.
+        object_store (Path): the git repository in which the objects of all
+            submitted bundles are stored.
+        limits (ZipLimits | None): the limits on the contents of zip files,
+            defaults to ZipLimits().
+
+    Returns:
+        str: a message describing what was extracted.
+    """
+    kind = {".zip": "zip", ".bundle": "bundle"}.get(path.suffix, "file")
+    with measure(f"extract {kind}", "extract", student=student_name) as span:
+        stat_result = path.stat()
+        span.bytes = stat_result.st_size
+        record_path = get_extraction_record_path(code_dir)
+        record = ExtractionRecord.load(record_path)
+        if record is not None and not record.is_outdated(path):
+            sha256 = record.sha256
+        else:
+            sha256 = hash_file(path)
+        if (
+            record is not None
+            and record.kind == kind
+            and record.sha256 == sha256
+            and is_extracted(path, code_dir, record)
+        ):
+            return "Submission was already extracted"
+
+        if kind == "zip":
+            members, excluded = scan_zip(path, limits or ZipLimits())
+        # the files of the project in which the environment is created
+        dependencies = get_dependency_digests(get_project_dir(code_dir))
+        update = can_update(path, code_dir)
+        # the record is only valid once the code directory is updated
+        record_path.unlink(missing_ok=True)
+        if code_dir.exists() and not update:
+            shutil.rmtree(code_dir, onerror=remove_readonly)
+        Path.mkdir(code_dir, parents=True, exist_ok=True)
+        files = record.files if record is not None and record.kind == kind else {}
+        match path.suffix:
+            case ".zip":
+                # a zip file (old submission format)
+                files, changed = update_from_zip(path, code_dir, members, files)
+                msg = (
+                    f"Updated {changed} changed file(s)"
+                    if update
+                    else "Extracted submitted files"
+                )
+                if excluded:
+                    msg += f" (skipped {excluded} excluded file(s))"
+            case ".bundle":
+                # a bundle file (new submission format)
+                if update:
+                    update_checkout(path, code_dir, student_name, object_store)
+                    msg = "Checked out resubmitted repository"
+                else:
+                    checkout_bundle(path, code_dir, student_name, object_store)
+                    msg = "Cloned submitted repository"
+            case _:
+                # default case, .py or something else
+                # copy it as-is to the code directory
+                target_name = path.name.removeprefix(f"{student_name}_")
+                shutil.copy(path, code_dir / target_name)
+                remove_files(code_dir, [name for name in files if name != target_name])
+                files = {target_name: get_file_record(code_dir / target_name)}
+                msg = f"Copied {target_name}"
+        if update and get_dependency_digests(get_project_dir(code_dir)) != dependencies:
+            if remove_envs(code_dir):
+                msg += " and removed the outdated environment"
+        ExtractionRecord(
+            kind=kind,
+            sha256=sha256,
+            size=stat_result.st_size,
+            mtime_ns=stat_result.st_mtime_ns,
+            files=files,
+        ).save(record_path)
+        return msg
+
+
+class ExtractedFile(BaseModel):
+    """An extracted file, as it was written to disk."""
+
+    crc: int = 0
+    size: int
+    mtime_ns: int
+
+
+class ExtractionRecord(BaseModel):
+    """Record of the submission which was extracted into a code directory.
+
+    Attributes:
+        kind (str): "zip", "bundle" or "file".
+        sha256 (str): the digest of the submission file.
+        size (int): the size of the submission file.
+        mtime_ns (int): the modification time of the submission file, used
+            to skip hashing an unchanged file.
+        files (dict[str, ExtractedFile]): the extracted files, keyed by their
+            path relative to the code directory. Empty for git bundles.
+    """
+
+    kind: str
+    sha256: str
+    size: int
+    mtime_ns: int
+    files: dict[str, ExtractedFile] = {}
+
+    @classmethod
+    def load(cls, path: Path) -> "ExtractionRecord | None":
+        try:
+            return cls.model_validate_json(path.read_bytes())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, path: Path) -> None:
+        with atomic_write(path) as f:
+            f.write(self.model_dump_json().encode())
+
+    def is_outdated(self, path: Path) -> bool:
+        stat_result = path.stat()
+        return (self.size, self.mtime_ns) != (
+            stat_result.st_size,
+            stat_result.st_mtime_ns,
+        )
+
+
+def get_extraction_record_path(code_dir: Path) -> Path:
+    """Get the path of the extraction record of a code directory.
+
+    The record is stored next to the code directory, since the contents of
+    the code directory are all submitted files.
+    """
+    return code_dir.with_name(f".{code_dir.name}.extracted.json")
+
+
+def get_file_record(path: Path, crc: int = 0) -> ExtractedFile:
+    stat_result = path.stat()
+    return ExtractedFile(
+        crc=crc, size=stat_result.st_size, mtime_ns=stat_result.st_mtime_ns
+    )
+
+
+def is_unmodified(path: Path, record: ExtractedFile) -> bool:
+    """Check whether an extracted file was left untouched since extracting."""
+    try:
+        stat_result = path.stat()
+    except FileNotFoundError:
+        return False
+    return (stat_result.st_size, stat_result.st_mtime_ns) == (
+        record.size,
+        record.mtime_ns,
+    )
+
+
+def is_extracted(
+    path: Path, code_dir: Path, record: ExtractionRecord | None = None
+) -> bool:
+    """Check whether the code directory contains the extracted submission.
+
+    For git bundles, the checked out commit is compared with the tip of the
+    bundle. For other submissions, the extracted files are compared with the
+    extraction record. Changes by the grader count as not extracted.
+    """
+    if path.suffix != ".bundle":
+        return record is not None and all(
+            is_unmodified(code_dir / name, file) for name, file in record.files.items()
+        )
+    if not (code_dir / ".git").exists():
+        return False
+    try:
+        _, tip = get_bundle_head(path)
+        head = run_git(["-C", code_dir, "rev-parse", "HEAD"]).strip()
+        status = run_git(
+            ["-C", code_dir, "status", "--porcelain", "--untracked-files=no"]
+        )
+    except TaskError:
+        return False
+    return head == tip and not status
+
+
+def can_update(path: Path, code_dir: Path) -> bool:
+    """Check whether a code directory can be updated to a submission in-place.
+
+    That is possible if the code directory contains the repository of a
+    previously checked out git bundle, or previously extracted files of the
+    same kind of submission. Otherwise, the code directory must be removed.
+    """
+    if path.suffix == ".bundle":
+        return (code_dir / ".git").is_dir()
+    record = ExtractionRecord.load(get_extraction_record_path(code_dir))
+    return (
+        code_dir.is_dir()
+        and record is not None
+        and record.kind == ("zip" if path.suffix == ".zip" else "file")
+    )
+
+
+def update_from_zip(
+    path: Path,
+    code_dir: Path,
+    members: list[ZipInfo],
+    files: dict[str, ExtractedFile],
+) -> tuple[dict[str, ExtractedFile], int]:
+    """Extract the files of a zip file which are not yet in the code directory.
+
+    Files with the same checksum and size as the previously extracted file
+    are skipped, unless they were modified on disk. Previously extracted files
+    which are no longer in the zip file are removed.
+
+    Args:
+        path (Path): the path of the zip file.
+        code_dir (Path): the code directory.
+        members (list[ZipInfo]): the members to extract, see scan_zip().
+        files (dict[str, ExtractedFile]): the previously extracted files.
+
+    Returns:
+        tuple[dict[str, ExtractedFile], int]: the extracted files and the
+        number of files which were written.
+    """
+    extracted = {}
+    changed = 0
+    with ZipFile(path) as f:
+        for info in members:
+            if info.is_dir():
+                f.extract(info, path=code_dir)
+                continue
+            previous = files.get(name := get_member_path(info.filename))
+            if (
+                previous is not None
+                and (previous.crc, previous.size) == (info.CRC, info.file_size)
+                and is_unmodified(code_dir / name, previous)
+            ):
+                extracted[name] = previous
+                continue
+            target = Path(f.extract(info, path=code_dir))
+            name = target.relative_to(code_dir).as_posix()
+            extracted[name] = get_file_record(target, crc=info.CRC)
+            changed += 1
+    remove_files(code_dir, [name for name in files if name not in extracted])
+    return extracted, changed
+
+
+def scan_zip(path: Path, limits: ZipLimits) -> tuple[list[ZipInfo], int]:
+    """Check the central directory of a zip file before extracting it.
+
+    Only the central directory at the end of the file is read. Since members
+    are never decompressed beyond their recorded size, the recorded sizes
+    bound the disk space used by extracting.
+
+    Args:
+        path (Path): the path of the zip file.
+        limits (ZipLimits): the limits on the contents.
+
+    Raises:
+        TaskError: if the zip file contains absolute paths or paths outside
+            the extraction directory, or exceeds the limits.
+
+    Returns:
+        tuple[list[ZipInfo], int]: the members to extract and the number of
+        excluded files.
+    """
+    members = []
+    excluded = 0
+    size = 0
+    with ZipFile(path) as f:
+        for info in f.infolist():
+            filename = info.filename.replace("\\", "/")
+            if (
+                filename.startswith("/")
+                or ":" in filename.split("/")[0]
+                or os.pardir in filename.split("/")
+            ):
+                raise TaskError(
+                    "Zip file contains an unsafe path", details=info.filename
+                )
+            if limits.is_excluded(filename):
+                excluded += not info.is_dir()
+                continue
+            members.append(info)
+            size += info.file_size
+    files = [info for info in members if not info.is_dir()]
+    if len(files) > limits.max_files:
+        folders = Counter(str(Path(info.filename).parent) for info in files)
+        raise TaskError(
+            f"Zip file contains {len(files)} files, more than the limit of "
+            f"{limits.max_files}",
+            details="\n".join(
+                f"{count:>8} files in {folder}"
+                for folder, count in folders.most_common(MAX_DETAILS)
+            ),
+        )
+    if size > limits.max_size:
+        largest = sorted(files, key=lambda info: info.file_size, reverse=True)
+        raise TaskError(
+            f"Zip file contains {humanize.naturalsize(size)}, more than the "
+            f"limit of {humanize.naturalsize(limits.max_size)}",
+            details="\n".join(
+                f"{humanize.naturalsize(info.file_size):>10}  {info.filename}"
+                for info in largest[:MAX_DETAILS]
+            ),
+        )
+    return members, excluded
+
+
+def get_member_path(filename: str) -> str:
+    """Get the path relative to the target at which ZipFile.extract() writes."""
+    parts = filename.replace("\\", "/").split("/")
+    return "/".join(p for p in parts if p not in ("", os.curdir, os.pardir))
+
+
+def remove_files(code_dir: Path, names: list[str]) -> None:
+    """Remove files from the code directory, and directories left empty."""
+    for name in names:
+        path = code_dir / name
+        path.unlink(missing_ok=True)
+        for parent in path.parents:
+            if parent == code_dir or not parent.is_dir() or any(parent.iterdir()):
+                break
+            parent.rmdir()
+
+
+def remove_envs(code_dir: Path) -> bool:
+    """Remove virtual environments in the code directory and a subdirectory.
+
+    Returns:
+        bool: whether an environment was removed.
+    """
+    envs = [
+        path
+        for path in [*code_dir.glob(".venv"), *code_dir.glob("*/.venv")]
+        if path.is_dir()
+    ]
+    for path in envs:
+        shutil.rmtree(path, onerror=remove_readonly)
+    return bool(envs)
+
+
+def checkout_bundle(
+    path: Path, code_dir: Path, student_name: str, object_store: Path
+) -> None:
+    """Check out the tip of a git bundle.
+
+    Instead of cloning the bundle, which copies all objects for every student,
+    the bundle is fetched into a shared object store. The code directory
+    becomes a repository borrowing its objects from that store, with only the
+    tip of the submitted branch checked out.
+
+    Args:
+        path (Path): the path of the bundle.
+        code_dir (Path): the (empty) code directory of the student.
+        student_name (str): the slugified name of the student.
+        object_store (Path): the git repository in which the objects of all
+            submitted bundles are stored.
+    """
+    branch, tip = fetch_bundle(path, student_name, object_store)
+    run_git(["init", "--quiet", "-b", branch, code_dir])
+    alternates = code_dir / ".git" / "objects" / "info" / "alternates"
+    alternates.write_text(f"{(object_store / 'objects').resolve().as_posix()}\n")
+    run_git(["-C", code_dir, "remote", "add", "origin", path.resolve()])
+    run_git(["-C", code_dir, "update-ref", f"refs/heads/{branch}", tip])
+    run_git(["-C", code_dir, "reset", "--quiet", "--hard"])
+
+
+def update_checkout(
+    path: Path, code_dir: Path, student_name: str, object_store: Path
+) -> None:
+    """Check out the tip of a git bundle in an existing repository.
+
+    Tracked files are updated to the new tip, untracked files (like a virtual
+    environment) are left alone.
+
+    Args:
+        path (Path): the path of the bundle.
+        code_dir (Path): the code directory of the student, containing a
+            repository created by checkout_bundle().
+        student_name (str): the slugified name of the student.
+        object_store (Path): the git repository in which the objects of all
+            submitted bundles are stored.
+    """
+    branch, tip = fetch_bundle(path, student_name, object_store)
+    run_git(["-C", code_dir, "remote", "set-url", "origin", path.resolve()])
+    run_git(["-C", code_dir, "checkout", "--quiet", "--force", "-B", branch, tip])
+
+
+def fetch_bundle(path: Path, student_name: str, object_store: Path) -> tuple[str, str]:
+    """Fetch the submitted branch of a git bundle into the object store.
+
+    Returns:
+        tuple[str, str]: the name of the branch and its commit hash.
+    """
+    ref, tip = get_bundle_head(path)
+    branch = ref.removeprefix("refs/heads/") if ref != "HEAD" else "main"
+    with _object_store_lock:
+        if not (object_store / "HEAD").exists():
+            run_git(["init", "--quiet", "--bare", object_store])
+    run_git(
+        [
+            *("--git-dir", object_store),
+            # concurrent fetches must not start garbage collection
+            *("-c", "gc.auto=0"),
+            *("fetch", "--quiet", "--no-write-fetch-head", path),
+            f"+{ref}:refs/students/{student_name}/{branch}",
+        ]
+    )
+    return branch, tip
+
+
+def get_bundle_head(path: Path) -> tuple[str, str]:
+    """Find the branch to check out from a git bundle.
+
+    Args:
+        path (Path): the path of the bundle.
+
+    Returns:
+        tuple[str, str]: the ref of the branch HEAD points to (or of any
+        branch, or HEAD itself) and its commit hash.
+    """
+    output = run_git(["bundle", "list-heads", path])
+    heads = {}
+    for line in output.splitlines():
+        sha, ref = line.split(maxsplit=1)
+        heads[ref] = sha
+    branches = [ref for ref in heads if ref.startswith("refs/heads/")]
+    for ref in branches:
+        if heads[ref] == heads.get("HEAD"):
+            return ref, heads[ref]
+    if branches:
+        return branches[0], heads[branches[0]]
+    if "HEAD" in heads:
+        return "HEAD", heads["HEAD"]
+    raise TaskError("Bundle does not contain any branches", details=output)
+
+
+def run_git(args: list) -> str:
+    """Run git and return its output, raising a TaskError if it fails."""
+    process = subprocess.run(
+        ["git", *args], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    output = process.stdout.decode()
+    if process.returncode:
+        raise TaskError(
+            f"Process exited with exit code: {process.returncode}", details=output
+        )
+    return output
+
+
+def ignore_progress(student: CanvasStudent, state: str) -> None:
+    pass
+
+
+def extract_all(
+    index: SubmissionIndex,
+    students: list[CanvasStudent],
+    object_store: Path,
+    max_workers: int | None = None,
+    callback: Callable[[CanvasStudent, str], None] | None = None,
+    limits: ZipLimits | None = None,
+) -> dict[int, str | Exception]:
+    """Extract the submissions of many students in parallel.
+
+    Zip files are extracted using a pool of processes, since extracting is CPU
+    bound. Git bundles are cloned and other files are copied from a pool of
+    threads, running the git processes concurrently. The objects of all git
+    bundles are stored once in a shared object store.
+
+    Args:
+        index (SubmissionIndex): the index of submission files and code
+            directories of the assignment.
+        students (list[CanvasStudent]): the students.
+        object_store (Path): the git repository in which the objects of all
+            submitted bundles are stored.
+        max_workers (int | None): the number of parallel extractions,
+            defaults to the number of CPUs.
+        callback (Callable[[CanvasStudent, str], None] | None): called with
+            the student and one of "extracting", "done" or "failed" whenever
+            the progress of an extraction changes.
+        limits (ZipLimits | None): the limits on the contents of zip files,
+            defaults to ZipLimits().
+
+    Returns:
+        dict[int, str | Exception]: a message describing what was extracted,
+        or the error, keyed by student id.
+    """
+    if callback is None:
+        callback = ignore_progress
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    results = {}
+    # multiprocessing hands stderr to the processes it starts, so it must be a
+    # real file and not a replacement without a file descriptor (e.g. Textual's)
+    with redirect_stderr(sys.__stderr__):
+        process_pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            # forking a process which is running threads is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    with process_pool, ThreadPoolExecutor(max_workers=max_workers) as thread_pool:
+        futures: dict[Future, CanvasStudent] = {}
+        for student in students:
+            try:
+                path = index.get_submission_file(student)
+            except RuntimeError as exc:
+                results[student.id] = exc
+                callback(student, "failed")
+                continue
+            code_dir = index.get_code_dir(student)
+            student_name = get_slug(student.name)
+            args = (
+                extract_submission,
+                path,
+                code_dir,
+                student_name,
+                object_store,
+                limits,
+            )
+            callback(student, "extracting")
+            if path.suffix == ".zip":
+                with redirect_stderr(sys.__stderr__):
+                    future = process_pool.submit(call_recorded, *args)
+            else:
+                future = thread_pool.submit(call_unrecorded, *args)
+            futures[future] = student
+        for future in as_completed(futures):
+            student = futures[future]
+            index.forget_code_dir(student)
+            try:
+                results[student.id], spans = future.result()
+                for span in spans:
+                    recorder.record(span)
+            except Exception as exc:
+                results[student.id] = exc
+                callback(student, "failed")
+            else:
+                callback(student, "done")
+    return results
+
+
+def call_unrecorded(func, *args):
+    """Call a function in a thread, which records its spans itself."""
+    return func(*args), []
+
+
+def remove_readonly(func, path, excinfo):
+    """Make a path writable and retry the failed function call."""
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
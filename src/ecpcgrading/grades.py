@@ -0,0 +1,257 @@
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from canvas_course_tools.datatypes import Assignment as CanvasAssignment
+from canvas_course_tools.datatypes import Student as CanvasStudent
+from pydantic import AwareDatetime, BaseModel, Field
+
+from ecpcgrading import canvas
+from ecpcgrading.client import CanvasClient, get_backoff
+from ecpcgrading.downloads import atomic_write
+
+GRADES = ("Fantastisch", "Goed", "Ontoereikend")
+GRADE_QUEUE_VERSION = 1
+# maximum number of students per bulk update
+MAX_BATCH_SIZE = 100
+# wait this long for more grades before sending them to Canvas
+FLUSH_DELAY = 2
+
+
+class GradeRecord(BaseModel):
+    """A grade and/or comment for a student, waiting to be sent to Canvas.
+
+    Attributes:
+        grade (str | None): the grade, or None to only add a comment.
+        comment (str): the comment, or an empty string.
+        attempts (int): the number of failed attempts to send the record.
+        error (str | None): why the last attempt failed.
+        retry_at (datetime | None): when to try again after a failure.
+    """
+
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    course_id: int
+    assignment_id: int
+    student_id: int
+    student_name: str
+    grade: str | None = None
+    comment: str = ""
+    created_at: AwareDatetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc)
+    )
+    attempts: int = 0
+    error: str | None = None
+    retry_at: AwareDatetime | None = None
+
+
+class GradeQueueFile(BaseModel):
+    version: int = GRADE_QUEUE_VERSION
+    records: list[GradeRecord] = []
+
+
+def merge_records(records: list[GradeRecord]) -> GradeRecord:
+    """Merge the records of a single student into one record.
+
+    The last grade wins, while all comments are kept.
+
+    Args:
+        records (list[GradeRecord]): the records, oldest first.
+
+    Returns:
+        GradeRecord: the merged record, with the id of the last record.
+    """
+    grades = [r.grade for r in records if r.grade is not None]
+    return records[-1].model_copy(
+        update={
+            "grade": grades[-1] if grades else None,
+            "comment": "\n\n".join(r.comment for r in records if r.comment),
+            "attempts": max(r.attempts for r in records),
+        }
+    )
+
+
+class GradeQueue:
+    """Durable queue of grades and comments which are sent to Canvas.
+
+    Every change is written to disk before it returns, so that no grades are
+    lost when the app exits before they were sent. Records are sent in batches
+    per assignment, using the bulk update endpoint of Canvas for more than one
+    student. Failed batches are retried later, with exponential backoff. The
+    queue is safe to use from multiple threads.
+
+    Args:
+        path (Path): the file in which the queue is stored.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # where an unusable queue file was moved to, if any
+        self.moved_aside: Path | None = None
+        self._records = self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._records)
+
+    def add(
+        self,
+        assignment: CanvasAssignment,
+        student: CanvasStudent,
+        grade: str | None,
+        comment: str,
+    ) -> GradeRecord:
+        """Add a grade and/or comment to the queue and save it."""
+        record = GradeRecord(
+            course_id=assignment.course.id,
+            assignment_id=assignment.id,
+            student_id=student.id,
+            student_name=student.name,
+            grade=grade,
+            comment=comment,
+        )
+        with self._lock:
+            self._records.append(record)
+            self._save()
+        return record
+
+    def get_pending(self, assignment_id: int) -> dict[int, GradeRecord]:
+        """Get the merged records per student id for an assignment."""
+        with self._lock:
+            records = [r for r in self._records if r.assignment_id == assignment_id]
+        return {
+            student_id: merge_records(
+                [r for r in records if r.student_id == student_id]
+            )
+            for student_id in dict.fromkeys(r.student_id for r in records)
+        }
+
+    def flush(
+        self, canvas_tasks: CanvasClient, force: bool = False
+    ) -> tuple[list[GradeRecord], list[GradeRecord]]:
+        """Send the queued records to Canvas.
+
+        The records of a student are merged and sent together, so that an
+        older grade can never overwrite a newer one. A student whose records
+        failed earlier is skipped until the retry time, unless a new record
+        was added or force is True. If another flush is in progress, nothing
+        is sent.
+
+        Args:
+            canvas_tasks (CanvasClient): the Canvas client.
+            force (bool): also send records which are waiting for a retry.
+
+        Returns:
+            tuple[list[GradeRecord], list[GradeRecord]]: the merged records
+            which were sent and which failed, one per student.
+        """
+        if not self._flush_lock.acquire(blocking=False):
+            return [], []
+        try:
+            now = datetime.now(timezone.utc)
+            per_student: dict[tuple[int, int, int], list[GradeRecord]] = {}
+            with self._lock:
+                for record in self._records:
+                    key = (record.course_id, record.assignment_id, record.student_id)
+                    per_student.setdefault(key, []).append(record)
+            per_assignment: dict[tuple[int, int], list[list[GradeRecord]]] = {}
+            for (course_id, assignment_id, _), records in per_student.items():
+                if force or any(
+                    r.retry_at is None or r.retry_at <= now for r in records
+                ):
+                    per_assignment.setdefault((course_id, assignment_id), []).append(
+                        records
+                    )
+
+            sent, failed = [], []
+            for (course_id, assignment_id), students in per_assignment.items():
+                for start in range(0, len(students), MAX_BATCH_SIZE):
+                    batch = students[start : start + MAX_BATCH_SIZE]
+                    merged = [merge_records(r) for r in batch]
+                    try:
+                        self._send(canvas_tasks, course_id, assignment_id, merged)
+                    except Exception as exc:
+                        failed.extend(self._failed(batch, exc))
+                    else:
+                        # the older records were sent along with the newest
+                        self._remove([r for rs in batch for r in rs])
+                        sent.extend(merged)
+            return sent, failed
+        finally:
+            self._flush_lock.release()
+
+    def _send(
+        self,
+        canvas_tasks: CanvasClient,
+        course_id: int,
+        assignment_id: int,
+        records: list[GradeRecord],
+    ) -> None:
+        if len(records) == 1:
+            record = records[0]
+            canvas.update_grade(
+                canvas_tasks,
+                course_id,
+                assignment_id,
+                record.student_id,
+                record.grade,
+                record.comment,
+            )
+        else:
+            canvas.update_grades(
+                canvas_tasks,
+                course_id,
+                assignment_id,
+                {r.student_id: (r.grade, r.comment) for r in records},
+            )
+
+    def _failed(
+        self, batch: list[list[GradeRecord]], exc: Exception
+    ) -> list[GradeRecord]:
+        """Schedule a retry for the records of a failed batch."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            for record in (r for rs in batch for r in rs):
+                record.attempts += 1
+                record.error = str(exc) or type(exc).__name__
+                record.retry_at = now + timedelta(
+                    seconds=get_backoff(record.attempts - 1, None)
+                )
+            self._save()
+        return [merge_records(rs) for rs in batch]
+
+    def _remove(self, records: list[GradeRecord]) -> None:
+        ids = {r.id for r in records}
+        with self._lock:
+            self._records = [r for r in self._records if r.id not in ids]
+            self._save()
+
+    def _load(self) -> list[GradeRecord]:
+        """Load the queue from disk, or start a new one.
+
+        An unreadable queue or one with a different version is moved aside
+        instead of discarded, since it may contain grades which were not sent.
+        """
+        try:
+            queue = GradeQueueFile.model_validate_json(self.path.read_bytes())
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            queue = None
+        if queue is None or queue.version != GRADE_QUEUE_VERSION:
+            timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            self.moved_aside = self.path.with_name(f"{self.path.name}.{timestamp}")
+            os.replace(self.path, self.moved_aside)
+            return []
+        return queue.records
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(self.path) as f:
+            f.write(GradeQueueFile(records=self._records).model_dump_json().encode())
+            # make sure that the grades survive a crash
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,173 @@
+import os
+import threading
+from functools import cache
+from pathlib import Path
+
+from canvas_course_tools.datatypes import Assignment as CanvasAssignment
+from canvas_course_tools.datatypes import Student as CanvasStudent
+from slugify import slugify
+
+from ecpcgrading.config import Config
+
+_indexes: dict[tuple[Path, int], "SubmissionIndex"] = {}
+_indexes_lock = threading.Lock()
+
+
+@cache
+def get_slug(name: str) -> str:
+    """Slugify a name, remembering the result since slugify is slow."""
+    return slugify(name)
+
+
+def get_project_dir(code_dir: Path) -> Path:
+    """Get the directory with the project files of an extracted submission.
+
+    Args:
+        code_dir (Path): the code directory of a student.
+
+    Returns:
+        Path: the single subdirectory, if the student submitted a directory
+        containing all the files, or else the code directory itself.
+    """
+    try:
+        with os.scandir(code_dir) as it:
+            entries = list(it)
+    except FileNotFoundError:
+        # not yet extracted
+        return code_dir
+    if len(entries) == 1 and entries[0].is_dir():
+        return Path(entries[0].path)
+    return code_dir
+
+
+class SubmissionIndex:
+    """Index of the submission files and code directories of an assignment.
+
+    The submissions directory is scanned once, instead of searching it for
+    every student. Submission files are named <slug>_<filename> and are
+    matched on the exact slug of the student. The code directory, or the
+    single subdirectory the student submitted, is looked up once per student.
+    Downloads and extractions update the index. Paths which disappeared are
+    looked up again, and the directory is scanned again when a student has no
+    submission file and the directory changed since the last scan, e.g.
+    because another process downloaded the submission.
+
+    Args:
+        submissions_dir (Path): the directory containing the submissions.
+        code_root (Path): the directory containing the code directories.
+    """
+
+    def __init__(self, submissions_dir: Path, code_root: Path) -> None:
+        self.submissions_dir = submissions_dir
+        self.code_root = code_root
+        self._files: dict[str, list[Path]] | None = None
+        self._mtime_ns: int | None = None
+        self._code_dirs: dict[str, Path] = {}
+        self._lock = threading.Lock()
+
+    def scan(self) -> None:
+        """Scan the submissions directory."""
+        files: dict[str, list[Path]] = {}
+        # taken before scanning, so that changes during the scan are noticed
+        mtime_ns = self._get_mtime_ns()
+        try:
+            with os.scandir(self.submissions_dir) as entries:
+                for entry in entries:
+                    slug, sep, _ = entry.name.partition("_")
+                    # skip hidden (temporary) files
+                    if sep and not slug.startswith(".") and entry.is_file():
+                        files.setdefault(slug, []).append(Path(entry.path))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._files = files
+            self._mtime_ns = mtime_ns
+
+    def _get_mtime_ns(self) -> int | None:
+        try:
+            return self.submissions_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def get_submission_files(self, student: CanvasStudent) -> list[Path]:
+        slug = get_slug(student.name)
+        with self._lock:
+            files, mtime_ns = self._files, self._mtime_ns
+        if (
+            files is None
+            or not all(p.is_file() for p in files.get(slug, []))
+            or (slug not in files and self._get_mtime_ns() != mtime_ns)
+        ):
+            self.scan()
+            with self._lock:
+                files = self._files
+        return list(files.get(slug, []))
+
+    def get_submission_file(self, student: CanvasStudent) -> Path:
+        """Find the submission file of a student.
+
+        Args:
+            student (CanvasStudent): the student.
+
+        Returns:
+            Path: the path of the submission file.
+        """
+        match self.get_submission_files(student):
+            case [path]:
+                return path
+            case [_, *_]:
+                raise RuntimeError("More than one submission file")
+            case _:
+                raise RuntimeError("Can't locate submission file")
+
+    def set_submission_file(self, student: CanvasStudent, path: Path) -> None:
+        """Record the (only) submission file of a student after downloading."""
+        with self._lock:
+            if self._files is not None:
+                self._files[get_slug(student.name)] = [path]
+
+    def get_code_dir(self, student: CanvasStudent, check_subdir: bool = False) -> Path:
+        """Get the code directory of a student.
+
+        Args:
+            student (CanvasStudent): the student.
+            check_subdir (bool): if the student submitted a single directory
+                containing all files, return that directory.
+
+        Returns:
+            Path: the code directory.
+        """
+        student_dir = self.code_root / get_slug(student.name)
+        if not check_subdir:
+            return student_dir
+        with self._lock:
+            code_dir = self._code_dirs.get(student.id)
+        if code_dir is not None and code_dir.is_dir():
+            return code_dir
+        if not student_dir.exists():
+            # not yet extracted
+            return student_dir
+        code_dir = get_project_dir(student_dir)
+        with self._lock:
+            self._code_dirs[student.id] = code_dir
+        return code_dir
+
+    def forget_code_dir(self, student: CanvasStudent) -> None:
+        """Look up the code directory again, e.g. after extracting."""
+        with self._lock:
+            self._code_dirs.pop(student.id, None)
+
+
+def get_submission_index(
+    config: Config, assignment: CanvasAssignment
+) -> SubmissionIndex:
+    """Get the (shared) submission index of an assignment."""
+    key = config.root_path, assignment.id
+    with _indexes_lock:
+        if (index := _indexes.get(key)) is None:
+            assignment_dir = config.root_path / get_slug(assignment.name)
+            index = _indexes[key] = SubmissionIndex(
+                assignment_dir / config.submissions_path,
+                assignment_dir / config.code_path,
+            )
+    return index
@@ -0,0 +1,179 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket
+# holds everything slower
+HISTOGRAM_BOUNDS = (0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30)
+# maximum number of spans kept for the trace
+MAX_SPANS = 100_000
+# maximum number of latencies kept per operation for the percentiles
+MAX_SAMPLES = 10_000
+
+
+@dataclass
+class Span:
+    """A single timed operation."""
+
+    name: str
+    category: str
+    # wall clock time in seconds since the epoch
+    start: float
+    duration: float = 0.0
+    bytes: int = 0
+    error: bool = False
+    args: dict = field(default_factory=dict)
+    pid: int = field(default_factory=os.getpid)
+    thread_id: int = field(default_factory=threading.get_ident)
+
+
+@dataclass
+class OperationStats:
+    """Aggregated counts, bytes and latencies of one kind of operation."""
+
+    name: str
+    category: str
+    count: int = 0
+    errors: int = 0
+    bytes: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    histogram: list[int] = field(
+        default_factory=lambda: [0] * (len(HISTOGRAM_BOUNDS) + 1)
+    )
+    samples: deque[float] = field(default_factory=lambda: deque(maxlen=MAX_SAMPLES))
+
+    def add(self, span: Span) -> None:
+        self.count += 1
+        self.errors += span.error
+        self.bytes += span.bytes
+        self.total_time += span.duration
+        self.max_time = max(self.max_time, span.duration)
+        self.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, span.duration)] += 1
+        self.samples.append(span.duration)
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.count if self.count else 0.0
+
+    def get_percentile(self, percentile: float) -> float:
+        """Get a latency percentile (0-100) of the most recent operations."""
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+class Recorder:
+    """Thread-safe recorder of spans and per-operation statistics."""
+
+    def __init__(self) -> None:
+        self._spans: deque[Span] = deque(maxlen=MAX_SPANS)
+        self._stats: dict[str, OperationStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+            if (stats := self._stats.get(span.name)) is None:
+                stats = self._stats[span.name] = OperationStats(
+                    span.name, span.category
+                )
+            stats.add(span)
+
+    @contextmanager
+    def measure(self, name: str, category: str, **args) -> Iterator[Span]:
+        """Time the body of a with statement.
+
+        The span can be used to add the number of bytes transferred or extra
+        arguments. Exceptions mark the span as failed.
+
+        Args:
+            name (str): the name of the operation.
+            category (str): the category, e.g. "canvas" or "download".
+            **args: extra information shown in the trace.
+
+        Yields:
+            Span: the span which is recorded when the body finishes.
+        """
+        span = Span(name, category, start=time.time(), args=args)
+        t0 = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.error = True
+            raise
+        finally:
+            span.duration = time.perf_counter() - t0
+            self.record(span)
+
+    def get_spans(self) -> list[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def get_stats(self) -> list[OperationStats]:
+        """Get a copy of the statistics, slowest operations (in total) first."""
+        with self._lock:
+            stats = [
+                OperationStats(
+                    **(
+                        vars(s)
+                        | {"histogram": s.histogram.copy(), "samples": s.samples.copy()}
+                    )
+                )
+                for s in self._stats.values()
+            ]
+        return sorted(stats, key=lambda s: s.total_time, reverse=True)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._spans.clear()
+            self._stats.clear()
+
+    def export_trace(self, path: Path) -> None:
+        """Export all spans as a Chrome trace.
+
+        The trace can be opened using chrome://tracing or https://ui.perfetto.dev.
+
+        Args:
+            path (Path): the path of the JSON file.
+        """
+        events = [
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": span.pid,
+                "tid": span.thread_id,
+                "args": span.args | {"bytes": span.bytes, "error": span.error},
+            }
+            for span in self.get_spans()
+        ]
+        Path.mkdir(path.parent, parents=True, exist_ok=True)
+        path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+
+recorder = Recorder()
+measure = recorder.measure
+
+
+def call_recorded(func: Callable[..., T], *args) -> tuple[T, list[Span]]:
+    """Call a function in a worker process and return the spans it recorded.
+
+    The recorder of the parent process is not available in a worker process,
+    so the spans must be recorded by the parent afterwards.
+    """
+    recorder.reset()
+    result = func(*args)
+    return result, recorder.get_spans()
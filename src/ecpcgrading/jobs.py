@@ -0,0 +1,309 @@
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr
+from dataclasses import dataclass, field
+from typing import Callable, TypeVar
+
+from canvas_course_tools.datatypes import Assignment as CanvasAssignment
+from canvas_course_tools.datatypes import Student as CanvasStudent
+
+from ecpcgrading.config import Config
+from ecpcgrading.instrumentation import call_recorded, recorder
+
+T = TypeVar("T")
+
+JOB_STATES = ("queued", "running", "done", "failed", "cancelled")
+# jobs started by the user come before jobs started in the background
+USER_PRIORITY = 0
+BACKGROUND_PRIORITY = 10
+# finished jobs are forgotten when there are more than this
+MAX_FINISHED_JOBS = 500
+
+_job_ids = itertools.count(1)
+
+
+@dataclass(eq=False)
+class Job:
+    """A unit of work for a student, like downloading or extracting.
+
+    Attributes:
+        kind (str): the kind of job, e.g. "download", which is also the name
+            of the pool of workers which runs it.
+        title (str): a description shown to the user.
+        assignment (CanvasAssignment): the assignment.
+        student (CanvasStudent): the student.
+        func (Callable[[], str]): performs the job and returns a message
+            describing the result.
+        after (Job | None): a job which must succeed before this job runs. If
+            it fails or is cancelled, this job is cancelled as well.
+        priority (int): jobs with a lower priority run first.
+        state (str): one of "queued", "running", "done", "failed" or
+            "cancelled".
+        message (str): the result of the job, or why it was cancelled.
+        error (Exception | None): the error, if the job failed.
+    """
+
+    kind: str
+    title: str
+    assignment: CanvasAssignment
+    student: CanvasStudent
+    func: Callable[[], str]
+    after: "Job | None" = None
+    priority: int = USER_PRIORITY
+    state: str = "queued"
+    message: str = ""
+    error: Exception | None = None
+    id: int = field(default_factory=lambda: next(_job_ids))
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    @property
+    def is_background(self) -> bool:
+        return self.priority > USER_PRIORITY
+
+    @property
+    def duration(self) -> float | None:
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class JobQueue:
+    """Queue of jobs which are run by bounded pools of worker threads.
+
+    Every kind of job has its own pool, so that e.g. downloads are not held up
+    by environments which are being created. Within a pool, the queued job
+    with the lowest priority (and then the oldest) runs first, as soon as the
+    job it depends on succeeded. Queued jobs can be cancelled or reprioritised
+    at any time. Only one job per student runs at a time, since jobs for the
+    same student work in the same folders. CPU-bound work can be run in a
+    shared pool of processes.
+
+    Args:
+        workers (dict[str, int]): the number of worker threads per kind of
+            job. Kinds which are not listed get a single worker.
+        process_workers (int): the maximum number of worker processes.
+        callback (Callable[[Job], None] | None): called from a worker thread
+            whenever a job is finished.
+    """
+
+    def __init__(
+        self,
+        workers: dict[str, int],
+        process_workers: int,
+        callback: Callable[[Job], None] | None = None,
+    ) -> None:
+        self.workers = workers
+        self.process_workers = process_workers
+        self.callback = callback
+        # incremented on every change, to detect changes by polling
+        self.version = 0
+        self._jobs: list[Job] = []
+        self._threads: dict[str, list[threading.Thread]] = {}
+        self._process_pool: ProcessPoolExecutor | None = None
+        self._condition = threading.Condition()
+        self._shutdown = False
+
+    @classmethod
+    def from_config(
+        cls, config: Config, callback: Callable[[Job], None] | None = None
+    ) -> "JobQueue":
+        extract_workers = config.extract_workers or os.cpu_count() or 1
+        return cls(
+            {
+                "download": config.pool_size,
+                "extract": extract_workers,
+                "env": config.env_workers,
+            },
+            extract_workers,
+            callback,
+        )
+
+    def submit(self, job: Job) -> Job:
+        """Add a job to the queue, starting workers if necessary.
+
+        If the job depends on a job which already failed or was cancelled, it
+        is cancelled right away.
+        """
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("The job queue was shut down")
+            self._jobs.append(job)
+            if job.after is not None and job.after.state in ("failed", "cancelled"):
+                # the job it depends on will never succeed
+                self._finish(
+                    job,
+                    "cancelled",
+                    f"Skipped, since {job.after.title} {job.after.state}",
+                )
+            else:
+                self._start_workers(job.kind)
+            self._changed()
+        return job
+
+    def cancel(self, predicate: Callable[[Job], bool], reason: str = "") -> int:
+        """Cancel queued jobs, and the jobs which depend on them.
+
+        Running jobs can not be cancelled and are left alone.
+
+        Args:
+            predicate (Callable[[Job], bool]): selects the jobs to cancel.
+            reason (str): the message of the cancelled jobs.
+
+        Returns:
+            int: the number of cancelled jobs.
+        """
+        with self._condition:
+            jobs = [j for j in self._jobs if j.state == "queued" and predicate(j)]
+            for job in jobs:
+                self._finish(job, "cancelled", reason or "Cancelled")
+            self._changed()
+        return len(jobs)
+
+    def set_priority(self, predicate: Callable[[Job], bool], priority: int) -> None:
+        """Change the priority of queued jobs."""
+        with self._condition:
+            for job in self._jobs:
+                if job.state == "queued" and predicate(job):
+                    job.priority = priority
+            self._changed()
+
+    def wait(self, jobs: list[Job], timeout: float | None = None) -> bool:
+        """Wait until jobs are finished.
+
+        Args:
+            jobs (list[Job]): the jobs.
+            timeout (float | None): the maximum time to wait in seconds.
+
+        Returns:
+            bool: True if all jobs are finished.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: all(job.is_finished for job in jobs), timeout
+            )
+
+    def get_jobs(self) -> list[Job]:
+        with self._condition:
+            return list(self._jobs)
+
+    def clear_finished(self) -> None:
+        """Forget all finished jobs."""
+        with self._condition:
+            self._jobs = [job for job in self._jobs if not job.is_finished]
+            self._changed()
+
+    def run_in_process(self, func: Callable[..., T], *args) -> T:
+        """Call a function in the pool of processes and wait for the result.
+
+        The spans recorded by the function are recorded in this process.
+        """
+        with self._condition:
+            if self._process_pool is None:
+                # multiprocessing hands stderr to the processes it starts, so
+                # it must be a real file and not e.g. Textual's replacement
+                with redirect_stderr(sys.__stderr__):
+                    self._process_pool = ProcessPoolExecutor(
+                        max_workers=self.process_workers,
+                        # forking a process which is running threads is unsafe
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+            pool = self._process_pool
+        with redirect_stderr(sys.__stderr__):
+            future = pool.submit(call_recorded, func, *args)
+        result, spans = future.result()
+        for span in spans:
+            recorder.record(span)
+        return result
+
+    def shutdown(self) -> None:
+        """Cancel all queued jobs and stop the workers when they are idle."""
+        self.cancel(lambda job: True, "Cancelled on exit")
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+            pool = self._process_pool
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _start_workers(self, kind: str) -> None:
+        threads = self._threads.setdefault(kind, [])
+        if len(threads) < self.workers.get(kind, 1):
+            thread = threading.Thread(
+                target=self._work, args=(kind,), name=f"job-{kind}", daemon=True
+            )
+            threads.append(thread)
+            thread.start()
+
+    def _work(self, kind: str) -> None:
+        while (job := self._next_job(kind)) is not None:
+            try:
+                message = job.func()
+            except Exception as exc:
+                state, message, job.error = "failed", str(exc), exc
+            else:
+                state = "done"
+            with self._condition:
+                self._finish(job, state, message)
+                self._forget_finished()
+                self._changed()
+
+    def _next_job(self, kind: str) -> Job | None:
+        """Wait for the next job of a kind which is ready to run."""
+        with self._condition:
+            while not self._shutdown:
+                busy = {
+                    (job.assignment.id, job.student.id)
+                    for job in self._jobs
+                    if job.state == "running"
+                }
+                ready = [
+                    job
+                    for job in self._jobs
+                    if job.kind == kind
+                    and job.state == "queued"
+                    and (job.after is None or job.after.state == "done")
+                    and (job.assignment.id, job.student.id) not in busy
+                ]
+                if ready:
+                    job = min(ready, key=lambda job: (job.priority, job.id))
+                    job.state = "running"
+                    job.started_at = time.time()
+                    self._changed()
+                    return job
+                self._condition.wait()
+        return None
+
+    def _finish(self, job: Job, state: str, message: str) -> None:
+        """Finish a job and cancel the jobs depending on it if it failed."""
+        job.state = state
+        job.message = message
+        job.finished_at = time.time()
+        if self.callback is not None:
+            self.callback(job)
+        if state != "done":
+            for dependent in self._jobs:
+                if dependent.after is job and dependent.state == "queued":
+                    self._finish(
+                        dependent, "cancelled", f"Skipped, since {job.title} {state}"
+                    )
+
+    def _forget_finished(self) -> None:
+        finished = [job for job in self._jobs if job.is_finished]
+        if len(finished) > MAX_FINISHED_JOBS:
+            forget = set(finished[: len(finished) - MAX_FINISHED_JOBS])
+            self._jobs = [job for job in self._jobs if job not in forget]
+
+    def _changed(self) -> None:
+        self.version += 1
+        self._condition.notify_all()
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import humanize
+from textual.app import ComposeResult
+from textual.containers import Center, Vertical
+from textual.screen import ModalScreen
+from textual.widgets import DataTable, Footer, Label
+
+from ecpcgrading.instrumentation import OperationStats, recorder
+from ecpcgrading.paths import get_trace_path
+
+if TYPE_CHECKING:
+    from ecpcgrading.tui import GradingTool
+
+SPARKS = " ▁▂▃▄▅▆▇█"
+# refresh the statistics while the screen is shown
+UPDATE_INTERVAL = 1.0
+
+
+class MetricsScreen(ModalScreen):
+    """Counts, bytes and latencies of the operations in this session."""
+
+    BINDINGS = [
+        ("escape", "dismiss", "Close"),
+        ("x", "export_trace", "Export trace"),
+    ]
+
+    app: GradingTool
+
+    def compose(self) -> ComposeResult:
+        with Vertical(id="modal_dialog"):
+            with Center():
+                yield Label("Performance metrics of this session")
+            yield DataTable(cursor_type="row", zebra_stripes=True)
+        yield Footer()
+
+    def on_mount(self) -> None:
+        table = self.query_one(DataTable)
+        table.add_columns(
+            "Operation", "Count", "Errors", "Bytes", "Mean", "p50", "p95", "Max"
+        )
+        table.add_column("Latency 1 ms → 30 s", key="histogram")
+        self.update_table()
+        self.set_interval(UPDATE_INTERVAL, self.update_table)
+
+    def update_table(self) -> None:
+        table = self.query_one(DataTable)
+        cursor_row = table.cursor_row
+        table.clear()
+        for stats in recorder.get_stats():
+            table.add_row(
+                f"[dim]{stats.category}[/] {stats.name}",
+                str(stats.count),
+                f"[red]{stats.errors}" if stats.errors else "",
+                humanize.naturalsize(stats.bytes) if stats.bytes else "",
+                format_time(stats.mean_time),
+                format_time(stats.get_percentile(50)),
+                format_time(stats.get_percentile(95)),
+                format_time(stats.max_time),
+                get_sparkline(stats),
+            )
+        table.move_cursor(row=cursor_row)
+
+    def action_export_trace(self) -> None:
+        path = get_trace_path(self.app.config)
+        recorder.export_trace(path)
+        self.notify(f"Exported trace to {path}.")
+
+
+def format_time(seconds: float) -> str:
+    if seconds < 1:
+        return f"{seconds * 1000:.1f} ms"
+    return f"{seconds:.2f} s"
+
+
+def get_sparkline(stats: OperationStats) -> str:
+    """Show the latency histogram as a row of bars."""
+    highest = max(stats.histogram)
+    return "".join(
+        SPARKS[round(count / highest * (len(SPARKS) - 1))] if highest else " "
+        for count in stats.histogram
+    )
@@ -0,0 +1,52 @@
+from datetime import datetime
+from pathlib import Path
+
+from canvas_course_tools.datatypes import Assignment as CanvasAssignment
+from canvas_course_tools.datatypes import Student as CanvasStudent
+
+from ecpcgrading.config import Config
+from ecpcgrading.index import get_slug, get_submission_index
+
+
+def get_submissions_dir(config: Config, assignment: CanvasAssignment):
+    return config.root_path / get_slug(assignment.name) / config.submissions_path
+
+
+def get_manifest_path(config: Config, assignment: CanvasAssignment) -> Path:
+    return config.root_path / get_slug(assignment.name) / "manifest.json"
+
+
+def get_object_store(config: Config, assignment: CanvasAssignment) -> Path:
+    return config.root_path / get_slug(assignment.name) / "objects.git"
+
+
+def get_env_templates_dir(config: Config, assignment: CanvasAssignment) -> Path:
+    return config.root_path / get_slug(assignment.name) / "envs"
+
+
+def get_blob_store_dir(config: Config) -> Path:
+    return config.root_path / ".ecpcgrading" / "blobs"
+
+
+def get_grade_queue_path(config: Config) -> Path:
+    return config.root_path / ".ecpcgrading" / "grade-queue.json"
+
+
+def get_trace_path(config: Config) -> Path:
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return config.root_path / ".ecpcgrading" / f"trace-{timestamp}.json"
+
+
+def get_uv_cache_dir(config: Config) -> Path | None:
+    if config.uv_cache_dir is None:
+        return None
+    return config.root_path / config.uv_cache_dir
+
+
+def get_code_dir(
+    config: Config,
+    assignment: CanvasAssignment,
+    student: CanvasStudent,
+    check_subdir: bool = False,
+) -> Path:
+    return get_submission_index(config, assignment).get_code_dir(student, check_subdir)
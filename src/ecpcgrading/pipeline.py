@@ -0,0 +1,257 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable
+
+import requests
+from canvas_course_tools.datatypes import Assignment as CanvasAssignment
+from canvas_course_tools.datatypes import CanvasSubmission
+from canvas_course_tools.datatypes import Student as CanvasStudent
+
+from ecpcgrading.config import Config, EnvironmentConfig
+from ecpcgrading.downloads import (
+    BlobStore,
+    Manifest,
+    download_submission,
+    get_shared_manifest,
+)
+from ecpcgrading.environments import ensure_env, get_python_version
+from ecpcgrading.extract import ZipLimits, extract_submission
+from ecpcgrading.index import get_slug, get_submission_index
+from ecpcgrading.paths import (
+    get_blob_store_dir,
+    get_env_templates_dir,
+    get_manifest_path,
+    get_object_store,
+    get_submissions_dir,
+    get_uv_cache_dir,
+)
+
+STAGES = ("download", "extract", "env")
+
+
+def ignore_progress(student: CanvasStudent, stage: str, state: str) -> None:
+    pass
+
+
+@dataclass
+class Stage:
+    """A step in preparing the code of a student.
+
+    Attributes:
+        name (str): the name of the stage.
+        run (Callable[[CanvasStudent], str]): performs the stage for a
+            student and returns a message describing the result.
+        max_workers (int): the number of students for which this stage may run
+            at the same time.
+    """
+
+    name: str
+    run: Callable[[CanvasStudent], str]
+    max_workers: int
+
+
+def run_pipeline(
+    students: list[CanvasStudent],
+    stages: list[Stage],
+    callback: Callable[[CanvasStudent, str, str], None] | None = None,
+) -> dict[int, str | Exception]:
+    """Run all stages for all students.
+
+    Every student advances to the next stage as soon as the previous stage is
+    finished, independently of other students. Each stage has its own pool of
+    workers, so that e.g. downloads for some students run while the code of
+    other students is extracted. When a stage fails for a student, the
+    remaining stages are skipped for that student only.
+
+    Args:
+        students (list[CanvasStudent]): the students.
+        stages (list[Stage]): the stages, in order.
+        callback (Callable[[CanvasStudent, str, str], None] | None): called
+            with the student, the name of the stage and one of "queued",
+            "running", "done" or "failed" whenever the progress of a student
+            changes. If it raises, e.g. a BrokenPipeError when printing, all
+            students are still finished and the first error is raised
+            afterwards.
+
+    Returns:
+        dict[int, str | Exception]: the message of the last stage, or the
+        error, keyed by student id. Empty if there are no stages.
+    """
+    if callback is None:
+        callback = ignore_progress
+    if not stages:
+        return {}
+
+    results = {}
+    callback_errors: list[Exception] = []
+    all_done = threading.Condition()
+    executors = [ThreadPoolExecutor(max_workers=s.max_workers) for s in stages]
+
+    def notify(student: CanvasStudent, idx: int, state: str) -> None:
+        try:
+            callback(student, stages[idx].name, state)
+        except Exception as exc:
+            callback_errors.append(exc)
+
+    def submit(student: CanvasStudent, idx: int) -> None:
+        notify(student, idx, "queued")
+        future = executors[idx].submit(run, student, idx)
+        future.add_done_callback(partial(advance, student, idx))
+
+    def run(student: CanvasStudent, idx: int) -> str:
+        notify(student, idx, "running")
+        return stages[idx].run(student)
+
+    def advance(student: CanvasStudent, idx: int, future: Future) -> None:
+        try:
+            result = future.result()
+        except Exception as exc:
+            result = exc
+            notify(student, idx, "failed")
+        else:
+            notify(student, idx, "done")
+            if idx + 1 < len(stages):
+                try:
+                    submit(student, idx + 1)
+                except Exception as exc:
+                    result = exc
+                else:
+                    return
+        with all_done:
+            results[student.id] = result
+            all_done.notify()
+
+    try:
+        for student in students:
+            submit(student, 0)
+        with all_done:
+            all_done.wait_for(lambda: len(results) == len(students))
+    finally:
+        for executor in executors:
+            executor.shutdown(cancel_futures=True)
+    if callback_errors:
+        raise callback_errors[0]
+    return results
+
+
+def prepare_stages(
+    config: Config,
+    assignment: CanvasAssignment,
+    submissions: dict[int, CanvasSubmission],
+    env: EnvironmentConfig | None,
+    manifest: Manifest,
+    session,
+    stage_names: tuple[str, ...] = STAGES,
+) -> list[Stage]:
+    """Create the stages to download, extract and create an environment.
+
+    Args:
+        config (Config): the grading tool configuration.
+        assignment (CanvasAssignment): the assignment.
+        submissions (dict[int, CanvasSubmission]): the submissions, keyed by
+            student id.
+        env (EnvironmentConfig | None): the environment to create, or None to
+            skip creating an environment.
+        manifest (Manifest): the manifest of downloaded submissions.
+        session (requests.Session): the HTTP session used for downloading.
+        stage_names (tuple[str, ...]): the names of the stages to create.
+
+    Returns:
+        list[Stage]: the stages.
+    """
+    submissions_dir = get_submissions_dir(config, assignment)
+    blob_store = BlobStore(get_blob_store_dir(config))
+    index = get_submission_index(config, assignment)
+
+    def download(student: CanvasStudent) -> str:
+        submission = submissions[student.id]
+        if manifest.is_current(submissions_dir, student, submission):
+            return "Submission is already up to date"
+        path = download_submission(
+            session, submissions_dir, blob_store, student, submission, manifest
+        )
+        index.set_submission_file(student, path)
+        return "Downloaded submission"
+
+    def extract(student: CanvasStudent) -> str:
+        try:
+            return extract_submission(
+                index.get_submission_file(student),
+                index.get_code_dir(student),
+                get_slug(student.name),
+                get_object_store(config, assignment),
+                ZipLimits.from_config(config),
+            )
+        finally:
+            index.forget_code_dir(student)
+
+    def create_environment(student: CanvasStudent) -> str:
+        code_dir = index.get_code_dir(student, check_subdir=True)
+        python_version = get_python_version(env, code_dir)
+        if python_version is None:
+            raise RuntimeError("Cannot determine Python version from .python-version")
+        msg, _ = ensure_env(
+            code_dir,
+            python_version,
+            env.package_spec,
+            get_env_templates_dir(config, assignment),
+            get_uv_cache_dir(config),
+        )
+        return msg
+
+    stages = [
+        Stage("download", download, config.pool_size),
+        Stage("extract", extract, config.extract_workers or os.cpu_count() or 1),
+    ]
+    if env is not None:
+        stages.append(Stage("env", create_environment, config.env_workers))
+    return [stage for stage in stages if stage.name in stage_names]
+
+
+def prepare_all(
+    config: Config,
+    assignment: CanvasAssignment,
+    submissions: list[tuple[CanvasStudent, CanvasSubmission]],
+    session: requests.Session,
+    callback: Callable[[CanvasStudent, str, str], None] | None = None,
+    stage_names: tuple[str, ...] = STAGES,
+    env: EnvironmentConfig | None = None,
+) -> dict[int, str | Exception]:
+    """Download, extract and create an environment for many students.
+
+    Args:
+        config (Config): the grading tool configuration.
+        assignment (CanvasAssignment): the assignment.
+        submissions (list[tuple[CanvasStudent, CanvasSubmission]]): the
+            students and their submissions.
+        session (requests.Session): the HTTP session used for downloading,
+            e.g. the shared session of the Canvas client.
+        callback (Callable[[CanvasStudent, str, str], None] | None): called
+            whenever the progress of a student changes, see run_pipeline().
+        stage_names (tuple[str, ...]): the names of the stages to run.
+        env (EnvironmentConfig | None): the environment to create, defaults to
+            the first configured environment.
+
+    Returns:
+        dict[int, str | Exception]: the message of the last stage, or the
+        error, keyed by student id.
+    """
+    manifest = get_shared_manifest(get_manifest_path(config, assignment))
+    if env is None:
+        env = next(iter(config.env.values()), None)
+    stages = prepare_stages(
+        config,
+        assignment,
+        {student.id: submission for student, submission in submissions},
+        env,
+        manifest,
+        session,
+        stage_names,
+    )
+    try:
+        return run_pipeline([student for student, _ in submissions], stages, callback)
+    finally:
+        manifest.save()
@@ -0,0 +1,57 @@
+import sys
+import time
+
+import click
+
+# maximum time in seconds from starting until the first frame is shown
+STARTUP_BUDGET = 1.0
+
+
+class StartupProfile:
+    """Timings of starting the grading tool.
+
+    All timings are relative to the creation of the profile.
+    """
+
+    def __init__(self) -> None:
+        self.t0 = time.perf_counter()
+        self.marks: dict[str, tuple[float, int]] = {}
+
+    def mark(self, name: str) -> None:
+        """Record the time and the number of imported modules."""
+        self.marks[name] = time.perf_counter() - self.t0, len(sys.modules)
+
+
+def profile_startup(budget: float = STARTUP_BUDGET) -> bool:
+    """Start the grading tool without output to the terminal and report timings.
+
+    The tool exits as soon as the assignments are shown. Importing the tool,
+    creating the app, showing the first frame and showing the assignments are
+    timed.
+
+    Args:
+        budget (float): the maximum time in seconds until the first frame.
+
+    Returns:
+        bool: True if the first frame was shown within budget.
+    """
+    profile = StartupProfile()
+    from ecpcgrading.tui import GradingTool
+
+    profile.mark("import")
+    app = GradingTool(profile=profile)
+    profile.mark("init")
+    app.run(headless=True)
+
+    for name, (t, n_modules) in profile.marks.items():
+        click.echo(f"{name:>12}: {t * 1000:7.1f} ms ({n_modules} modules loaded)")
+    if (first_frame := profile.marks.get("first frame")) is None:
+        click.echo("The first frame was never shown.", err=True)
+        return False
+    if first_frame[0] > budget:
+        click.echo(
+            f"The first frame took longer than the budget of {budget * 1000:.0f} ms.",
+            err=True,
+        )
+        return False
+    return True
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import threading
 import time
+from datetime import datetime, timedelta, timezone
 from functools import partial
 from typing import TYPE_CHECKING
 
@@ -12,18 +13,59 @@ from textual import on, work
 from textual.app import App, ComposeResult
 from textual.command import Hit, Hits, Provider
 from textual.containers import Horizontal, VerticalScroll
-from textual.reactive import reactive
+from textual.message import Message
 from textual.screen import ModalScreen, Screen
-from textual.widgets import Button, Footer, Header, Label, ListItem, ListView, Static
-from textual.worker import Worker, get_current_worker
-
-from ecpcgrading.tasks import TasksScreen
+from textual.widgets import Button, DataTable, Footer, Header, Label, Static
+
+from ecpcgrading.cache import store_submissions
+from ecpcgrading.canvas import get_changed_submissions
+from ecpcgrading.grades import GradeRecord
+from ecpcgrading.paths import get_code_dir
+from ecpcgrading.pipeline import STAGES
+from ecpcgrading.tasks import (
+    JOB_PANEL_INTERVAL,
+    JobPanel,
+    LookAhead,
+    TasksScreen,
+    TaskSummaryModal,
+    get_jobs_result,
+    submit_jobs,
+)
 
 if TYPE_CHECKING:
     from ecpcgrading.assignments import Assignment
+    from ecpcgrading.jobs import Job
     from ecpcgrading.tui import GradingTool
 
-CANVAS_POOL_SIZE = 8
+JOB_PROGRESS = {
+    ("download", "running"): "[bold]Downloading...",
+    ("download", "done"): "[green]Downloaded",
+    ("download", "failed"): "[bold red]Download failed",
+    ("extract", "running"): "[bold]Extracting...",
+    ("extract", "done"): "[green]Extracted",
+    ("extract", "failed"): "[bold red]Extract failed",
+    ("env", "running"): "[bold]Creating env...",
+    ("env", "done"): "[green]Ready",
+    ("env", "failed"): "[bold red]Env failed",
+}
+# overlap between refreshes, to allow for clock differences with Canvas
+SYNC_MARGIN = timedelta(minutes=1)
+
+
+def get_progress(jobs: list[Job]) -> str:
+    """Describe the progress of jobs which run one after the other."""
+    previous = None
+    for job in jobs:
+        if job.state == "done":
+            previous = job
+        elif job.state == "queued":
+            # waiting for the previous job, or for a free worker
+            if previous is None:
+                return "[dim]Queued"
+            break
+        else:
+            return JOB_PROGRESS.get((job.kind, job.state), "[dim]Cancelled")
+    return JOB_PROGRESS[(previous.kind, "done")] if previous else ""
 
 
 class CommentsScreen(ModalScreen):
@@ -51,102 +93,156 @@ class CommentsScreen(ModalScreen):
         widget.border_subtitle = "Escape to close"
 
 
-class Student(ListItem):
-    submission: reactive[CanvasSubmission | None] = reactive(None)
+class Student:
+    """A student and their submission, shown as a row in the students table."""
 
     def __init__(self, student: CanvasStudent) -> None:
-        super().__init__()
         self._student = student
         self.student_name = student.name
+        self.submission: CanvasSubmission | None = None
+        # a grade or comment which was not yet sent to Canvas
+        self.pending_grade: GradeRecord | None = None
+        self.progress: str = ""
+
+    @property
+    def key(self) -> str:
+        return str(self._student.id)
+
+    def get_cells(self) -> tuple[str, str, str, str]:
+        """Get the contents of the comments, grade, progress and status cells."""
+        if self.submission is None:
+            return "", self.get_grade(), self.progress, ""
+        return (
+            self.get_comments_count(),
+            self.get_grade(),
+            self.progress,
+            self.get_submission_status(),
+        )
 
-    def compose(self) -> ComposeResult:
-        with Horizontal():
-            yield Label(self.student_name)
-            yield Label(id="comments")
-            yield Label(id="grade")
-            yield Label(id="status")
-
-    def watch_submission(self) -> None:
-        if self.submission:
-            self.show_comments_count()
-            self.show_grade()
-            self.show_submission_status()
-
-    def show_comments_count(self) -> None:
+    def get_comments_count(self) -> str:
         author_count = len(
             [c for c in self.submission.comments if c.author_name == self.student_name]
         )
         other_count = len(self.submission.comments) - author_count
         match author_count, other_count:
             case 0, 0:
-                text = ""
+                return ""
             case int(), 0:
-                text = f"📝: [bold]{author_count}"
+                return f"📝: [bold]{author_count}"
             case 0, int():
-                text = f"📝:   [dim](+{other_count})"
+                return f"📝:   [dim](+{other_count})"
             case int(), int():
-                text = f"📝: [bold]{author_count}[/bold] [dim](+{other_count})"
-        self.query_one("#comments", Label).update(text)
+                return f"📝: [bold]{author_count}[/bold] [dim](+{other_count})"
+
+    @property
+    def grade(self) -> str | None:
+        """The grade, including a grade which was not yet sent to Canvas."""
+        if self.pending_grade is not None and self.pending_grade.grade is not None:
+            return self.pending_grade.grade
+        return self.submission.grade if self.submission else None
 
-    def show_grade(self) -> None:
-        match self.submission.grade:
+    def get_grade(self) -> str:
+        match self.grade:
             case "Fantastisch":
-                text = "[bold bright_white]Fantastisch ✨"
+                grade = "[bold bright_white]Fantastisch ✨"
             case "Goed":
-                text = "[bold green]Goed ✅"
+                grade = "[bold green]Goed ✅"
             case "Ontoereikend":
-                text = "[bold bright_red]Ontoereikend ❌"
+                grade = "[bold bright_red]Ontoereikend ❌"
             case _:
-                text = ""
-        self.query_one("#grade", Label).update(text)
+                grade = ""
+        if self.pending_grade is None:
+            return grade
+        # not yet sent to Canvas, or sending failed
+        return f"{grade} {'⚠️' if self.pending_grade.error else '⏳'}"
 
-    def show_submission_status(self) -> None:
+    def get_submission_status(self) -> str:
         if self.submission.attempt is None:
             if self.submission.seconds_late > 0:
-                text = "[italic bold red](Not submitted)"
+                return "[italic bold red](Not submitted)"
             else:
-                text = "[italic bold orange1](Not yet submitted)"
+                return "[italic bold orange1](Not yet submitted)"
         elif self.submission.attempts[-1].seconds_late == 0:
-            text = "[italic bold green](On time)"
+            return "[italic bold green](On time)"
         elif self.submission.attempts[-1].seconds_late < 15 * 60:
-            text = f"[italic bold orange1]({humanize.naturaldelta(self.submission.attempts[-1].seconds_late)})"
+            return f"[italic bold orange1]({humanize.naturaldelta(self.submission.attempts[-1].seconds_late)})"
         else:
-            text = f"[italic bold red]({humanize.naturaldelta(self.submission.attempts[-1].seconds_late)})"
-        self.query_one("#status", Label).update(text)
+            return f"[italic bold red]({humanize.naturaldelta(self.submission.attempts[-1].seconds_late)})"
+
+
+class Students(DataTable):
+    """Table of students, backed by a flat list of Student rows.
 
+    Only the visible rows are rendered. Rows are changed by updating the
+    Student and calling `mark_changed`, which is safe to call from worker
+    threads. All changed rows are then redrawn at once.
+    """
 
-class Students(ListView):
     BINDINGS = [("c", "show_comments", "Show comments")]
+    COLUMNS = {"comments": 12, "grade": 18, "progress": 17, "status": 19}
 
-    def __init__(self, assignment: Assignment) -> None:
-        super().__init__()
+    class RowsChanged(Message):
+        """Posted when there are changed rows to redraw."""
+
+    def __init__(self, assignment: Assignment, students: list[CanvasStudent]) -> None:
+        super().__init__(cursor_type="row", show_header=False, cell_padding=2)
         self.assignment = assignment
+        self.students = [Student(student) for student in students]
+        self._lookup = {student._student.id: student for student in self.students}
+        self._changed: set[int] = set()
+        self._changed_lock = threading.Lock()
 
-    def compose(self) -> ComposeResult:
-        for student in self.app.students:
-            yield Student(student)
+    def on_mount(self) -> None:
+        self.add_column("name", key="name")
+        for key, width in self.COLUMNS.items():
+            self.add_column(key, key=key, width=width)
+        for student in self.students:
+            self.add_row(student.student_name, *student.get_cells(), key=student.key)
+
+    def get_student(self, student_id: int) -> Student | None:
+        return self._lookup.get(student_id)
+
+    @property
+    def highlighted_student(self) -> Student | None:
+        if not self.students:
+            return None
+        return self.students[self.cursor_row]
+
+    def mark_changed(self, *students: Student) -> None:
+        """Schedule a redraw of the rows of students.
+
+        Args:
+            *students (Student): the students whose rows have changed.
+        """
+        with self._changed_lock:
+            is_scheduled = bool(self._changed)
+            self._changed.update(student._student.id for student in students)
+        if not is_scheduled:
+            self.post_message(self.RowsChanged())
+
+    def on_students_rows_changed(self, event: RowsChanged) -> None:
+        with self._changed_lock:
+            changed, self._changed = self._changed, set()
+        for student_id in changed:
+            student = self._lookup[student_id]
+            for column, value in zip(self.COLUMNS, student.get_cells()):
+                self.update_cell(student.key, column, value)
 
     def action_show_comments(self) -> None:
-        student: Student = self.highlighted_child
-        if student.submission:
+        student = self.highlighted_student
+        if student is not None and student.submission:
             if student.submission.comments:
                 self.app.push_screen(
                     CommentsScreen(student.student_name, student.submission.comments)
                 )
 
-    def on_list_item__child_clicked(self, event: ListItem._ChildClicked) -> None:
-        if self.index != (clicked_index := self._nodes.index(event.item)):
-            event.prevent_default()
-            event.stop()
-            self.index = clicked_index
-
 
 class GradeStudentCommands(Provider):
     app: "GradingTool"
 
     async def search(self, query: str) -> Hits:
         matcher = self.matcher(query)
-        for student in self.screen.query_one(Students).children:
+        for student in self.screen.query_one(Students).students:
             command = f"grade {student.student_name}"
             score = matcher.match(command)
             if score > 0:
@@ -158,7 +254,16 @@ class GradeStudentCommands(Provider):
 
 
 class StudentsScreen(Screen):
-    BINDINGS = [("escape", "go_back", "Back to Assignments")]
+    BINDINGS = [
+        ("escape", "go_back", "Back to Assignments"),
+        ("D", "download_all", "Download all"),
+        ("E", "extract_all", "Extract all"),
+        ("P", "prepare_all", "Prepare all"),
+        ("V", "ensure_envs", "Ensure envs"),
+        ("r", "refresh_submissions", "Refresh"),
+        ("l", "toggle_look_ahead", "Look-ahead"),
+        ("g", "grade", "Grade"),
+    ]
     COMMANDS = App.COMMANDS | {GradeStudentCommands}
 
     app: GradingTool
@@ -166,6 +271,7 @@ class StudentsScreen(Screen):
     def __init__(self, assignment: Assignment) -> None:
         super().__init__()
         self.assignment = assignment
+        self.last_sync: datetime | None = None
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -177,36 +283,304 @@ class StudentsScreen(Screen):
             id="breadcrumbs",
         )
         yield Label("Please Select a Student", id="list_header")
-        yield Students(self.assignment)
+        yield Students(self.assignment, self.app.students)
+        yield JobPanel()
 
     def on_mount(self) -> None:
-        self.query_one("Students").focus()
+        students = self.query_one(Students)
+        students.focus()
+        self.look_ahead = LookAhead(
+            self.app, self.assignment, students.students, self.app.config.look_ahead
+        )
+        self.show_grades()
         self.load_submission_info()
+        if self.app.config.refresh_interval > 0:
+            self.set_interval(
+                self.app.config.refresh_interval, self.refresh_submissions
+            )
 
     @work(thread=True)
     def load_submission_info(self) -> None:
         t0 = time.time()
-        students = list(self.query(Student))
-        student_lookup = {s._student.id: s for s in students}
-        self.notify("Loading submissions...")
-        submissions = self.app.canvas_tasks.get_submissions(self.assignment._assignment)
-        for submission in submissions:
-            student = student_lookup[submission.student_id]
-            student.submission = submission
+        assignment = self.assignment._assignment
+        if (stored := self.app.submissions.get(assignment.id)) is not None:
+            # fetched earlier in this session, only fetch the changes
+            self.last_sync, submissions = stored
+            self.app.call_from_thread(self.show_submissions, submissions)
+            self.sync_changed_submissions()
+            return
+        if cached := self.app.cache.submissions.get(assignment.id):
+            self.app.call_from_thread(self.show_submissions, cached)
+            self.notify("Showing cached submissions, refreshing...")
+        else:
+            self.notify("Loading submissions...")
+        started = datetime.now(timezone.utc)
+        submissions = self.app.canvas_tasks.get_submissions(assignment)
+        self.app.call_from_thread(self.show_submissions, submissions)
+        self.app.submissions.put(assignment.id, submissions, started)
+        store_submissions(self.app.config, self.app.cache, assignment, submissions)
+        self.last_sync = started
         self.notify(f"Loaded submissions in {time.time() - t0:.1f} s.")
 
+    def action_refresh_submissions(self) -> None:
+        if self.last_sync is None:
+            self.notify("Submissions are still loading.")
+        else:
+            self.refresh_submissions(quiet=False)
+
+    @work(thread=True, exclusive=True, group="refresh_submissions")
+    def refresh_submissions(self, quiet: bool = True) -> None:
+        if self.last_sync is None:
+            # the full load is still running
+            return
+        self.sync_changed_submissions(quiet)
+
+    def sync_changed_submissions(self, quiet: bool = True) -> None:
+        """Fetch only the submissions that changed since the last sync.
+
+        Args:
+            quiet (bool): only notify when submissions changed or on errors.
+        """
+        assignment = self.assignment._assignment
+        started = datetime.now(timezone.utc)
+        try:
+            changed = get_changed_submissions(
+                self.app.canvas_tasks, assignment, self.last_sync - SYNC_MARGIN
+            )
+        except Exception as exc:
+            self.notify(f"Could not refresh submissions: {exc}", severity="warning")
+            return
+        self.last_sync = started
+        stored = self.app.submissions.get(assignment.id)
+        if stored is not None:
+            submissions = stored[1]
+        else:
+            submissions = self.app.cache.submissions.get(assignment.id, [])
+        if changed:
+            submissions = list(
+                (
+                    {s.student_id: s for s in submissions}
+                    | {s.student_id: s for s in changed}
+                ).values()
+            )
+            store_submissions(self.app.config, self.app.cache, assignment, submissions)
+        self.app.submissions.put(assignment.id, submissions, started)
+        num_updated = self.app.call_from_thread(self.show_submissions, changed)
+        if num_updated or not quiet:
+            self.notify(f"Updated {num_updated} submission(s).")
+
+    def show_submissions(self, submissions: list[CanvasSubmission]) -> int:
+        """Show submissions, only updating students whose submission changed.
+
+        Args:
+            submissions (list[CanvasSubmission]): the submissions.
+
+        Returns:
+            int: the number of students that were updated.
+        """
+        students = self.query_one(Students)
+        updated = []
+        for submission in submissions:
+            student = students.get_student(submission.student_id)
+            if student is not None and student.submission != submission:
+                student.submission = submission
+                updated.append(student)
+        students.mark_changed(*updated)
+        return len(updated)
+
+    def get_submitted_students(self) -> list[Student]:
+        return [
+            s
+            for s in self.query_one(Students).students
+            if s.submission is not None and s.submission.attempt is not None
+        ]
+
+    @work(thread=True, exclusive=True, group="download_all")
+    def action_download_all(self) -> None:
+        students = self.get_submitted_students()
+        if not students:
+            self.notify("No submissions to download (yet).", severity="warning")
+            return
+        t0 = time.time()
+        self.notify(f"Synchronizing {len(students)} submissions...")
+        results = self.run_jobs(students, ("download",))
+        failed = [r for r in results.values() if isinstance(r, Exception)]
+        if failed:
+            self.notify(
+                f"Failed to download {len(failed)} of {len(results)} submissions.",
+                severity="error",
+            )
+        else:
+            self.notify(
+                f"Synchronized {len(results)} submissions in {time.time() - t0:.1f} s."
+            )
+
+    @work(thread=True, exclusive=True, group="extract_all")
+    def action_extract_all(self) -> None:
+        students = self.get_submitted_students()
+        if not students:
+            self.notify("No submissions to extract (yet).", severity="warning")
+            return
+        t0 = time.time()
+        self.notify(f"Extracting {len(students)} submissions...")
+        results = self.run_jobs(students, ("extract",))
+        self.notify(f"Extracted submissions in {time.time() - t0:.1f} s.")
+        failed = [r for r in results.values() if isinstance(r, Exception)]
+        self.app.call_from_thread(
+            self.app.push_screen,
+            TaskSummaryModal(
+                f"Extracted {len(results) - len(failed)} of {len(results)} submissions",
+                [(s.student_name, results[s._student.id]) for s in students],
+            ),
+        )
+
+    @work(thread=True, exclusive=True, group="prepare_all")
+    def action_prepare_all(self) -> None:
+        students = self.get_submitted_students()
+        if not students:
+            self.notify("No submissions to prepare (yet).", severity="warning")
+            return
+        self.prepare_students(students, STAGES)
+
+    @work(thread=True, exclusive=True, group="prepare_all")
+    def action_ensure_envs(self) -> None:
+        config = self.app.config
+        assignment = self.assignment._assignment
+        if not config.env:
+            self.notify("No environments configured.", severity="warning")
+            return
+        students = [
+            s
+            for s in self.get_submitted_students()
+            if get_code_dir(config, assignment, s._student).is_dir()
+        ]
+        if not students:
+            self.notify("No extracted submissions (yet).", severity="warning")
+            return
+        self.prepare_students(students, ("env",))
+
+    def prepare_students(
+        self, students: list[Student], stage_names: tuple[str, ...]
+    ) -> None:
+        """Run stages of the pipeline for students, showing their progress.
+
+        Args:
+            students (list[Student]): the students.
+            stage_names (tuple[str, ...]): the names of the stages to run.
+        """
+        t0 = time.time()
+        self.notify(f"Preparing {len(students)} students...")
+        results = self.run_jobs(students, stage_names)
+        failed = [r for r in results.values() if isinstance(r, Exception)]
+        self.notify(
+            f"Prepared {len(results) - len(failed)} of {len(results)} students "
+            f"in {time.time() - t0:.1f} s.",
+            severity="error" if failed else "information",
+        )
+        if failed:
+            self.app.call_from_thread(
+                self.app.push_screen,
+                TaskSummaryModal(
+                    f"Failed to prepare {len(failed)} of {len(results)} students",
+                    [(s.student_name, results[s._student.id]) for s in students],
+                ),
+            )
+
+    def run_jobs(
+        self, students: list[Student], kinds: tuple[str, ...]
+    ) -> dict[int, str | Exception]:
+        """Queue jobs for students and wait for them, showing their progress.
+
+        The jobs run in the job queue of the app, so that they never run at the
+        same time as other jobs for the same student, e.g. of the look-ahead.
+
+        Args:
+            students (list[Student]): the students.
+            kinds (tuple[str, ...]): the kinds of jobs to run for each student.
+
+        Returns:
+            dict[int, str | Exception]: the message of the last job, or the
+            error, keyed by student id.
+        """
+        assignment = self.assignment._assignment
+        student_jobs = {
+            s._student.id: submit_jobs(
+                self.app, assignment, s._student, kinds, s.submission
+            )
+            for s in students
+        }
+        all_jobs = [job for jobs in student_jobs.values() for job in jobs]
+        table = self.query_one(Students)
+        while True:
+            is_finished = self.app.jobs.wait(all_jobs, JOB_PANEL_INTERVAL)
+            changed = []
+            for s in students:
+                progress = get_progress(student_jobs[s._student.id])
+                if progress != s.progress:
+                    s.progress = progress
+                    changed.append(s)
+            table.mark_changed(*changed)
+            if is_finished:
+                return {
+                    student_id: get_jobs_result(jobs)
+                    for student_id, jobs in student_jobs.items()
+                }
+
+    def show_grades(self, sent: list[GradeRecord] | None = None) -> None:
+        """Show the grades which are queued, or were just sent to Canvas.
+
+        Args:
+            sent (list[GradeRecord] | None): the records which were sent.
+        """
+        table = self.query_one(Students)
+        assignment_id = self.assignment._assignment.id
+        changed = []
+        for record in sent or []:
+            student = table.get_student(record.student_id)
+            if (
+                record.assignment_id == assignment_id
+                and record.grade is not None
+                and student is not None
+                and student.submission is not None
+            ):
+                # Canvas now has the grade, before the next refresh shows it
+                student.submission = student.submission.model_copy(
+                    update={"grade": record.grade}
+                )
+                changed.append(student)
+        pending = self.app.grades.get_pending(assignment_id)
+        for student in table.students:
+            record = pending.get(student._student.id)
+            if record != student.pending_grade:
+                student.pending_grade = record
+                changed.append(student)
+        table.mark_changed(*changed)
+
+    def action_grade(self) -> None:
+        student = self.query_one(Students).highlighted_student
+        if student is not None:
+            self.app.grade_student(self.assignment._assignment, student)
+
+    def action_toggle_look_ahead(self) -> None:
+        self.notify(
+            self.look_ahead.toggle(self.query_one(Students).highlighted_student)
+        )
+
     @on(Button.Pressed, "#back")
     def action_go_back(self) -> None:
+        self.look_ahead.stop()
         self.dismiss()
 
-    @on(Students.Selected)
-    def select_student(self, event: Students.Selected) -> None:
-        self.show_tasks(event.item)
+    @on(Students.RowSelected)
+    def select_student(self, event: Students.RowSelected) -> None:
+        self.show_tasks(self.query_one(Students).students[event.cursor_row])
 
     def show_tasks(self, student: Student) -> None:
-        self.app.push_screen(TasksScreen(self.assignment, student))
+        self.look_ahead.update(student)
+        self.app.push_screen(TasksScreen(self.assignment, student, self.look_ahead))
 
     def highlight_student(self, student: Student) -> None:
         students = self.query_one(Students)
-        idx = students.children.index(student)
-        students.index = idx
+        students.move_cursor(row=students.get_row_index(student.key))
+        # move the look-ahead along when jumping to another student
+        self.look_ahead.update(student)
@@ -1,22 +1,15 @@
 from __future__ import annotations
 
 import os
-import re
-import shutil
-import stat
 import subprocess
-from dataclasses import dataclass
-from pathlib import Path
-from typing import TYPE_CHECKING
-from zipfile import ZipFile
+from functools import partial
+from typing import TYPE_CHECKING, Callable
 
-import requests
 from canvas_course_tools.datatypes import Assignment as CanvasAssignment
-from canvas_course_tools.datatypes import CanvasAttachment
+from canvas_course_tools.datatypes import CanvasSubmission
 from canvas_course_tools.datatypes import Student as CanvasStudent
-from slugify import slugify
-from textual import on, work
-from textual.app import ComposeResult, log
+from textual import on
+from textual.app import ComposeResult
 from textual.binding import Binding
 from textual.containers import Center, Horizontal, Vertical
 from textual.events import Key
@@ -24,114 +17,387 @@ from textual.screen import ModalScreen, Screen
 from textual.widgets import (
     Button,
     Collapsible,
+    DataTable,
     Footer,
     Header,
     Label,
     ListItem,
     ListView,
-    LoadingIndicator,
     Log,
+    RadioButton,
+    RadioSet,
     Static,
+    TextArea,
 )
-from textual.worker import Worker, WorkerFailed, WorkerState
 
 from ecpcgrading.config import Config, EnvironmentConfig
+from ecpcgrading.downloads import BlobStore, download_submission, get_shared_manifest
+from ecpcgrading.environments import ensure_env, get_python_version
+from ecpcgrading.errors import TaskError
+from ecpcgrading.extract import ZipLimits, can_update, extract_submission
+from ecpcgrading.grades import GRADES
+from ecpcgrading.index import get_slug, get_submission_index
+from ecpcgrading.instrumentation import measure
+from ecpcgrading.jobs import BACKGROUND_PRIORITY, USER_PRIORITY, Job, JobQueue
+from ecpcgrading.paths import (
+    get_blob_store_dir,
+    get_code_dir,
+    get_env_templates_dir,
+    get_manifest_path,
+    get_object_store,
+    get_submissions_dir,
+    get_uv_cache_dir,
+)
+from ecpcgrading.pipeline import STAGES
 
 if TYPE_CHECKING:
     from ecpcgrading.assignments import Assignment
+    from ecpcgrading.client import CanvasClient
     from ecpcgrading.students import Student
     from ecpcgrading.tui import GradingTool
 
+# how often the job panel checks for changes
+JOB_PANEL_INTERVAL = 0.25
+# maximum number of jobs shown in the job panel
+JOB_PANEL_ROWS = 100
+JOB_STATE_STYLES = {
+    "queued": "[dim]Queued",
+    "running": "[bold]Running",
+    "done": "[green]Done",
+    "failed": "[bold red]Failed",
+    "cancelled": "[dim]Cancelled",
+}
+
+
+def download(
+    config: Config,
+    canvas_tasks: CanvasClient,
+    assignment: CanvasAssignment,
+    student: CanvasStudent,
+    submission: CanvasSubmission | None = None,
+) -> str:
+    """Download the submission of a student, unless it is up to date.
+
+    The submission is fetched from Canvas, unless it is given.
+    """
+    submissions_dir = get_submissions_dir(config, assignment)
+    manifest = get_shared_manifest(get_manifest_path(config, assignment))
+    if submission is None:
+        submission = canvas_tasks.get_submission(assignment, student)
+    if manifest.is_current(submissions_dir, student, submission):
+        return "Submission is already up to date"
+    submission_path = download_submission(
+        canvas_tasks.session,
+        submissions_dir,
+        BlobStore(get_blob_store_dir(config)),
+        student,
+        submission,
+        manifest,
+    )
+    manifest.save()
+    get_submission_index(config, assignment).set_submission_file(
+        student, submission_path
+    )
+    if len(submission.attachments) == 1:
+        return f"Downloaded a single {submission_path.suffix}-file"
+    return f"Zipped {len(submission.attachments)} submitted file(s)"
+
+
+def extract(
+    config: Config,
+    jobs: JobQueue,
+    assignment: CanvasAssignment,
+    student: CanvasStudent,
+) -> str:
+    """Extract the submission of a student, zip files in a worker process."""
+    index = get_submission_index(config, assignment)
+    code_dir = index.get_code_dir(student)
+    path = index.get_submission_file(student)
+    replaced = code_dir.exists() and not can_update(path, code_dir)
+    args = (
+        path,
+        code_dir,
+        get_slug(student.name),
+        get_object_store(config, assignment),
+        ZipLimits.from_config(config),
+    )
+    try:
+        if path.suffix == ".zip":
+            msg = jobs.run_in_process(extract_submission, *args)
+        else:
+            msg = extract_submission(*args)
+    finally:
+        index.forget_code_dir(student)
+    return f"{msg} (replaced existing directory)" if replaced else msg
+
+
+def create_environment(
+    config: Config,
+    env: EnvironmentConfig,
+    assignment: CanvasAssignment,
+    student: CanvasStudent,
+) -> str:
+    """Make sure that a student has an up-to-date environment."""
+    code_dir = get_code_dir(config, assignment, student, check_subdir=True)
+    python_version = get_python_version(env, code_dir)
+    if python_version is None:
+        raise RuntimeError(
+            "Environment not created. Cannot determine Python version from "
+            ".python-version."
+        )
+    msg, _ = ensure_env(
+        code_dir,
+        python_version,
+        env.package_spec,
+        get_env_templates_dir(config, assignment),
+        get_uv_cache_dir(config),
+    )
+    return msg
+
+
+def open_vscode(
+    config: Config, assignment: CanvasAssignment, student: CanvasStudent
+) -> str:
+    """Open the code of a student in Visual Studio Code."""
+    code_dir = get_code_dir(config, assignment, student, check_subdir=True)
+    if not code_dir.exists():
+        raise RuntimeError("Please download and extract submission first.")
+
+    # find pyproject.toml and Python files in src/ folder
+    code_paths = []
+    if (p := code_dir / "pyproject.toml").exists():
+        code_paths.append(p)
+    code_paths.extend([p for p in code_dir.glob("src/**/*.py")])
+    # filter out __init__.py
+    code_paths = [p for p in code_paths if not p.name == "__init__.py"]
+
+    env = os.environ
+    # find Python interpreter in .venv
+    venv_dir = code_dir / ".venv"
+    for path in [venv_dir / "bin" / "python", venv_dir / "Scripts" / "python.exe"]:
+        if path.is_file():
+            # a copy, leaving the environment of the grading tool untouched
+            env = os.environ | {"VIRTUAL_ENV": str(venv_dir)}
+            break
+
+    # start VS Code
+    path_args = " ".join([f'"{p}"' for p in code_paths])
+    with measure("code", "vscode", files=len(code_paths)):
+        process = subprocess.run(
+            f'code "{code_dir}" {path_args}',
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            # make sure the .venv environment is used even when another virtual
+            # environment is activated
+            env=env,
+        )
+    if process.returncode:
+        raise TaskError(
+            f"Process exited with exit code: {process.returncode}",
+            details=process.stdout.decode(),
+        )
+    return "Visual Studio Code is running"
+
+
+def submit_jobs(
+    app: GradingTool,
+    assignment: CanvasAssignment,
+    student: CanvasStudent,
+    kinds: tuple[str, ...] = STAGES,
+    submission: CanvasSubmission | None = None,
+) -> list[Job]:
+    """Queue background jobs to prepare a student, each waiting for the previous.
+
+    Args:
+        app (GradingTool): the app, which owns the job queue.
+        assignment (CanvasAssignment): the assignment.
+        student (CanvasStudent): the student.
+        kinds (tuple[str, ...]): the kinds of jobs, out of "download",
+            "extract" and "env". The environment is the first configured
+            environment, and is skipped if there is none.
+        submission (CanvasSubmission | None): the submission to download,
+            fetched from Canvas if not given.
+
+    Returns:
+        list[Job]: the queued jobs.
+    """
+    config = app.config
+    steps = []
+    if "download" in kinds:
+        steps.append(
+            (
+                DownloadTask.kind,
+                DownloadTask.job_title,
+                partial(
+                    download, config, app.canvas_tasks, assignment, student, submission
+                ),
+            )
+        )
+    if "extract" in kinds:
+        steps.append(
+            (
+                DecompressCodeTask.kind,
+                DecompressCodeTask.job_title,
+                partial(extract, config, app.jobs, assignment, student),
+            )
+        )
+    if "env" in kinds and config.env:
+        env = next(iter(config.env.values()))
+        steps.append(
+            (
+                CreateEnvTask.kind,
+                f"Create environment ({env.name})",
+                partial(create_environment, config, env, assignment, student),
+            )
+        )
+    jobs = []
+    job = None
+    for kind, title, func in steps:
+        job = app.jobs.submit(
+            Job(
+                kind,
+                title,
+                assignment,
+                student,
+                func,
+                after=job,
+                priority=BACKGROUND_PRIORITY,
+            )
+        )
+        jobs.append(job)
+    return jobs
+
+
+def get_jobs_result(jobs: list[Job]) -> str | Exception:
+    """Get the result of finished jobs which ran one after the other.
 
-@dataclass
-class TaskError(Exception):
-    msg: str
-    details: str
+    Returns:
+        str | Exception: the message of the last job, or the error of the job
+        which failed or was cancelled.
+    """
+    for job in jobs:
+        if job.state == "failed":
+            return job.error
+        if job.state == "cancelled":
+            return RuntimeError(job.message)
+    return jobs[-1].message
 
 
 class Task(ListItem):
-    run_msg: str = "Running task..."
-    success_msg: str = "Finished task"
-    error_msg: str = "Task failed"
+    """A task in the list of tasks, which is run as a job when selected.
+
+    Args:
+        title (str): the title shown in the list.
+        func (Callable[[CanvasAssignment, CanvasStudent], str]): performs the
+            task for a student and returns a message describing the result.
+    """
+
+    kind: str
+    job_title: str
 
     app: GradingTool
 
-    def __init__(self, title: str = "", *args, **kwargs) -> None:
+    def __init__(
+        self,
+        title: str,
+        func: Callable[[CanvasAssignment, CanvasStudent], str],
+        *args,
+        **kwargs,
+    ) -> None:
         super().__init__(*args, **kwargs)
         self.title = title
+        self.func = func
 
     def compose(self) -> ComposeResult:
         yield Label(self.title)
 
-    def execute(self, assignment: Assignment, student: Student) -> Worker:
-        self._assignment = assignment._assignment
-        self._student = student._student
-        self.app.push_screen(RunTaskModal(self.run_msg))
-        # run worker and return worker to caller
-        return self.run_task()
-
-    @work(thread=True)
-    def run_task(self) -> None: ...
-
-    def on_worker_state_changed(self, event: Worker.StateChanged) -> None:
-        if event.state == WorkerState.RUNNING:
-            log(self.run_msg)
-        elif event.state == WorkerState.SUCCESS:
-            log(self.success_msg)
-            self.app.pop_screen()
-        elif event.state == WorkerState.ERROR:
-            log(self.error_msg)
-            self.app.pop_screen()
-            self.app.push_screen(
-                TaskErrorModal(self.error_msg, exception=event.worker.error)
+    def execute(
+        self, assignment: Assignment, student: Student, after: Job | None = None
+    ) -> Job:
+        """Queue the task as a job, without waiting for it to finish.
+
+        Args:
+            assignment (Assignment): the assignment.
+            student (Student): the student.
+            after (Job | None): a job which must succeed first.
+
+        Returns:
+            Job: the queued job.
+        """
+        return self.app.jobs.submit(
+            Job(
+                self.kind,
+                self.job_title,
+                assignment._assignment,
+                student._student,
+                partial(self.func, assignment._assignment, student._student),
+                after=after,
             )
+        )
 
 
-class RunTaskModal(ModalScreen):
+class TaskErrorModal(ModalScreen):
     def __init__(
         self,
         msg: str,
+        exception: TaskError,
         name: str | None = None,
         id: str | None = None,
         classes: str | None = None,
     ) -> None:
         super().__init__(name, id, classes)
         self.msg = msg
+        self.exception = exception
 
     def compose(self) -> ComposeResult:
         with Vertical(id="modal_dialog"):
+            yield Label(f"{self.msg}: {self.exception}", id="error_msg")
+            with Collapsible(title="Detailed output"):
+                yield Log()
             with Center():
-                yield Label(self.msg)
-            yield LoadingIndicator()
+                yield Button("Close", variant="primary")
 
+    def on_mount(self) -> None:
+        try:
+            self.query_one(Log).write(self.exception.details)
+        except AttributeError:
+            self.query_one(Collapsible).remove()
+            self.query_one("#modal_dialog").styles.height = "auto"
+        self.query_one(Button).focus()
 
-class TaskErrorModal(ModalScreen):
+    @on(Button.Pressed)
+    def close_dialog(self, event: Button.Pressed) -> None:
+        self.dismiss()
+
+
+class TaskSummaryModal(ModalScreen):
     def __init__(
         self,
         msg: str,
-        exception: TaskError,
+        results: list[tuple[str, str | Exception]],
         name: str | None = None,
         id: str | None = None,
         classes: str | None = None,
     ) -> None:
         super().__init__(name, id, classes)
         self.msg = msg
-        self.exception = exception
+        self.results = results
 
     def compose(self) -> ComposeResult:
         with Vertical(id="modal_dialog"):
-            yield Label(f"{self.msg}: {self.exception}", id="error_msg")
-            with Collapsible(title="Detailed output"):
-                yield Log()
+            yield Label(self.msg, id="summary_msg")
+            yield Log()
             with Center():
                 yield Button("Close", variant="primary")
 
     def on_mount(self) -> None:
-        try:
-            self.query_one(Log).write(self.exception.details)
-        except AttributeError:
-            self.query_one(Collapsible).remove()
-            self.query_one("#modal_dialog").styles.height = "auto"
+        log = self.query_one(Log)
+        for student_name, result in self.results:
+            if isinstance(result, Exception):
+                log.write_line(f"✖ {student_name}: {result}")
+            else:
+                log.write_line(f"✔ {student_name}: {result}")
         self.query_one(Button).focus()
 
     @on(Button.Pressed)
@@ -139,233 +405,229 @@ class TaskErrorModal(ModalScreen):
         self.dismiss()
 
 
-class DownloadTask(Task):
-    run_msg = "Downloading submission..."
-    success_msg = "Download successful"
-    error_msg = "Download failed"
+class GradeModal(ModalScreen[tuple[str | None, str] | None]):
+    """Dialog to grade a student and/or add a comment.
 
-    @work(thread=True, exit_on_error=False)
-    def run_task(self):
-        student_name = slugify(self._student.name)
-        submissions_dir = get_submissions_dir(self.app.config, self._assignment)
+    Dismissed with the new grade (None if unchanged) and the comment, or with
+    None when cancelled or when nothing was changed.
+    """
+
+    BINDINGS = [("escape", "dismiss", "Cancel"), ("ctrl+s", "save", "Save")]
+
+    def __init__(self, student_name: str, grade: str | None) -> None:
+        super().__init__()
+        self.student_name = student_name
+        self.grade = grade
+
+    def compose(self) -> ComposeResult:
+        with Vertical(id="modal_dialog"):
+            yield Label(f"Grade {self.student_name}")
+            with RadioSet():
+                for grade in GRADES:
+                    yield RadioButton(grade, value=grade == self.grade)
+            yield TextArea()
+            with Horizontal():
+                yield Button("Save [dim](ctrl+s)", variant="primary", id="save")
+                yield Button("Cancel", id="cancel")
+
+    def on_mount(self) -> None:
+        self.query_one(RadioSet).focus()
+
+    @on(Button.Pressed, "#save")
+    def action_save(self) -> None:
+        button = self.query_one(RadioSet).pressed_button
+        grade = None if button is None else str(button.label)
+        if grade == self.grade:
+            grade = None
+        comment = self.query_one(TextArea).text.strip()
+        self.dismiss((grade, comment) if grade is not None or comment else None)
+
+    @on(Button.Pressed, "#cancel")
+    def cancel(self) -> None:
+        self.dismiss()
 
-        submission = self.app.canvas_tasks.get_submissions(
-            self._assignment, self._student
-        )
-        if submission.attempt is None:
-            raise RuntimeError("Student did not yet submit this assignment")
-
-        Path.mkdir(submissions_dir, parents=True, exist_ok=True)
-        match submission.attachments:
-            case [CanvasAttachment() as attachment]:
-                submission_path = (
-                    submissions_dir / f"{student_name}_{attachment.filename}"
-                )
-                file_type = submission_path.suffix
-                file_contents = requests.get(attachment.url).content
-                submission_path.write_bytes(file_contents)
-                self.app.call_from_thread(
-                    self.notify, f"Downloaded a single {file_type}-file"
-                )
-            case [*attachments]:
-                self.zip_attachments(student_name, submissions_dir, attachments)
-                self.app.call_from_thread(
-                    self.notify,
-                    f"Zipped {len(attachments)} submitted file(s)",
-                    severity="warning",
-                )
-
-    def zip_attachments(
-        self, student_name, submissions_dir, attachments: list[CanvasAttachment]
-    ):
-        submission_path = submissions_dir / (student_name + "_zipped.zip")
-        with ZipFile(submission_path, mode="w") as f:
-            for attachment in attachments:
-                file_contents = requests.get(attachment.url).content
-                f.writestr(attachment.filename, data=file_contents)
+
+class DownloadTask(Task):
+    kind = "download"
+    job_title = "Download submission"
 
 
 class DecompressCodeTask(Task):
-    run_msg = "Extracting files..."
-    success_msg = "Code successfully decompressed"
-    error_msg = "Decompression failed"
-
-    @work(thread=True, exit_on_error=False)
-    def run_task(self):
-        submissions_dir = get_submissions_dir(self.app.config, self._assignment)
-        code_dir = get_code_dir(self.app.config, self._assignment, self._student)
-        student_name = slugify(self._student.name)
-
-        match list(submissions_dir.glob(f"{student_name}_*")):
-            case [path]:
-                if code_dir.exists():
-                    self.app.call_from_thread(
-                        self.notify,
-                        f"Removing existing directory {code_dir}",
-                        severity="warning",
-                    )
-                    shutil.rmtree(code_dir, onerror=remove_readonly)
-                Path.mkdir(code_dir, parents=True)
-                match path.suffix:
-                    case ".zip":
-                        # a zip file (old submission format)
-                        with ZipFile(path) as f:
-                            f.extractall(path=code_dir)
-                        self.app.call_from_thread(
-                            self.notify, "Extracted submitted files"
-                        )
-                    case ".bundle":
-                        # a bundle file (new submission format)
-                        process = subprocess.run(
-                            ["git", "clone", path, code_dir],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                        )
-                        output = process.stdout.decode()
-                        self.log(output)
-                        if process.returncode:
-                            raise TaskError(
-                                f"Process exited with exit code: {process.returncode}",
-                                details=output,
-                            )
-                        self.app.call_from_thread(
-                            self.notify, "Cloned submitted repository"
-                        )
-                    case _:
-                        # default case, .py or something else
-                        # copy it as-is to the code directory
-                        target_name = path.name.removeprefix(f"{student_name}_")
-                        shutil.copy(path, code_dir / target_name)
-                        self.app.call_from_thread(self.notify, f"Copied {target_name}")
-            case [_, *_]:
-                raise RuntimeError("More than one submission file")
-            case _:
-                raise RuntimeError("Can't locate submission file")
+    kind = "extract"
+    job_title = "Extract submission"
 
 
 class CreateEnvTask(Task):
-    success_msg = "Environment successfully created"
-    error_msg = "Environment creation failed"
-
-    def __init__(self, title: str, env: EnvironmentConfig, *args, **kwargs) -> None:
-        super().__init__(title, *args, **kwargs)
-        self.run_msg = f"Creating environment ({env.name})..."
-        self.env = env
-
-    @work(thread=True, exit_on_error=False)
-    def run_task(self):
-        code_dir = get_code_dir(
-            self.app.config, self._assignment, self._student, check_subdir=True
-        )
-        python_version = self.env.python_version
-        if python_version == "*":
-            if (p := (code_dir / ".python-version")).is_file():
-                python_version = p.open().readline().rstrip("\n")
-            else:
-                self.notify(
-                    "Environment not created. Cannot determine Python version from .python-version.",
-                    severity="warning",
-                )
-                return
-
-        command = f"uv venv --python {python_version} --clear"
-        if self.env.package_spec:
-            command += f" && uv pip install {self.env.package_spec}"
+    kind = "env"
 
-        process = subprocess.run(
-            command,
-            cwd=code_dir,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            # make sure the .venv environment is used for installing packages
-            # even when another virtual environment is activated
-            env=os.environ | {"VIRTUAL_ENV": "./.venv"},
-        )
-        output = process.stdout.decode()
-        self.log(output)
-        if process.returncode:
-            raise TaskError(
-                f"Process exited with exit code: {process.returncode}", details=output
-            )
-        self.notify(f"Created clean environment ({python_version})")
+    def __init__(
+        self,
+        title: str,
+        func: Callable[[CanvasAssignment, CanvasStudent], str],
+        env: EnvironmentConfig,
+        *args,
+        **kwargs,
+    ) -> None:
+        super().__init__(title, func, *args, **kwargs)
+        self.job_title = f"Create environment ({env.name})"
 
 
 class OpenCodeTask(Task):
-    run_msg = "Starting Visual Studio Code..."
-    success_msg = "Visual Studio Code is running"
-    error_msg = "Could not start Visual Studio Code"
-
-    @work(thread=True, exit_on_error=False)
-    def run_task(self):
-        code_dir = get_code_dir(
-            self.app.config, self._assignment, self._student, check_subdir=True
-        )
-        if not code_dir.exists():
-            raise RuntimeError("Please download and extract submission first.")
-
-        # find pyproject.toml and Python files in src/ folder
-        code_paths = []
-        if (p := code_dir / "pyproject.toml").exists():
-            code_paths.append(p)
-        code_paths.extend([p for p in code_dir.glob("src/**/*.py")])
-        # filter out __init__.py
-        code_paths = [p for p in code_paths if not p.name == "__init__.py"]
-
-        env = os.environ
-        # find Python interpreter in .venv
-        for path in [Path(".venv/bin/python"), Path(".venv/Scripts/python.exe")]:
-            if path.is_file():
-                env |= {"VIRTUAL_ENV": str(path)}
-                break
-
-        # start VS Code
-        path_args = " ".join([f'"{p}"' for p in code_paths])
-        print(f'code "{code_dir}" {path_args}')
-        process = subprocess.run(
-            f'code "{code_dir}" {path_args}',
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            # make sure the .venv environment is used even when another virtual
-            # environment is activated
-            env=env,
-        )
-        self.log(process.stdout.decode())
-        if process.returncode:
-            raise RuntimeError(f"Process exited with exit code: {process.returncode}")
+    kind = "vscode"
+    job_title = "Open Visual Studio Code"
 
 
-def get_submissions_dir(config: Config, assignment: CanvasAssignment):
-    return config.root_path / slugify(assignment.name) / config.submissions_path
+class LookAhead:
+    """Prepares the next students in the background while grading.
 
+    While a student is being graded, the next students with a submission are
+    downloaded, extracted and get the first environment, using background
+    jobs. When moving to another student, the queued jobs of students which
+    are no longer ahead are cancelled, and the jobs of the new student get the
+    priority of the user's own jobs.
 
-def get_code_dir(
-    config: Config,
-    assignment: CanvasAssignment,
-    student: CanvasStudent,
-    check_subdir: bool = False,
-) -> Path:
-    student_dir = (
-        config.root_path
-        / slugify(assignment.name)
-        / config.code_path
-        / slugify(student.name)
-    )
+    Args:
+        app (GradingTool): the app, which owns the job queue.
+        assignment (Assignment): the assignment.
+        students (list[Student]): all students, in the order of grading.
+        count (int): the number of students to prepare ahead.
+    """
 
-    if check_subdir and student_dir.exists():
-        dir_contents: Path = list(student_dir.iterdir())
-        if len(dir_contents) == 1 and dir_contents[0].is_dir():
-            # student submitted a directory containing all the files, use that
-            # directory as code dir
-            return dir_contents[0]
-    return student_dir
+    def __init__(
+        self,
+        app: GradingTool,
+        assignment: Assignment,
+        students: list[Student],
+        count: int,
+    ) -> None:
+        self.app = app
+        self.assignment = assignment
+        self.students = students
+        self.count = count
+        self.enabled = False
+        self._jobs: dict[int, list[Job]] = {}
+        self._job_ids: set[int] = set()
+
+    def toggle(self, student: Student | None) -> str:
+        """Enable or disable look-ahead, starting from a student.
+
+        Returns:
+            str: a message for the user.
+        """
+        self.enabled = not self.enabled
+        if not self.enabled:
+            self.stop()
+            return "Look-ahead disabled"
+        if student is not None:
+            self.update(student)
+        return f"Look-ahead enabled, preparing the next {self.count} students"
+
+    def update(self, student: Student) -> None:
+        """Prepare the students ahead of the student which is being graded."""
+        if not self.enabled:
+            return
+        ahead = self.get_students_ahead(student)
+        keep = {s._student.id for s in ahead} | {student._student.id}
+        queue = self.app.jobs
+        queue.set_priority(
+            lambda job: self.is_own(job) and job.student.id == student._student.id,
+            USER_PRIORITY,
+        )
+        queue.cancel(
+            lambda job: self.is_own(job) and job.student.id not in keep,
+            "No longer ahead",
+        )
+        for s in ahead:
+            jobs = self._jobs.get(s._student.id)
+            if jobs is None or (
+                any(job.state == "cancelled" for job in jobs)
+                and not any(job.state == "failed" for job in jobs)
+            ):
+                self._jobs[s._student.id] = self.submit(s)
+
+    def stop(self) -> None:
+        """Cancel all queued look-ahead jobs."""
+        self.app.jobs.cancel(self.is_own, "Look-ahead stopped")
+
+    def is_own(self, job: Job) -> bool:
+        return job.id in self._job_ids
+
+    def get_students_ahead(self, student: Student) -> list[Student]:
+        start = self.students.index(student) + 1
+        return [
+            s
+            for s in self.students[start:]
+            if s.submission is not None and s.submission.attempt is not None
+        ][: self.count]
+
+    def submit(self, student: Student) -> list[Job]:
+        """Queue the jobs to prepare a student, each waiting for the previous."""
+        jobs = submit_jobs(self.app, self.assignment._assignment, student._student)
+        self._job_ids.update(job.id for job in jobs)
+        return jobs
+
+
+class JobPanel(DataTable):
+    """Non-modal overview of the queued, running and finished jobs.
+
+    The panel is hidden while there are no jobs. Selecting a failed job shows
+    its error.
+    """
 
+    app: GradingTool
 
-def remove_readonly(func, path, excinfo):
-    """Make a path writable and retry the failed function call."""
-    os.chmod(path, stat.S_IWRITE)
-    func(path)
+    def __init__(self) -> None:
+        super().__init__(cursor_type="row", zebra_stripes=True)
+        self.jobs: list[Job] = []
+        self._version = -1
+
+    def on_mount(self) -> None:
+        self.add_columns("Student", "Job", "State", "Time", "Result")
+        self.update_jobs()
+        self.set_interval(JOB_PANEL_INTERVAL, self.update_jobs)
+
+    def update_jobs(self) -> None:
+        queue = self.app.jobs
+        if queue.version == self._version and not any(
+            job.state == "running" for job in self.jobs
+        ):
+            return
+        self._version = queue.version
+        jobs = queue.get_jobs()
+        # running jobs first, then the queued jobs in the order in which they
+        # will run, then the most recently finished jobs
+        self.jobs = (
+            [job for job in jobs if job.state == "running"]
+            + sorted(
+                (job for job in jobs if job.state == "queued"),
+                key=lambda job: (job.priority, job.id),
+            )
+            + sorted(
+                (job for job in jobs if job.is_finished),
+                key=lambda job: job.finished_at,
+                reverse=True,
+            )
+        )[:JOB_PANEL_ROWS]
+        self.display = bool(self.jobs)
+        cursor_row = self.cursor_row
+        self.clear()
+        for job in self.jobs:
+            self.add_row(
+                job.student.name,
+                job.title,
+                JOB_STATE_STYLES[job.state],
+                f"{job.duration:.1f} s" if job.duration is not None else "",
+                job.message,
+            )
+        self.move_cursor(row=cursor_row)
+
+    @on(DataTable.RowSelected)
+    def show_error(self, event: DataTable.RowSelected) -> None:
+        job = self.jobs[event.cursor_row]
+        if job.error is not None:
+            self.app.push_screen(
+                TaskErrorModal(f"{job.title} failed", exception=job.error)
+            )
 
 
 class Tasks(ListView):
@@ -377,17 +639,29 @@ class Tasks(ListView):
         self.student = student
 
     def compose(self) -> ComposeResult:
-        yield DownloadTask(r"Download Submission [dim]\[d]", id="download_task")
+        config = self.app.config
+        yield DownloadTask(
+            r"Download Submission [dim]\[d]",
+            partial(download, config, self.app.canvas_tasks),
+            id="download_task",
+        )
         yield DecompressCodeTask(
-            r"Extract submission into grading folder [dim]\[e]", id="extract_task"
+            r"Extract submission into grading folder [dim]\[e]",
+            partial(extract, config, self.app.jobs),
+            id="extract_task",
         )
-        for idx, env in enumerate(self.app.config.env.values()):
+        for idx, env in enumerate(config.env.values()):
             yield CreateEnvTask(
                 rf"Create virtual environment: {env.name} [dim]\[{idx}]",
+                partial(create_environment, config, env),
                 env=env,
                 id=f"create_env{idx}_task",
             )
-        yield OpenCodeTask(r"Open Visual Studio Code [dim]\[o]", id="open_vscode_task")
+        yield OpenCodeTask(
+            r"Open Visual Studio Code [dim]\[o]",
+            partial(open_vscode, config),
+            id="open_vscode_task",
+        )
 
     @on(ListView.Selected)
     def execute_task(self, selected: ListView.Selected) -> None:
@@ -401,12 +675,22 @@ class TasksScreen(Screen):
         Binding("e", "extract_submission", show=False),
         Binding("o", "open_vscode", show=False),
         ("s", "speedrun", "Speedrun"),
+        ("l", "toggle_look_ahead", "Look-ahead"),
+        ("g", "grade", "Grade"),
     ]
 
-    def __init__(self, assignment: Assignment, student: Student) -> None:
+    app: GradingTool
+
+    def __init__(
+        self,
+        assignment: Assignment,
+        student: Student,
+        look_ahead: LookAhead | None = None,
+    ) -> None:
         super().__init__()
         self.assignment = assignment
         self.student = student
+        self.look_ahead = look_ahead
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -420,6 +704,7 @@ class TasksScreen(Screen):
         )
         yield Label("Please Select a Task", id="list_header")
         yield Tasks(self.assignment, self.student)
+        yield JobPanel()
 
     def on_mount(self) -> None:
         self.query_one("Tasks").focus()
@@ -428,24 +713,10 @@ class TasksScreen(Screen):
     def action_go_back(self) -> None:
         self.dismiss()
 
-    def run_task(self, task_id) -> None:
-        self.query_one(task_id, Task).execute(self.assignment, self.student)
-
-    async def run_task_wait(self, task_id) -> None:
-        # WIP: Nice idea, but blocking the event queue results in behavior that
-        # depends on whether it is blocked in the action, or the on_key method.
-        # Sometimes the keys are queued for this screen, sometimes they are
-        # dumped on the modal, it all depends. And when an error occurs the keys
-        # can get dumped in that new error dialog. So this is not very useful
-        # for quickly typing several shortcuts and have that result in a queue
-        # of tasks to perform. Leaving this for now.
-        worker = self.query_one(task_id, Task).execute(self.assignment, self.student)
-        try:
-            await worker.wait()
-        except WorkerFailed:
-            # any error is handled by the task
-            pass
-        return worker
+    def run_task(self, task_id, after: Job | None = None) -> Job:
+        return self.query_one(task_id, Task).execute(
+            self.assignment, self.student, after
+        )
 
     def on_key(self, event: Key) -> None:
         try:
@@ -458,23 +729,29 @@ class TasksScreen(Screen):
                 # check idx bound for number of environment entries
                 self.run_task(f"#create_env{idx}_task")
 
-    async def action_download(self) -> None:
-        await self.run_task_wait("#download_task")
+    def action_download(self) -> None:
+        self.run_task("#download_task")
+
+    def action_extract_submission(self) -> None:
+        self.run_task("#extract_task")
+
+    def action_open_vscode(self) -> None:
+        self.run_task("#open_vscode_task")
 
-    async def action_extract_submission(self) -> None:
-        await self.run_task_wait("#extract_task")
+    def action_grade(self) -> None:
+        self.app.grade_student(self.assignment._assignment, self.student)
 
-    async def action_open_vscode(self) -> None:
-        await self.run_task_wait("#open_vscode_task")
+    def action_toggle_look_ahead(self) -> None:
+        if self.look_ahead is not None:
+            self.notify(self.look_ahead.toggle(self.student))
 
-    async def action_speedrun(self) -> None:
+    def action_speedrun(self) -> None:
+        # every job only runs if the previous one succeeded
+        job = None
         for task_id in [
             "#download_task",
             "#extract_task",
             "#create_env0_task",
             "#open_vscode_task",
         ]:
-            worker = await self.run_task_wait(task_id)
-            if worker.error:
-                # there was an error, abort speedrun
-                break
+            job = self.run_task(task_id, after=job)
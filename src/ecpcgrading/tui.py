@@ -1,20 +1,32 @@
+from __future__ import annotations
+
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterable
 
-from canvas_course_tools.canvas_tasks import CanvasTasks
-from canvas_course_tools.datatypes import Assignment as CanvasAssignment
-from canvas_course_tools.datatypes import Course as CanvasCourse
-from canvas_course_tools.datatypes import Student as CanvasStudent
-from canvas_course_tools.utils import find_course
 from textual import on, work
-from textual.app import App, ComposeResult
+from textual.app import App, ComposeResult, SystemCommand
 from textual.containers import Center, Vertical
-from textual.screen import ModalScreen
+from textual.message import Message
+from textual.screen import ModalScreen, Screen
+from textual.timer import Timer
 from textual.widgets import Label, LoadingIndicator
-from textual.worker import Worker, WorkerState
+from textual.worker import Worker, WorkerState, get_current_worker
 
 import ecpcgrading.config
-from ecpcgrading import canvas
-from ecpcgrading.assignments import AssignmentsScreen
+
+# Canvas, the cache and the other screens are imported when they are first
+# needed, so that the first frame is shown without waiting for those imports
+if TYPE_CHECKING:
+    from canvas_course_tools.datatypes import Assignment as CanvasAssignment
+    from canvas_course_tools.datatypes import Course as CanvasCourse
+    from canvas_course_tools.datatypes import Student as CanvasStudent
+
+    from ecpcgrading.cache import CanvasCache, SubmissionStore
+    from ecpcgrading.client import CanvasClient
+    from ecpcgrading.grades import GradeQueue, GradeRecord
+    from ecpcgrading.jobs import Job, JobQueue
+    from ecpcgrading.profiling import StartupProfile
+    from ecpcgrading.students import Student
 
 
 class StartupScreen(ModalScreen):
@@ -32,17 +44,34 @@ class StartupScreen(ModalScreen):
 
     @work(thread=True)
     def get_assignments_and_students(self) -> list[str]:
-        config: ecpcgrading.config.Config = self.app.config
-        canvas_tasks, course = find_course(config.course_alias)
-        assignments = canvas.get_assignments(
-            canvas_tasks, course, config.assignment_group
-        )
-        students = canvas.get_students(
-            canvas_tasks, course, config.groupset, config.group
+        from ecpcgrading import canvas
+        from ecpcgrading.cache import (
+            SubmissionStore,
+            fetch_canvas_data,
+            load_cache,
+            save_cache,
         )
-        self.app.canvas_tasks = canvas_tasks
-        self.app.course = course
-        return assignments, students
+        from ecpcgrading.grades import GradeQueue
+        from ecpcgrading.jobs import JobQueue
+        from ecpcgrading.paths import get_grade_queue_path
+
+        config: ecpcgrading.config.Config = self.app.config
+        if (cache := load_cache(config)) is not None:
+            self.app.canvas_tasks, _ = canvas.get_canvas_tasks(
+                config.course_alias, config.pool_size, config.max_retries
+            )
+        else:
+            self.app.canvas_tasks, cache = fetch_canvas_data(config)
+            save_cache(config, cache)
+        self.app.cache = cache
+        self.app.course = cache.course
+        self.app.submissions = SubmissionStore(config.submission_store_size)
+        self.app.jobs = JobQueue.from_config(config, callback=self.app.job_finished)
+        self.app.grades = GradeQueue(get_grade_queue_path(config))
+        # import the next screen while the loading indicator is still shown
+        import ecpcgrading.assignments  # noqa: F401 (preloaded in the background)
+
+        return cache.assignments, cache.students
 
     @on(Worker.StateChanged)
     def return_assignments(self, event: Worker.StateChanged) -> None:
@@ -56,13 +85,24 @@ class GradingTool(App):
     CSS_PATH = "grading_tool.tcss"
 
     config: ecpcgrading.config.Config
-    canvas_tasks: CanvasTasks
+    canvas_tasks: CanvasClient
     course: CanvasCourse
+    cache: CanvasCache
+    submissions: SubmissionStore
+    jobs: JobQueue
+    grades: GradeQueue
     assignments: list[CanvasAssignment]
     students: list[CanvasStudent]
 
-    def __init__(self):
+    class JobFinished(Message):
+        def __init__(self, job: Job) -> None:
+            super().__init__()
+            self.job = job
+
+    def __init__(self, profile: StartupProfile | None = None):
         super().__init__()
+        self.profile = profile
+        self._flush_timer: Timer | None = None
         try:
             self.config = ecpcgrading.config.read_config(Path.cwd())
         except FileNotFoundError:
@@ -73,10 +113,199 @@ class GradingTool(App):
 
     def on_mount(self) -> None:
         def callback(result):
+            from ecpcgrading.assignments import AssignmentsScreen
+
             self.assignments, self.students = result
             self.push_screen(AssignmentsScreen())
+            if self.profile is not None:
+                self.call_after_refresh(self.profile_mark, "assignments", exit=True)
+            elif self.cache.is_stale(self.config.cache_ttl):
+                self.refresh_canvas_data()
+            elif self.config.prefetch_submissions:
+                self.prefetch_submissions()
+            if self.profile is None:
+                if (path := self.grades.moved_aside) is not None:
+                    self.notify(
+                        f"Could not read the queue of unsent grades, moved it to {path}",
+                        severity="error",
+                        timeout=30,
+                    )
+                # send the grades which were left over from the last session
+                if len(self.grades):
+                    self.flush_grades()
+                if self.config.grade_flush_interval > 0:
+                    self.set_interval(
+                        self.config.grade_flush_interval, self.flush_grades
+                    )
 
         self.app.push_screen(StartupScreen(), callback=callback)
+        if self.profile is not None:
+            self.call_after_refresh(self.profile_mark, "first frame")
+
+    def on_unmount(self) -> None:
+        if hasattr(self, "jobs"):
+            self.jobs.shutdown()
+
+    def job_finished(self, job: Job) -> None:
+        # called from the threads of the job queue
+        self.post_message(self.JobFinished(job))
+
+    def on_grading_tool_job_finished(self, message: JobFinished) -> None:
+        job = message.job
+        if job.is_background:
+            # shown in the job panel only
+            return
+        if job.state == "done":
+            self.notify(f"{job.student.name}: {job.message}", title=job.title)
+        elif job.state == "failed":
+            self.notify(
+                f"{job.student.name}: {job.message}",
+                title=f"{job.title} failed",
+                severity="error",
+            )
+
+    def grade_student(self, assignment: CanvasAssignment, student: Student) -> None:
+        """Ask for a grade and/or comment and queue it for Canvas."""
+        from ecpcgrading.grades import FLUSH_DELAY
+        from ecpcgrading.tasks import GradeModal
+
+        def callback(result: tuple[str | None, str] | None) -> None:
+            if result is None:
+                return
+            grade, comment = result
+            self.grades.add(assignment, student._student, grade, comment)
+            self.show_grades()
+            # wait for more grades, to send them in a single batch
+            if self._flush_timer is not None:
+                self._flush_timer.stop()
+            self._flush_timer = self.set_timer(FLUSH_DELAY, self.flush_grades)
+
+        self.push_screen(GradeModal(student.student_name, student.grade), callback)
+
+    @work(thread=True, group="flush_grades")
+    def flush_grades(self) -> None:
+        if not len(self.grades):
+            return
+        sent, failed = self.grades.flush(self.canvas_tasks)
+        if sent:
+            self.notify(f"Sent {len(sent)} grade(s) to Canvas.")
+        if failed:
+            self.notify(
+                f"Could not send {len(failed)} grade(s) to Canvas, will retry: "
+                f"{failed[0].error}",
+                severity="warning",
+            )
+        if sent or failed:
+            self.call_from_thread(self.show_grades, sent)
+
+    def show_grades(self, sent: list[GradeRecord] | None = None) -> None:
+        from ecpcgrading.students import StudentsScreen
+
+        for screen in self.screen_stack:
+            if isinstance(screen, StudentsScreen):
+                screen.show_grades(sent)
+
+    def profile_mark(self, name: str, exit: bool = False) -> None:
+        self.profile.mark(name)
+        if exit:
+            self.exit()
+
+    def get_system_commands(self, screen: Screen) -> Iterable[SystemCommand]:
+        yield from super().get_system_commands(screen)
+        yield SystemCommand(
+            "Refresh Canvas data",
+            "Reload the course, assignments and students from Canvas",
+            self.action_refresh_canvas_data,
+        )
+        yield SystemCommand(
+            "Performance metrics",
+            "Show the time spent on Canvas, downloads, extraction, uv and VS Code",
+            self.action_show_metrics,
+        )
+
+    def action_show_metrics(self) -> None:
+        from ecpcgrading.metrics import MetricsScreen
+
+        self.push_screen(MetricsScreen())
+
+    def action_refresh_canvas_data(self) -> None:
+        from ecpcgrading import canvas
+
+        self.notify("Refreshing Canvas data...")
+        canvas.clear_group_lookups()
+        self.refresh_canvas_data()
+
+    @work(thread=True, exclusive=True, group="refresh_canvas_data")
+    def refresh_canvas_data(self) -> None:
+        from ecpcgrading.cache import fetch_canvas_data, save_cache
+
+        try:
+            canvas_tasks, cache = fetch_canvas_data(self.config)
+        except Exception as exc:
+            self.notify(f"Could not refresh Canvas data: {exc}", severity="error")
+            return
+        # submissions are refreshed when an assignment is opened
+        cache.submissions = self.cache.submissions
+        save_cache(self.config, cache)
+        self.call_from_thread(self.update_canvas_data, canvas_tasks, cache)
+
+    async def update_canvas_data(
+        self, canvas_tasks: CanvasClient, cache: CanvasCache
+    ) -> None:
+        from ecpcgrading.assignments import AssignmentsScreen
+
+        self.canvas_tasks = canvas_tasks
+        self.cache = cache
+        self.course = cache.course
+        self.assignments = cache.assignments
+        self.students = cache.students
+        for screen in self.screen_stack:
+            if isinstance(screen, AssignmentsScreen):
+                await screen.update_assignments()
+        if self.config.prefetch_submissions:
+            self.prefetch_submissions()
+
+    @work(thread=True, exclusive=True, group="prefetch_submissions")
+    def prefetch_submissions(self) -> None:
+        """Fetch the submissions of all assignments in the background.
+
+        Assignments are fetched one at a time, so that the user's own requests
+        are not slowed down, until the submission store is full.
+        """
+        from datetime import datetime, timezone
+
+        from ecpcgrading.assignments import AssignmentsScreen
+        from ecpcgrading.cache import save_cache, store_submissions
+
+        worker = get_current_worker()
+        cache = self.cache
+        stored = False
+        try:
+            for assignment in self.assignments[: self.submissions.maxsize]:
+                if worker.is_cancelled:
+                    return
+                if assignment.id in self.submissions:
+                    continue
+                fetched_at = datetime.now(timezone.utc)
+                try:
+                    submissions = self.canvas_tasks.get_submissions(assignment)
+                except Exception as exc:
+                    self.notify(
+                        f"Could not prefetch submissions: {exc}", severity="warning"
+                    )
+                    return
+                self.submissions.put(assignment.id, submissions, fetched_at)
+                # the cache is saved once, instead of after every assignment
+                store_submissions(
+                    self.config, cache, assignment, submissions, save=False
+                )
+                stored = True
+                for screen in self.screen_stack:
+                    if isinstance(screen, AssignmentsScreen):
+                        self.call_from_thread(screen.show_counts, assignment.id)
+        finally:
+            if stored:
+                save_cache(self.config, cache)
 
 
 def app():